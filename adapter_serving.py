@@ -0,0 +1,195 @@
+"""
+Serve registered LoRA adapters on top of one loaded base model.
+
+Adapters listed in ``config/adapters.json`` are copied on demand into the slots
+of a multi-LoRA bank (see :mod:`multi_lora`) instead of being merged into
+separate model copies. Loaded adapters are kept in LRU order; when every slot
+is taken the least recently used adapter that no request is using is replaced.
+"""
+import json
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import torch
+
+from multi_lora import (
+    has_multi_lora,
+    inject_multi_lora,
+    load_multi_lora_adapter,
+    read_adapter_config,
+    set_adapter_indices,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REGISTRY_PATH = "config/adapters.json"
+FALLBACK_TARGET_MODULES = ["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj"]
+
+
+class LoraAdapterBank:
+    """LRU of registry adapters loaded into multi-LoRA slots of one base model"""
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        registry_path: str = DEFAULT_REGISTRY_PATH,
+        max_loaded: int = 8,
+        max_rank: Optional[int] = None,
+        target_modules: Optional[Sequence[str]] = None,
+    ):
+        """
+        Args:
+            model: Base causal LM (not merged, not wrapped by PEFT)
+            registry_path: Adapter registry JSON
+            max_loaded: Number of adapter slots kept resident
+            max_rank: Bank rank (defaults to the largest rank in the registry)
+            target_modules: Projections to wrap (defaults to the registry's union)
+        """
+        self.model = model
+        self.registry_path = registry_path
+        self.max_loaded = max_loaded
+        self.max_rank = max_rank
+        self.target_modules = list(target_modules) if target_modules else None
+
+        self._slots: "OrderedDict[str, int]" = OrderedDict()
+        self._paths: Dict[str, str] = {}
+        self._in_use: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        # Uniform per-request selection is model-wide state, so one request at a time
+        self.switch_lock = threading.RLock()
+        self.active: Optional[str] = None
+        self.loads = 0
+
+    def _resolve(self, name_or_path: str) -> Dict:
+        from train import find_registered_adapter
+
+        return find_registered_adapter(self.registry_path, name_or_path)
+
+    def resolve_path(self, name_or_path: str) -> str:
+        """Adapter directory a registry name (or path) refers to"""
+        return self._resolve(name_or_path)["resolved_path"]
+
+    def _registry_configs(self) -> List[Dict]:
+        from train import _resolve_registry_path
+
+        path = _resolve_registry_path(self.registry_path)
+        if not path.exists():
+            return []
+        with path.open("r", encoding="utf-8") as f:
+            entries = json.load(f).get("adapters", [])
+        configs = []
+        for entry in entries:
+            try:
+                configs.append(read_adapter_config(self._resolve(entry.get("name") or entry["path"])["resolved_path"]))
+            except (OSError, ValueError, KeyError):
+                continue
+        return configs
+
+    def _ensure_bank(self, first_adapter_dir: str) -> None:
+        if has_multi_lora(self.model):
+            return
+        configs = self._registry_configs() or [read_adapter_config(first_adapter_dir)]
+        rank = self.max_rank or max(int(config.get("r", 8)) for config in configs)
+        targets = self.target_modules
+        if targets is None:
+            names = set()
+            for config in configs:
+                modules = config.get("target_modules")
+                names.update(FALLBACK_TARGET_MODULES if isinstance(modules, str) or not modules else modules)
+            targets = sorted(names)
+        dtype = next(self.model.parameters()).dtype
+        if not dtype.is_floating_point:
+            dtype = torch.float16
+        inject_multi_lora(
+            self.model,
+            adapter_names=[f"slot{idx}" for idx in range(self.max_loaded)],
+            r=rank,
+            lora_alpha=rank,
+            target_modules=targets,
+            dtype=dtype,
+        )
+        set_adapter_indices(self.model, None)
+        logger.info(f"Injected multi-LoRA bank: {self.max_loaded} slots, rank {rank}, targets {targets}")
+
+    def acquire(self, name_or_path: str) -> int:
+        """Load an adapter if needed, pin its slot and return the slot index"""
+        entry = self._resolve(name_or_path)
+        name = entry.get("name") or entry["resolved_path"]
+        with self._lock:
+            if name in self._slots:
+                self._slots.move_to_end(name)
+                slot = self._slots[name]
+                self._in_use[slot] = self._in_use.get(slot, 0) + 1
+                return slot
+
+        # Injecting the bank or rewriting a slot must not overlap a forward pass
+        with self.switch_lock, self._lock:
+            if name in self._slots:
+                slot = self._slots[name]
+                self._in_use[slot] = self._in_use.get(slot, 0) + 1
+                return slot
+
+            self._ensure_bank(entry["resolved_path"])
+            used = set(self._slots.values())
+            free = [idx for idx in range(self.max_loaded) if idx not in used]
+            if free:
+                slot = free[0]
+            else:
+                victim = next((n for n, s in self._slots.items() if not self._in_use.get(s)), None)
+                if victim is None:
+                    raise RuntimeError("All adapter slots are in use; raise max_loaded_adapters")
+                slot = self._slots.pop(victim)
+                self._paths.pop(victim, None)
+                logger.info(f"Evicting adapter {victim} from slot {slot}")
+
+            load_multi_lora_adapter(self.model, slot, entry["resolved_path"])
+            self.loads += 1
+            self._slots[name] = slot
+            self._paths[name] = entry["resolved_path"]
+            self._in_use[slot] = self._in_use.get(slot, 0) + 1
+            return slot
+
+    def release(self, slot: int) -> None:
+        with self._lock:
+            self._in_use[slot] = max(0, self._in_use.get(slot, 0) - 1)
+
+    @contextmanager
+    def activate(self, name_or_path: str) -> Iterator[int]:
+        """Route the whole model through one adapter for the duration of the block"""
+        with self.switch_lock:
+            slot = self.acquire(name_or_path)
+            set_adapter_indices(self.model, slot)
+            self.active = name_or_path
+            try:
+                yield slot
+            finally:
+                set_adapter_indices(self.model, None)
+                self.active = None
+                self.release(slot)
+
+    @contextmanager
+    def use_base(self) -> Iterator[None]:
+        """Run the block on the plain base model, never overlapping an adapter switch or engine step"""
+        with self.switch_lock:
+            set_adapter_indices(self.model, None)
+            yield
+
+    def evict(self, name_or_path: str) -> bool:
+        name = self._resolve(name_or_path).get("name") or name_or_path
+        with self._lock:
+            slot = self._slots.get(name)
+            if slot is None or self._in_use.get(slot):
+                return False
+            del self._slots[name]
+            self._paths.pop(name, None)
+            return True
+
+    def loaded(self) -> List[Dict]:
+        with self._lock:
+            return [
+                {"name": name, "slot": slot, "path": self._paths.get(name), "in_use": self._in_use.get(slot, 0)}
+                for name, slot in reversed(self._slots.items())
+            ]
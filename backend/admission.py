@@ -0,0 +1,217 @@
+"""
+Admission control for generation requests.
+
+Each loaded model gets an :class:`AdmissionController` that caps how many
+requests run at once and parks the rest in a bounded queue ordered by priority
+class, then arrival. A request is rejected instead of queued when the queue is
+full (429, unless it can displace a lower-priority waiter) or when it waits
+longer than the queue-time limit or its own deadline allows (503). Rejections
+carry a ``Retry-After`` estimate derived from recent service times.
+
+Controllers are driven from the event loop thread; generations finishing on
+worker threads hand their slot back through :meth:`AdmissionSlot.release_when_done`.
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+from dataclasses import dataclass, field
+from concurrent.futures import Future
+from typing import Any, Dict, Hashable, List, Optional
+
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+
+
+class AdmissionRejected(Exception):
+    """A request that was not admitted, with the HTTP status and retry hint to send back"""
+
+    def __init__(self, message: str, status_code: int, retry_after: int):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+@dataclass(order=True)
+class _Waiter:
+    priority: int
+    seq: int
+    future: "asyncio.Future[None]" = field(compare=False)
+    enqueued_at: float = field(compare=False, default_factory=time.monotonic)
+    admitted_at: float = field(compare=False, default=0.0)
+
+
+class AdmissionSlot:
+    """A held slot; release it once, either directly or when a generation finishes"""
+
+    def __init__(self, controller: "AdmissionController", admitted_at: float):
+        self.controller = controller
+        self.admitted_at = admitted_at
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self.controller.release(self.admitted_at)
+
+    def release_when_done(self, future: Future) -> None:
+        """Keep the slot until ``future`` resolves, which may be after the requesting client left"""
+        if self._released:
+            return
+        self._released = True
+        future.add_done_callback(lambda _: self.controller.release_threadsafe(self.admitted_at))
+
+
+class AdmissionController:
+    """Concurrency limit with a bounded, prioritised wait queue"""
+
+    def __init__(self, max_active: int = 8, max_queue: int = 64, max_queue_seconds: float = 30.0):
+        """
+        Args:
+            max_active: Requests allowed to run at once
+            max_queue: Requests allowed to wait for a slot (0 rejects as soon as all slots are busy)
+            max_queue_seconds: Longest time a request may wait for a slot (0 waits indefinitely)
+        """
+        self.max_active = max(1, max_active)
+        self.max_queue = max(0, max_queue)
+        self.max_queue_seconds = max_queue_seconds
+        self.active = 0
+        self._waiting: List[_Waiter] = []
+        self._seq = itertools.count()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # Exponential moving average of how long an admitted request holds its slot
+        self._service_seconds: Optional[float] = None
+
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_queue_timeout = 0
+        self.shed = 0
+        self.total_queue_seconds = 0.0
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for waiter in self._waiting if not waiter.future.done())
+
+    def retry_after(self) -> int:
+        """Seconds until a slot is likely to free up for a newly arriving request"""
+        service = self._service_seconds or 1.0
+        return max(1, math.ceil(service * (self.queued + 1) / self.max_active))
+
+    async def acquire(self, priority: str = "normal", timeout: Optional[float] = None) -> AdmissionSlot:
+        """
+        Wait for a slot in ``priority`` order, or raise :class:`AdmissionRejected`.
+
+        ``timeout`` (e.g. what is left of the request's deadline) further
+        bounds the queue wait.
+        """
+        self._loop = asyncio.get_running_loop()
+        level = PRIORITIES[priority]
+        if self.active < self.max_active and not self.queued:
+            return AdmissionSlot(self, self._admit(None))
+
+        if self.queued >= self.max_queue:
+            pending = [waiter for waiter in self._waiting if not waiter.future.done()]
+            worst = max(pending) if pending else None
+            if worst is None or worst.priority <= level:
+                self.rejected_queue_full += 1
+                raise AdmissionRejected("Generation queue is full", 429, self.retry_after())
+            # Shed the newest lowest-priority waiter to make room
+            self.shed += 1
+            worst.future.set_exception(
+                AdmissionRejected("Displaced by higher-priority requests", 429, self.retry_after())
+            )
+
+        waiter = _Waiter(level, next(self._seq), self._loop.create_future())
+        heapq.heappush(self._waiting, waiter)
+        limits = [limit for limit in (timeout, self.max_queue_seconds or None) if limit is not None]
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), min(limits) if limits else None)
+        except asyncio.TimeoutError:
+            if waiter.future.done() and not waiter.future.exception():
+                # Granted just as the wait expired; keep the slot
+                return AdmissionSlot(self, waiter.admitted_at)
+            waiter.future.cancel()
+            self.rejected_queue_timeout += 1
+            raise AdmissionRejected("Timed out waiting for a generation slot", 503, self.retry_after())
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled() and not waiter.future.exception():
+                self.release(waiter.admitted_at)
+            else:
+                waiter.future.cancel()
+            raise
+        return AdmissionSlot(self, waiter.admitted_at)
+
+    def _admit(self, waiter: Optional[_Waiter]) -> float:
+        self.active += 1
+        self.admitted += 1
+        now = time.monotonic()
+        if waiter is not None:
+            waiter.admitted_at = now
+            self.total_queue_seconds += now - waiter.enqueued_at
+            waiter.future.set_result(None)
+        return now
+
+    def release(self, admitted_at: float) -> None:
+        """Hand a slot back and admit the next waiters in priority order"""
+        held = time.monotonic() - admitted_at
+        self._service_seconds = held if self._service_seconds is None else 0.8 * self._service_seconds + 0.2 * held
+        self.active = max(0, self.active - 1)
+        while self._waiting and self.active < self.max_active:
+            waiter = heapq.heappop(self._waiting)
+            if not waiter.future.done():
+                self._admit(waiter)
+
+    def release_threadsafe(self, admitted_at: float) -> None:
+        """:meth:`release` from a worker thread"""
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self.release, admitted_at)
+
+    def stats(self) -> Dict[str, Any]:
+        by_priority = {name: 0 for name in PRIORITIES}
+        names = {level: name for name, level in PRIORITIES.items()}
+        for waiter in self._waiting:
+            if not waiter.future.done():
+                by_priority[names[waiter.priority]] += 1
+        return {
+            "active": self.active,
+            "max_active": self.max_active,
+            "queued": sum(by_priority.values()),
+            "queued_by_priority": by_priority,
+            "max_queue": self.max_queue,
+            "max_queue_seconds": self.max_queue_seconds,
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_queue_timeout": self.rejected_queue_timeout,
+            "shed": self.shed,
+            "mean_queue_seconds": self.total_queue_seconds / self.admitted if self.admitted else 0.0,
+            "mean_service_seconds": self._service_seconds or 0.0,
+            "retry_after": self.retry_after(),
+        }
+
+
+class AdmissionRegistry:
+    """One controller per model key, created on first use"""
+
+    def __init__(self, max_active: int = 8, max_queue: int = 64, max_queue_seconds: float = 30.0):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.max_queue_seconds = max_queue_seconds
+        self._controllers: Dict[Hashable, AdmissionController] = {}
+
+    def controller(self, key: Hashable) -> AdmissionController:
+        if key not in self._controllers:
+            self._controllers[key] = AdmissionController(self.max_active, self.max_queue, self.max_queue_seconds)
+        return self._controllers[key]
+
+    def items(self):
+        return list(self._controllers.items())
+
+
+def admission_limits_from_env(default_max_active: int = 8) -> Dict[str, Any]:
+    """Controller limits from ``ADMISSION_MAX_ACTIVE``, ``ADMISSION_MAX_QUEUE`` and ``ADMISSION_MAX_QUEUE_SECONDS``"""
+    return {
+        "max_active": int(os.getenv("ADMISSION_MAX_ACTIVE", str(default_max_active))),
+        "max_queue": int(os.getenv("ADMISSION_MAX_QUEUE", "64")),
+        "max_queue_seconds": float(os.getenv("ADMISSION_MAX_QUEUE_SECONDS", "30")),
+    }
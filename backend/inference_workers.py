@@ -0,0 +1,529 @@
+"""
+Out-of-process generation workers.
+
+Generation runs in dedicated worker processes so that decode loops, tokenizer
+work and model loading never compete with the API's event loop for the GIL,
+nor with job threads that redirect stdout for the whole process. Each worker
+keeps its own model pool, batching engines and response caches, and runs many
+requests at once through them.
+
+The API talks to a worker over two local queues:
+
+- ``jobs`` (API -> worker): ``("generate", job_id, row, model_key, settings, request, route)``,
+  ``("cancel", job_id)`` and ``None`` to shut down.
+- ``events`` (worker -> API): ``("tokens", job_id, count, overflow)``,
+  ``("done", job_id, result, cached, prompt_tokens)`` and ``("error", job_id, kind, message)``.
+
+Decoded token ids are not pickled per token. Every job owns one row of a
+shared-memory ``int32`` buffer; the worker writes tokens into the row and
+periodically sends only the new count, which the API reads straight out of
+shared memory. Tokens beyond the row's capacity travel in ``overflow``.
+
+A reader thread per worker replays events onto the API-side
+:class:`SharedGeneration`, forwards cancellations and restarts the worker if it
+dies, failing its in-flight jobs.
+"""
+import itertools
+import multiprocessing as mp
+import queue
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from multiprocessing.shared_memory import SharedMemory
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from backend.model_pool import ModelKey, ModelPool, ModelPoolBusy, draft_pool_limits_from_env, pool_limits_from_env
+from backend.request_coalescing import SharedGeneration
+from cancellation import GenerationCancelled
+
+TOKEN_FLUSH_SECONDS = 0.01
+EVENT_POLL_SECONDS = 0.05
+RESTART_DELAY_SECONDS = 1.0
+TOKEN_BYTES = 4
+
+# Exceptions rebuilt on the API side, so status mapping works as in-process
+_ERROR_TYPES = {
+    "ValueError": ValueError,
+    "TimeoutError": TimeoutError,
+    "GenerationCancelled": GenerationCancelled,
+    "ModelPoolBusy": ModelPoolBusy,
+}
+
+
+class WorkerPoolSaturated(RuntimeError):
+    """Every worker's token buffer rows are taken"""
+
+
+def run_generation(
+    shared: SharedGeneration,
+    inference: Any,
+    request: Any,
+    route: str,
+    max_batch_size: int = 8,
+    draft_model: Any = None,
+) -> None:
+    """
+    Run one request on ``inference`` and resolve ``shared`` with its result.
+
+    ``draft_model`` is the pooled draft paired with ``inference`` on the
+    ``draft_model`` route.
+
+    The ``engine`` route returns as soon as the request is submitted to the
+    batching engine; the others block until their decode finishes.
+    """
+    try:
+        if route == "engine":
+            # Submitting may load the adapter into a slot, which touches disk
+            submitted = inference.get_engine(max_batch_size=max_batch_size).submit(
+                request.prompt,
+                max_new_tokens=request.max_new_tokens or inference.max_length,
+                temperature=request.temperature,
+                top_p=request.top_p,
+                top_k=request.top_k,
+                adapter=request.adapter,
+                stop=request.stop,
+                cancel=shared.cancel,
+                on_token=shared.push,
+            )
+            shared.prompt_tokens = len(submitted.prompt_ids)
+            shared.link(submitted.future)
+            return
+        if route == "beam_search":
+            # Beam search keeps its own batch of hypotheses; run it outside the engine
+            result = inference.generate_response(
+                request.prompt,
+                max_new_tokens=request.max_new_tokens,
+                adapter=request.adapter,
+                stop=request.stop,
+                cancel=shared.cancel,
+                use_response_cache=False,
+                temperature=request.temperature,
+                top_p=request.top_p,
+                top_k=request.top_k,
+                num_beams=request.num_beams,
+            )
+        elif route == "draft_model":
+            result = inference.generate_speculative(
+                request.prompt,
+                max_new_tokens=request.max_new_tokens,
+                num_draft_tokens=request.num_draft_tokens,
+                cancel=shared.cancel,
+                draft_model=draft_model,
+                adapter=request.adapter,
+                stop=request.stop,
+                temperature=request.temperature,
+                top_p=request.top_p,
+                top_k=request.top_k,
+            )
+        else:
+            result = inference.generate_prompt_lookup(
+                request.prompt,
+                max_new_tokens=request.max_new_tokens,
+                cancel=shared.cancel,
+                adapter=request.adapter,
+                stop=request.stop,
+                temperature=request.temperature,
+                top_p=request.top_p,
+                top_k=request.top_k,
+            )
+    except Exception as exc:
+        shared.resolve(error=exc)
+        return
+    shared.resolve(result=result)
+
+
+# ---------------------------------------------------------------------------
+# Worker process
+# ---------------------------------------------------------------------------
+
+
+class _WorkerJob:
+    """Worker-side state of one request: its generation and shared-memory row"""
+
+    def __init__(self, job_id: int, row: int):
+        self.job_id = job_id
+        self.row = row
+        self.shared = SharedGeneration(None)
+        self.written = 0
+        self.notified = 0
+        self.overflow: List[int] = []
+        self.lock = threading.Lock()
+
+
+def _worker_main(
+    index: int,
+    jobs: "mp.Queue",
+    events: "mp.Queue",
+    shm_name: str,
+    row_tokens: int,
+    max_batch_size: int,
+) -> None:
+    # The parent owns shutdown; Ctrl+C in a terminal must not kill workers mid-decode
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from run_inference import ModelInference, load_draft_model
+
+    shm = SharedMemory(name=shm_name)
+    tokens = shm.buf.cast("i")
+    active: Dict[int, _WorkerJob] = {}
+    active_lock = threading.Lock()
+    stopping = threading.Event()
+
+    def _release(entry) -> None:
+        entry.model.close()
+        entry.model = None
+
+    pool = ModelPool(loader=ModelInference, on_evict=_release, **pool_limits_from_env())
+    drafts = ModelPool(loader=load_draft_model, **draft_pool_limits_from_env())
+    # Loading and non-engine decodes block, so they run off the job-reading loop
+    executor = ThreadPoolExecutor(max_workers=max_batch_size * 4, thread_name_prefix=f"worker{index}")
+
+    def _flush(job: _WorkerJob) -> None:
+        # Caller holds job.lock
+        if job.written > job.notified:
+            overflow = job.overflow[max(0, job.notified - row_tokens):]
+            events.put(("tokens", job.job_id, job.written, overflow))
+            job.notified = job.written
+
+    def _on_token(job: _WorkerJob, token: Optional[int]) -> None:
+        if token is None:
+            return
+        with job.lock:
+            if job.written < row_tokens:
+                tokens[job.row * row_tokens + job.written] = token
+            else:
+                job.overflow.append(token)
+            job.written += 1
+
+    def _flusher() -> None:
+        while not stopping.wait(TOKEN_FLUSH_SECONDS):
+            with active_lock:
+                pending = list(active.values())
+            for job in pending:
+                with job.lock:
+                    _flush(job)
+
+    def _finish(job: _WorkerJob, lease: Any, key: Optional[str]) -> None:
+        inference = lease.model
+        error = job.shared.future.exception()
+        if error is None and key is not None and inference.response_cache is not None:
+            result = job.shared.future.result()
+            inference.response_cache.put(key, result[0] if isinstance(result, tuple) else result)
+        with job.lock:
+            _flush(job)
+            if error is None:
+                events.put(("done", job.job_id, job.shared.future.result(), False, job.shared.prompt_tokens))
+            else:
+                events.put(("error", job.job_id, type(error).__name__, str(error)))
+        with active_lock:
+            active.pop(job.job_id, None)
+        lease.release()
+
+    def _start(job: _WorkerJob, model_key: Dict[str, Any], settings: Dict[str, Any], params: Dict[str, Any], route: str) -> None:
+        request = SimpleNamespace(**params)
+        lease = None
+        try:
+            if job.shared.cancel.fired:
+                raise job.shared.cancel.error()
+            # Leased until the job finishes, so loading another model cannot evict this one mid-decode
+            lease = pool.acquire(ModelKey(**model_key), **settings)
+            inference = lease.model
+            draft_model = None
+            if route == "draft_model":
+                draft_key = ModelKey(request.draft_model_path, model_key["device"], model_key["torch_dtype"])
+                draft_model = drafts.get(
+                    draft_key,
+                    trust_remote_code=settings["trust_remote_code"],
+                    mmap_weights=settings["mmap_weights"],
+                )
+            key = inference.generation_key(
+                request.prompt,
+                max_new_tokens=request.max_new_tokens,
+                adapter=request.adapter,
+                stop=request.stop,
+                temperature=request.temperature,
+                top_p=request.top_p,
+                top_k=request.top_k,
+                num_beams=request.num_beams,
+            )
+            cached = None
+            if inference.response_cache is not None:
+                if key is None:
+                    inference.response_cache.record_bypass()
+                else:
+                    cached = inference.response_cache.get(key)
+        except Exception as exc:
+            if lease is not None:
+                lease.release()
+            events.put(("error", job.job_id, type(exc).__name__, str(exc)))
+            with active_lock:
+                active.pop(job.job_id, None)
+            return
+        if cached is not None:
+            lease.release()
+            events.put(("done", job.job_id, cached, True, None))
+            with active_lock:
+                active.pop(job.job_id, None)
+            return
+
+        job.shared.listen(lambda token: _on_token(job, token))
+        # Cache writes touch disk, so never finish on the engine's decode thread
+        job.shared.future.add_done_callback(lambda _: executor.submit(_finish, job, lease, key))
+        run_generation(job.shared, inference, request, route, max_batch_size, draft_model=draft_model)
+
+    threading.Thread(target=_flusher, daemon=True).start()
+    try:
+        while True:
+            message = jobs.get()
+            if message is None:
+                break
+            if message[0] == "cancel":
+                with active_lock:
+                    job = active.get(message[1])
+                if job is not None:
+                    job.shared.cancel.cancel()
+                continue
+            _, job_id, row, model_key, settings, params, route = message
+            job = _WorkerJob(job_id, row)
+            with active_lock:
+                active[job_id] = job
+            executor.submit(_start, job, model_key, settings, params, route)
+    finally:
+        stopping.set()
+        with active_lock:
+            for job in active.values():
+                job.shared.cancel.cancel()
+        executor.shutdown(wait=True)
+        pool.clear()
+        drafts.clear()
+        events.close()
+        events.join_thread()
+        tokens.release()
+        shm.close()
+
+
+# ---------------------------------------------------------------------------
+# API side
+# ---------------------------------------------------------------------------
+
+
+@dataclass
+class _RemoteJob:
+    shared: SharedGeneration
+    row: int
+    received: int = 0
+    cancel_sent: bool = False
+
+
+@dataclass
+class _Worker:
+    index: int
+    shm: SharedMemory
+    tokens: Any
+    free_rows: List[int]
+    process: Optional[mp.Process] = None
+    jobs: Optional["mp.Queue"] = None
+    events: Optional["mp.Queue"] = None
+    inflight: Dict[int, _RemoteJob] = field(default_factory=dict)
+    models: Set[ModelKey] = field(default_factory=set)
+    started_at: float = 0.0
+    restarts: int = 0
+    completed: int = 0
+    failed: int = 0
+
+
+class InferenceWorkerPool:
+    """Pool of generation worker processes, started on first use"""
+
+    def __init__(self, num_workers: int = 1, rows_per_worker: int = 64, row_tokens: int = 4096, max_batch_size: int = 8):
+        """
+        Args:
+            num_workers: Worker processes
+            rows_per_worker: Concurrent jobs per worker (one shared-memory token row each)
+            row_tokens: Tokens per row before the rest are sent inline
+            max_batch_size: Rows of each worker's batching engine
+        """
+        self.num_workers = max(1, num_workers)
+        self.rows_per_worker = max(1, rows_per_worker)
+        self.row_tokens = max(1, row_tokens)
+        self.max_batch_size = max_batch_size
+        self._context = mp.get_context("spawn")
+        self._workers: List[_Worker] = []
+        self._lock = threading.Lock()
+        self._job_ids = itertools.count(1)
+        self._closing = threading.Event()
+
+    def _ensure_started(self) -> None:
+        # Caller holds self._lock
+        if self._workers:
+            return
+        for index in range(self.num_workers):
+            shm = SharedMemory(create=True, size=self.rows_per_worker * self.row_tokens * TOKEN_BYTES)
+            worker = _Worker(index, shm, shm.buf.cast("i"), list(range(self.rows_per_worker)))
+            self._spawn(worker)
+            self._workers.append(worker)
+            threading.Thread(target=self._read_events, args=(worker,), daemon=True, name=f"worker{index}-events").start()
+
+    def _spawn(self, worker: _Worker) -> None:
+        # Fresh queues: a worker that died mid-write may have left a torn message behind
+        worker.jobs = self._context.Queue()
+        worker.events = self._context.Queue()
+        worker.process = self._context.Process(
+            target=_worker_main,
+            args=(worker.index, worker.jobs, worker.events, worker.shm.name, self.row_tokens, self.max_batch_size),
+            daemon=True,
+            name=f"inference-worker-{worker.index}",
+        )
+        worker.process.start()
+        worker.started_at = time.time()
+        worker.models.clear()
+
+    def _pick_worker(self, key: ModelKey) -> Optional[_Worker]:
+        """A worker that already holds ``key`` and has a free row, else the least loaded one"""
+        available = [worker for worker in self._workers if worker.free_rows]
+        if not available:
+            return None
+        holders = [worker for worker in available if key in worker.models]
+        return min(holders or available, key=lambda worker: len(worker.inflight))
+
+    def submit(
+        self,
+        shared: SharedGeneration,
+        key: ModelKey,
+        settings: Dict[str, Any],
+        request: Dict[str, Any],
+        route: str,
+    ) -> None:
+        """Run ``request`` in a worker; ``shared`` receives its tokens and result"""
+        with self._lock:
+            if self._closing.is_set():
+                shared.resolve(error=RuntimeError("Inference workers are shutting down"))
+                return
+            self._ensure_started()
+            worker = self._pick_worker(key)
+            if worker is None:
+                shared.resolve(error=WorkerPoolSaturated("All inference workers are busy"))
+                return
+            job_id = next(self._job_ids)
+            row = worker.free_rows.pop()
+            worker.inflight[job_id] = _RemoteJob(shared, row)
+            worker.models.add(key)
+            worker.jobs.put(("generate", job_id, row, key._asdict(), settings, request, route))
+
+    def _read_events(self, worker: _Worker) -> None:
+        while not self._closing.is_set():
+            try:
+                event = worker.events.get(timeout=EVENT_POLL_SECONDS)
+            except queue.Empty:
+                event = None
+            except (EOFError, OSError):
+                event = None
+            if event is not None:
+                self._handle(worker, event)
+            self._forward_cancellations(worker)
+            if not worker.process.is_alive() and not self._closing.is_set():
+                self._restart(worker)
+
+    def _handle(self, worker: _Worker, event: Tuple) -> None:
+        kind, job_id = event[0], event[1]
+        with self._lock:
+            job = worker.inflight.get(job_id)
+        if job is None:
+            return
+        if kind == "tokens":
+            count, overflow = event[2], event[3]
+            base = job.row * self.row_tokens
+            for position in range(job.received, min(count, self.row_tokens)):
+                job.shared.push(worker.tokens[base + position])
+            for token in overflow:
+                job.shared.push(token)
+            job.received = count
+            return
+
+        with self._lock:
+            worker.inflight.pop(job_id, None)
+            worker.free_rows.append(job.row)
+        if kind == "done":
+            _, _, result, cached, prompt_tokens = event
+            worker.completed += 1
+            job.shared.cached = cached
+            if prompt_tokens is not None:
+                job.shared.prompt_tokens = prompt_tokens
+            job.shared.resolve(result=result)
+        else:
+            _, _, error_type, message = event
+            worker.failed += 1
+            job.shared.resolve(error=_ERROR_TYPES.get(error_type, RuntimeError)(message))
+
+    def _forward_cancellations(self, worker: _Worker) -> None:
+        with self._lock:
+            pending = [
+                (job_id, job) for job_id, job in worker.inflight.items()
+                if not job.cancel_sent and job.shared.cancel.fired
+            ]
+            for job_id, job in pending:
+                job.cancel_sent = True
+                worker.jobs.put(("cancel", job_id))
+
+    def _restart(self, worker: _Worker) -> None:
+        exitcode = worker.process.exitcode
+        with self._lock:
+            failed = list(worker.inflight.values())
+            worker.inflight.clear()
+            # No free rows keeps new jobs away until the replacement is up
+            worker.free_rows = []
+        for job in failed:
+            job.shared.resolve(error=RuntimeError(f"Inference worker {worker.index} exited with code {exitcode}"))
+        worker.failed += len(failed)
+        # Back off so a worker that dies on start does not spin
+        time.sleep(max(0.0, RESTART_DELAY_SECONDS - (time.time() - worker.started_at)))
+        with self._lock:
+            if self._closing.is_set():
+                return
+            worker.restarts += 1
+            worker.free_rows = list(range(self.rows_per_worker))
+            self._spawn(worker)
+
+    def close(self, timeout: float = 10.0) -> None:
+        """Stop every worker, cancelling what they are running, and free the shared memory"""
+        self._closing.set()
+        with self._lock:
+            workers = list(self._workers)
+            self._workers = []
+        for worker in workers:
+            worker.jobs.put(None)
+        for worker in workers:
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.kill()
+                worker.process.join()
+            for job in worker.inflight.values():
+                job.shared.resolve(error=RuntimeError("Inference workers were shut down"))
+            worker.inflight.clear()
+            worker.tokens.release()
+            worker.shm.close()
+            worker.shm.unlink()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "workers": [
+                    {
+                        "index": worker.index,
+                        "pid": worker.process.pid if worker.process is not None else None,
+                        "alive": worker.process is not None and worker.process.is_alive(),
+                        "in_flight": len(worker.inflight),
+                        "free_rows": len(worker.free_rows),
+                        "models": [key._asdict() for key in worker.models],
+                        "completed": worker.completed,
+                        "failed": worker.failed,
+                        "restarts": worker.restarts,
+                        "uptime_seconds": time.time() - worker.started_at if worker.started_at else 0.0,
+                    }
+                    for worker in self._workers
+                ],
+                "rows_per_worker": self.rows_per_worker,
+                "row_tokens": self.row_tokens,
+            }
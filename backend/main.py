@@ -1,4 +1,5 @@
 import asyncio
+import hashlib
 import io
 import json
 import os
@@ -8,15 +9,18 @@ import threading
 import time
 import uuid
 from contextlib import redirect_stderr, redirect_stdout
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Sequence
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Literal, NamedTuple, Optional, Sequence, Tuple
 
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Query
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Query, Request, WebSocket, WebSocketDisconnect
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 from huggingface_hub import HfApi
 from huggingface_hub.utils import HfHubHTTPError
+from sse_starlette.sse import EventSourceResponse
+from transformers import AutoTokenizer
 
 # Ensure project root on path
 import sys
@@ -25,13 +29,33 @@ if str(PROJECT_ROOT) not in sys.path:
     sys.path.insert(0, str(PROJECT_ROOT))
 
 from train import train as run_training  # noqa: E402  # type: ignore
-from run_inference import ModelInference  # noqa: E402  # type: ignore
+from run_inference import ModelInference, load_draft_model  # noqa: E402  # type: ignore
 from eval import ModelEvaluator, EVAL_MODEL  # noqa: E402  # type: ignore
 from merge_multiple_loras import merge_multiple_loras  # noqa: E402  # type: ignore
 from backend.dataset_utils import DatasetManager, DatasetValidator  # noqa: E402  # type: ignore
 from backend.monitoring import get_current_metrics, get_metrics_collector  # noqa: E402  # type: ignore
 from backend.model_utils import ModelComparator, CheckpointManager, ModelExporter  # noqa: E402  # type: ignore
 from backend.evaluation_utils import EvaluationManager  # noqa: E402  # type: ignore
+from backend.model_pool import (  # noqa: E402  # type: ignore
+    ModelKey,
+    ModelLease,
+    ModelPool,
+    ModelPoolBusy,
+    draft_pool_limits_from_env,
+    pool_limits_from_env,
+)
+from backend.request_coalescing import RequestCoalescer, SharedGeneration  # noqa: E402  # type: ignore
+from backend.inference_workers import InferenceWorkerPool, WorkerPoolSaturated, run_generation  # noqa: E402  # type: ignore
+from backend.admission import (  # noqa: E402  # type: ignore
+    AdmissionRegistry,
+    AdmissionRejected,
+    AdmissionSlot,
+    admission_limits_from_env,
+)
+from memory_guard import free_memory  # noqa: E402  # type: ignore
+from chat_session import ChatSessionManager, ChatTemplate  # noqa: E402  # type: ignore
+from cancellation import CancellationToken, GenerationCancelled  # noqa: E402  # type: ignore
+from stop_sequences import compile_stop_sequences, normalize_stop  # noqa: E402  # type: ignore
 
 app = FastAPI(title="QLoRA Pipeline API")
 
@@ -389,6 +413,14 @@ TRAIN_PARAM_SPECS: List[Dict[str, Any]] = [
         "category": "General",
         "help": "Optional dataset identifier",
     },
+    {
+        "name": "dataset_sources",
+        "label": "Dataset Mixture",
+        "type": "json",
+        "default": None,
+        "category": "General",
+        "help": 'Stream several datasets instead of Dataset Path, e.g. [{"path": "data/a.json", "weight": 3}, {"path": "data/b.jsonl", "weight": 1}]',
+    },
     {
         "name": "output_dir",
         "label": "Output Directory",
@@ -442,6 +474,23 @@ TRAIN_PARAM_SPECS: List[Dict[str, Any]] = [
         "default": None,
         "category": "Dataset",
     },
+    {
+        "name": "mixture_samples_per_epoch",
+        "label": "Mixture Samples Per Epoch",
+        "type": "number",
+        "subtype": "int",
+        "default": None,
+        "category": "Dataset",
+        "help": "Examples drawn from the dataset mixture per epoch (defaults to the combined source size)",
+    },
+    {
+        "name": "mixture_shuffle_buffer",
+        "label": "Mixture Shuffle Buffer",
+        "type": "number",
+        "subtype": "int",
+        "default": 1000,
+        "category": "Dataset",
+    },
     {
         "name": "num_train_epochs",
         "label": "Epochs",
@@ -648,6 +697,31 @@ TRAIN_PARAM_SPECS: List[Dict[str, Any]] = [
         "default": 3,
         "category": "Misc",
     },
+    {
+        "name": "oom_backoff",
+        "label": "OOM Backoff",
+        "type": "boolean",
+        "default": True,
+        "category": "Misc",
+        "help": "On out-of-memory, halve the micro-batch and double accumulation instead of failing",
+    },
+    {
+        "name": "memory_guard_threshold",
+        "label": "Memory Guard Threshold",
+        "type": "number",
+        "subtype": "float",
+        "default": 0.92,
+        "category": "Misc",
+        "help": "Save a protective checkpoint when RSS or GPU memory exceeds this fraction of the limit (0 disables)",
+    },
+    {
+        "name": "memory_guard_cooldown_steps",
+        "label": "Memory Guard Cooldown",
+        "type": "number",
+        "subtype": "int",
+        "default": 50,
+        "category": "Misc",
+    },
     {
         "name": "bits",
         "label": "Quantization Bits",
@@ -713,6 +787,63 @@ TRAIN_PARAM_SPECS: List[Dict[str, Any]] = [
         "default": None,
         "category": "Prompt",
     },
+    {
+        "name": "task_datasets",
+        "label": "Task Datasets",
+        "type": "json",
+        "default": None,
+        "category": "Multi-Task",
+        "help": "JSON object mapping task names to dataset paths; trains one adapter per task in a shared pass",
+    },
+    {
+        "name": "prune_strategy",
+        "label": "Prune Strategy",
+        "type": "string",
+        "default": None,
+        "category": "Data Pruning",
+        "help": "drop_easy, downweight or stratified (leave empty to disable)",
+    },
+    {
+        "name": "prune_fraction",
+        "label": "Prune Fraction",
+        "type": "number",
+        "subtype": "float",
+        "default": 0.2,
+        "category": "Data Pruning",
+        "help": "Share of lowest-loss examples to drop/downweight, or removed overall when stratified",
+    },
+    {
+        "name": "prune_easy_weight",
+        "label": "Easy Example Weight",
+        "type": "number",
+        "subtype": "float",
+        "default": 0.1,
+        "category": "Data Pruning",
+    },
+    {
+        "name": "prune_num_strata",
+        "label": "Loss Strata",
+        "type": "number",
+        "subtype": "int",
+        "default": 10,
+        "category": "Data Pruning",
+    },
+    {
+        "name": "prune_batch_size",
+        "label": "Scoring Batch Size",
+        "type": "number",
+        "subtype": "int",
+        "default": 8,
+        "category": "Data Pruning",
+    },
+    {
+        "name": "prune_scoring_adapter",
+        "label": "Scoring Adapter Path",
+        "type": "string",
+        "default": None,
+        "category": "Data Pruning",
+        "help": "Optional prior adapter used to score examples instead of the base model",
+    },
     {
         "name": "run_name",
         "label": "Run Name",
@@ -763,6 +894,31 @@ TRAIN_PARAM_SPECS: List[Dict[str, Any]] = [
         "default": None,
         "category": "Tracking",
     },
+    {
+        "name": "warm_start_adapter",
+        "label": "Warm-Start Adapter",
+        "type": "string",
+        "default": None,
+        "category": "Incremental",
+        "help": "Registered adapter name or path to continue training from",
+    },
+    {
+        "name": "train_on_delta",
+        "label": "Train On New Rows Only",
+        "type": "boolean",
+        "default": True,
+        "category": "Incremental",
+        "help": "Skip rows already listed in the warm-start adapter's training manifest",
+    },
+    {
+        "name": "replay_fraction",
+        "label": "Replay Fraction",
+        "type": "number",
+        "subtype": "float",
+        "default": 0.0,
+        "category": "Incremental",
+        "help": "Previously seen rows mixed in, relative to the number of new rows",
+    },
     {
         "name": "save_safetensors",
         "label": "Save Safetensors",
@@ -812,16 +968,41 @@ class TrainRequest(BaseModel):
     parameters: Dict[str, Any] = Field(default_factory=dict)
 
 
-class GenerateRequest(BaseModel):
+class ModelLoadRequest(BaseModel):
     model_path: str = Field(default="./merged_model")
+    device: str = Field(default="auto")
+    torch_dtype: str = Field(default="float16")
+    adapter_path: Optional[str] = None
+    draft_model_path: Optional[str] = None
+    trust_remote_code: bool = Field(default=True)
+
+
+class ChatSessionRequest(ModelLoadRequest):
+    prompt_template_type: Optional[str] = None
+    system: Optional[str] = None
+
+
+class ChatMessageRequest(BaseModel):
+    message: str
+    max_new_tokens: int = Field(default=256)
+    temperature: float = Field(default=0.7)
+    top_p: float = Field(default=0.9)
+    top_k: int = Field(default=50)
+
+
+class GenerateRequest(ModelLoadRequest):
     prompt: str
     max_new_tokens: Optional[int] = Field(default=256)
     temperature: float = Field(default=0.7)
     top_p: float = Field(default=0.9)
     top_k: int = Field(default=50)
     num_beams: int = Field(default=1)
-    device: str = Field(default="auto")
-    trust_remote_code: bool = Field(default=True)
+    num_draft_tokens: int = Field(default=4, ge=1, le=16)
+    prompt_lookup: bool = Field(default=False)
+    adapter: Optional[str] = None
+    stop: Optional[List[str]] = None
+    timeout_seconds: Optional[float] = Field(default=None, gt=0)
+    priority: Literal["high", "normal", "low"] = Field(default="normal")
 
 
 class EvaluateRequest(BaseModel):
@@ -864,7 +1045,7 @@ def trigger_training(request: TrainRequest) -> Dict[str, Any]:
     param_values = {spec["name"]: spec["default"] for spec in TRAIN_PARAM_SPECS}
     param_values.update(request.parameters)
 
-    path_keys = ["model_name", "dataset_path", "output_dir", "model_cache_dir", "resume_from_checkpoint", "adapter_config_path"]
+    path_keys = ["model_name", "dataset_path", "output_dir", "model_cache_dir", "resume_from_checkpoint", "adapter_config_path", "prune_scoring_adapter"]
     for key in path_keys:
         if param_values.get(key):
             param_values[key] = normalize_path_string(str(param_values[key]))
@@ -881,11 +1062,23 @@ def trigger_training(request: TrainRequest) -> Dict[str, Any]:
             param_values["prompt_template"] = json.loads(param_values["prompt_template"])
         except json.JSONDecodeError as exc:
             raise HTTPException(status_code=400, detail=f"Invalid prompt_template JSON: {exc}")
+    if isinstance(param_values.get("task_datasets"), str) and param_values["task_datasets"]:
+        try:
+            param_values["task_datasets"] = json.loads(param_values["task_datasets"])
+        except json.JSONDecodeError as exc:
+            raise HTTPException(status_code=400, detail=f"Invalid task_datasets JSON: {exc}")
+    if isinstance(param_values.get("task_datasets"), dict):
+        param_values["task_datasets"] = {
+            name: normalize_path_string(str(path)) for name, path in param_values["task_datasets"].items()
+        }
 
     model_name = param_values.get("model_name") or "model"
     summary = f"Fine-tune {model_name}"
     dataset_label = param_values.get("dataset_name") or param_values.get("dataset_path")
-    if dataset_label:
+    if not dataset_label and param_values.get("task_datasets"):
+        dataset_label = f"{len(param_values['task_datasets'])} tasks"
+        summary = f"{summary} on {dataset_label}"
+    elif dataset_label:
         dataset_label = Path(str(dataset_label)).name
         summary = f"{summary} on {dataset_label}"
 
@@ -905,32 +1098,718 @@ def trigger_training(request: TrainRequest) -> Dict[str, Any]:
     return {"job_id": job_id, "status": "queued"}
 
 
-@app.post("/generate")
-async def generate_text(request: GenerateRequest) -> Dict[str, Any]:
-    def _generate() -> str:
-        try:
-            model_path = str(resolve_storage_path(request.model_path))
-        except Exception:
-            model_path = normalize_path_string(request.model_path) or request.model_path
+GENERATION_MAX_BATCH_SIZE = int(os.getenv("GENERATION_MAX_BATCH_SIZE", "8"))
+PREFIX_CACHE_MB = int(os.getenv("PREFIX_CACHE_MB", "512"))
+STREAM_DISCONNECT_POLL_SECONDS = 0.5
+# Default end-to-end deadline for generation requests (0 disables it)
+GENERATION_TIMEOUT_SECONDS = float(os.getenv("GENERATION_TIMEOUT_SECONDS", "0"))
+MAX_LOADED_ADAPTERS = int(os.getenv("MAX_LOADED_ADAPTERS", "8"))
+ADAPTER_REGISTRY_PATH = str(PROJECT_ROOT / "config" / "adapters.json")
+# Deterministic (temperature 0) responses kept per loaded model; RESPONSE_CACHE_DIR adds a disk tier
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR") or None
+# Worker processes running generation outside the API process (0 runs it in-process)
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "0"))
+GENERATION_WORKER_ROWS = int(os.getenv("GENERATION_WORKER_ROWS", "64"))
+GENERATION_WORKER_ROW_TOKENS = int(os.getenv("GENERATION_WORKER_ROW_TOKENS", "4096"))
+# Share CPU weights between uvicorn workers and generation workers through the page cache
+MODEL_MMAP_WEIGHTS = os.getenv("MODEL_MMAP_WEIGHTS", "0").lower() in ("1", "true", "yes")
+# Run a short forward pass after loading so the first request after a cold start is not slow
+MODEL_WARMUP = os.getenv("MODEL_WARMUP", "1").lower() in ("1", "true", "yes")
+
+
+CHAT_SESSIONS = ChatSessionManager(
+    idle_timeout=float(os.getenv("CHAT_SESSION_IDLE_SECONDS", "900")),
+    max_sessions=int(os.getenv("CHAT_MAX_SESSIONS", "32")),
+    max_cached_tokens=int(os.getenv("CHAT_SESSION_MAX_TOKENS", "4096")),
+)
 
-        inference = ModelInference(
-            model_path=model_path,
-            device=request.device,
-            max_length=request.max_new_tokens or 256,
+
+def _release_pooled_model(entry) -> None:
+    CHAT_SESSIONS.close_for_owner(entry.model)
+    entry.model.close()
+    entry.model = None
+    free_memory()
+
+
+MODEL_POOL = ModelPool(loader=ModelInference, on_evict=_release_pooled_model, **pool_limits_from_env())
+# Draft models are cached apart from their targets and paired with them per request
+DRAFT_POOL = ModelPool(loader=load_draft_model, on_evict=lambda entry: free_memory(), **draft_pool_limits_from_env())
+COALESCER = RequestCoalescer()
+WORKER_POOL = (
+    InferenceWorkerPool(
+        GENERATION_WORKERS,
+        rows_per_worker=GENERATION_WORKER_ROWS,
+        row_tokens=GENERATION_WORKER_ROW_TOKENS,
+        max_batch_size=GENERATION_MAX_BATCH_SIZE,
+    )
+    if GENERATION_WORKERS > 0 else None
+)
+# Per-model concurrency limit and bounded priority queue in front of generation
+ADMISSION = AdmissionRegistry(**admission_limits_from_env(GENERATION_MAX_BATCH_SIZE))
+
+
+def _resolve_model_reference(path: Optional[str]) -> Optional[str]:
+    if not path:
+        return None
+    try:
+        return str(resolve_storage_path(path))
+    except Exception:
+        return normalize_path_string(path) or path
+
+
+def _model_key(request: ModelLoadRequest) -> ModelKey:
+    return ModelKey(
+        model_path=_resolve_model_reference(request.model_path),
+        device=request.device,
+        torch_dtype=request.torch_dtype,
+        adapter_path=_resolve_model_reference(request.adapter_path),
+    )
+
+
+def _draft_key(request: ModelLoadRequest) -> Optional[ModelKey]:
+    if not request.draft_model_path:
+        return None
+    return ModelKey(
+        model_path=_resolve_model_reference(request.draft_model_path),
+        device=request.device,
+        torch_dtype=request.torch_dtype,
+    )
+
+
+def _model_settings(request: ModelLoadRequest) -> Dict[str, Any]:
+    """Load arguments besides the ``ModelKey`` fields"""
+    return {
+        "trust_remote_code": request.trust_remote_code,
+        "prefix_cache_mb": PREFIX_CACHE_MB,
+        "adapter_registry": ADAPTER_REGISTRY_PATH,
+        "max_loaded_adapters": MAX_LOADED_ADAPTERS,
+        "response_cache_size": RESPONSE_CACHE_SIZE,
+        "response_cache_dir": RESPONSE_CACHE_DIR,
+        "mmap_weights": MODEL_MMAP_WEIGHTS,
+        "warmup": MODEL_WARMUP,
+    }
+
+
+def _pooled_model(request: ModelLoadRequest) -> ModelInference:
+    return MODEL_POOL.get(_model_key(request), **_model_settings(request))
+
+
+def _leased_model(request: ModelLoadRequest) -> ModelLease:
+    """Pooled model that stays loaded until the lease is released"""
+    return MODEL_POOL.acquire(_model_key(request), **_model_settings(request))
+
+
+def _pool_busy(exc: ModelPoolBusy) -> HTTPException:
+    return HTTPException(status_code=503, detail=str(exc), headers={"Retry-After": "5"})
+
+
+def _pooled_draft_model(request: ModelLoadRequest):
+    key = _draft_key(request)
+    if key is None:
+        return None
+    return DRAFT_POOL.get(key, trust_remote_code=request.trust_remote_code, mmap_weights=MODEL_MMAP_WEIGHTS)
+
+
+@lru_cache(maxsize=8)
+def _worker_tokenizer(model_path: str, trust_remote_code: bool):
+    """Tokenizer for decoding streamed token ids when the model lives in a worker process"""
+    return AutoTokenizer.from_pretrained(model_path, trust_remote_code=trust_remote_code)
+
+
+def _require_in_process_models(feature: str) -> None:
+    """Reject endpoints that act on this process's model pool while models live in worker processes"""
+    if WORKER_POOL is not None:
+        raise HTTPException(
+            status_code=409,
+            detail=f"{feature} is unavailable while generation runs in worker processes (GENERATION_WORKERS > 0)",
+        )
+
+
+@app.on_event("shutdown")
+def _stop_generation_workers() -> None:
+    if WORKER_POOL is not None:
+        WORKER_POOL.close()
+
+
+SPECULATIVE_ROUTES = ("draft_model", "prompt_lookup")
+
+
+def _generation_route(request: GenerateRequest) -> str:
+    if request.draft_model_path:
+        return "draft_model"
+    if request.prompt_lookup:
+        return "prompt_lookup"
+    if request.num_beams > 1:
+        return "beam_search"
+    return "engine"
+
+
+def _lookup_generation(inference: ModelInference, request: GenerateRequest) -> Tuple[Optional[str], Optional[str]]:
+    """``(output key, cached response)``; the key is ``None`` for sampled requests"""
+    try:
+        key = inference.generation_key(
+            request.prompt,
+            max_new_tokens=request.max_new_tokens,
+            adapter=request.adapter,
+            stop=request.stop,
             temperature=request.temperature,
             top_p=request.top_p,
             top_k=request.top_k,
             num_beams=request.num_beams,
-            trust_remote_code=request.trust_remote_code,
         )
-        return inference.generate_response(
-            request.prompt,
-            max_new_tokens=request.max_new_tokens,
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    if inference.response_cache is None:
+        return key, None
+    if key is None:
+        inference.response_cache.record_bypass()
+        return None, None
+    return key, inference.response_cache.get(key)
+
+
+def _request_key(request: GenerateRequest) -> Optional[str]:
+    """
+    Output identity of a deterministic request, computed without its model.
+
+    Used to coalesce requests when the model lives in a worker process (which
+    does its own response caching); ``None`` for sampled requests.
+    """
+    if request.temperature > 0:
+        return None
+    payload = request.dict(exclude={"timeout_seconds", "priority"})
+    payload["model"] = _model_key(request)._asdict()
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+async def _load_generation(
+    request: GenerateRequest,
+) -> Tuple[Optional[ModelInference], Optional[str], Optional[str], Optional[ModelLease]]:
+    """
+    ``(inference, key, cached, lease)``; ``inference`` and ``lease`` are ``None``
+    when generation runs in worker processes.
+
+    The caller releases the lease, or hands it to the generation it leads.
+    """
+    if WORKER_POOL is not None:
+        return None, _request_key(request), None, None
+    loop = asyncio.get_running_loop()
+    try:
+        lease = await loop.run_in_executor(None, _leased_model, request)
+    except ModelPoolBusy as exc:
+        raise _pool_busy(exc) from exc
+    try:
+        key, cached = await loop.run_in_executor(None, _lookup_generation, lease.model, request)
+    except BaseException:
+        lease.release()
+        raise
+    return lease.model, key, cached, lease
+
+
+def _start_generation(
+    shared: SharedGeneration,
+    inference: Optional[ModelInference],
+    request: GenerateRequest,
+    route: str,
+) -> None:
+    """Start a leader's generation in a worker process, or on ``inference`` in this one"""
+    if WORKER_POOL is not None:
+        params = request.dict()
+        draft_key = _draft_key(request)
+        if draft_key is not None:
+            params["draft_model_path"] = draft_key.model_path
+        WORKER_POOL.submit(shared, _model_key(request), _model_settings(request), params, route)
+        return
+    asyncio.get_running_loop().run_in_executor(None, _run_in_process, shared, inference, request, route)
+
+
+def _run_in_process(shared: SharedGeneration, inference: ModelInference, request: GenerateRequest, route: str) -> None:
+    try:
+        draft_model = _pooled_draft_model(request) if route == "draft_model" else None
+    except Exception as exc:
+        shared.resolve(error=exc)
+        return
+    run_generation(shared, inference, request, route, GENERATION_MAX_BATCH_SIZE, draft_model=draft_model)
+
+
+def _generation_payload(
+    request: GenerateRequest,
+    route: str,
+    result: Any,
+    cached: bool = False,
+    coalesced: bool = False,
+) -> Dict[str, Any]:
+    if route in SPECULATIVE_ROUTES and not cached:
+        response, stats = result
+        payload: Dict[str, Any] = {"response": response, "speculative": stats}
+    else:
+        payload = {"response": result}
+    if request.adapter:
+        payload["adapter"] = request.adapter
+    if cached:
+        payload["cached"] = True
+    if coalesced:
+        payload["coalesced"] = True
+    return payload
+
+
+def _cancel_token(request: GenerateRequest) -> CancellationToken:
+    return CancellationToken(request.timeout_seconds or GENERATION_TIMEOUT_SECONDS or None)
+
+
+async def _await_generation(awaitable, http_request: Request, cancel: CancellationToken):
+    """
+    Wait for a (possibly shared) generation on behalf of one client.
+
+    The client stops waiting when it disconnects or its deadline passes; the
+    generation itself is cancelled once no subscriber is left. Deadlines
+    surface as 504, client cancellations as 499 and bad arguments as 400.
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=STREAM_DISCONNECT_POLL_SECONDS)
+            if done:
+                return task.result()
+            if not cancel.fired and await http_request.is_disconnected():
+                cancel.cancel()
+            if cancel.cancelled:
+                raise cancel.error()
+    except TimeoutError as exc:
+        raise HTTPException(status_code=504, detail=str(exc)) from exc
+    except GenerationCancelled as exc:
+        raise HTTPException(status_code=499, detail=str(exc)) from exc
+    except WorkerPoolSaturated as exc:
+        raise HTTPException(status_code=503, detail=str(exc), headers={"Retry-After": "1"}) from exc
+    except ModelPoolBusy as exc:
+        raise _pool_busy(exc) from exc
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+
+
+async def _admit(request: GenerateRequest, cancel: CancellationToken) -> AdmissionSlot:
+    """
+    Wait for a generation slot on the request's model.
+
+    Saturation is reported as 429 (queue full) or 503 (no slot within the
+    queue-time limit or the request deadline), both with ``Retry-After``.
+    """
+    controller = ADMISSION.controller(_model_key(request))
+    try:
+        return await controller.acquire(request.priority, timeout=cancel.remaining())
+    except AdmissionRejected as exc:
+        raise HTTPException(
+            status_code=exc.status_code,
+            detail=str(exc),
+            headers={"Retry-After": str(exc.retry_after)},
+        ) from exc
+
+
+async def _store_response(
+    inference: Optional[ModelInference],
+    shared: SharedGeneration,
+    key: Optional[str],
+    response: str,
+) -> None:
+    # Worker processes store their own responses
+    if inference is None or shared.cached:
+        return
+    if key is not None and inference.response_cache is not None and shared.claim_cache_write():
+        await asyncio.get_running_loop().run_in_executor(None, inference.response_cache.put, key, response)
+
+
+@app.post("/generate")
+async def generate_text(request: GenerateRequest, http_request: Request) -> Dict[str, Any]:
+    cancel = _cancel_token(request)
+    route = _generation_route(request)
+    # The slot covers model loading too; cache hits and followers hand it back early
+    slot = await _admit(request, cancel)
+    lease = None
+    try:
+        inference, key, cached, lease = await _load_generation(request)
+        if cached is not None:
+            return _generation_payload(request, route, cached, cached=True)
+
+        # Identical deterministic requests share one generation
+        shared, leader = COALESCER.acquire(f"{route}:{key}" if key is not None else None)
+        if leader:
+            slot.release_when_done(shared.future)
+            if lease is not None:
+                lease.release_when_done(shared.future)
+            _start_generation(shared, inference, request, route)
+    finally:
+        slot.release()
+        if lease is not None:
+            lease.release()
+    try:
+        # Shielded: one client leaving must not cancel the shared future for the others
+        result = await _await_generation(asyncio.shield(asyncio.wrap_future(shared.future)), http_request, cancel)
+    finally:
+        shared.detach()
+    if not shared.cached:
+        await _store_response(inference, shared, key, result[0] if route in SPECULATIVE_ROUTES else result)
+    return _generation_payload(request, route, result, cached=shared.cached, coalesced=not leader)
+
+
+class PreparedStream(NamedTuple):
+    # ``None`` when generation runs in worker processes
+    inference: Optional[ModelInference]
+    tokenizer: Any
+    key: Optional[str]
+    cached: Optional[str]
+    cancel: CancellationToken
+    # ``None`` when the response is cached
+    shared: Optional[SharedGeneration] = None
+    leader: bool = False
+    # Wall-clock arrival, and the time spent waiting for admission and for the model
+    received_at: float = 0.0
+    queue_seconds: float = 0.0
+    load_seconds: float = 0.0
+
+
+async def _prepare_stream(request: GenerateRequest) -> PreparedStream:
+    """
+    Validate a streaming request, admit it, load its model and subscribe it to
+    its generation (started here when this request leads it).
+
+    Admission errors surface before any event is sent. Timings reported to
+    the client are measured from here, so they include queueing and loading.
+    """
+    received_at = time.time()
+    if _generation_route(request) != "engine":
+        raise HTTPException(
+            status_code=400,
+            detail="Streaming supports greedy and sampled decoding only (no beams or speculative decoding)",
         )
+    cancel = _cancel_token(request)
+    slot = await _admit(request, cancel)
+    admitted_at = time.time()
+    lease = None
+    try:
+        inference, key, cached, lease = await _load_generation(request)
+        if inference is not None:
+            tokenizer = inference.tokenizer
+        else:
+            tokenizer = await asyncio.get_running_loop().run_in_executor(
+                None, _worker_tokenizer, _model_key(request).model_path, request.trust_remote_code
+            )
+        timings = {
+            "received_at": received_at,
+            "queue_seconds": admitted_at - received_at,
+            "load_seconds": time.time() - admitted_at,
+        }
+        if cached is not None:
+            return PreparedStream(inference, tokenizer, key, cached, cancel, **timings)
+        shared, leader = COALESCER.acquire(f"engine:{key}" if key is not None else None)
+        if leader:
+            slot.release_when_done(shared.future)
+            if lease is not None:
+                lease.release_when_done(shared.future)
+            _start_generation(shared, inference, request, "engine")
+        return PreparedStream(inference, tokenizer, key, None, cancel, shared, leader, **timings)
+    finally:
+        slot.release()
+        if lease is not None:
+            lease.release()
+
+
+async def _stream_events(
+    request: GenerateRequest,
+    prepared: PreparedStream,
+    is_disconnected: Callable[[], Awaitable[bool]],
+) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Yield ``(event, data)`` pairs: ``token`` events with new text, then ``done``.
+
+    Identical deterministic streams share one engine row; a late subscriber is
+    first sent the text decoded so far. Text that may be the start of a stop
+    string is held back. Leaving the generator early, the client going away or
+    the request deadline passing detaches this subscriber, and the row is
+    cancelled once nobody is left. Timings in the ``done`` event count from
+    the request's arrival.
+    """
+    inference, tokenizer, key, cached, cancel, shared, leader, started = prepared[:8]
+    timings = {"queue_seconds": prepared.queue_seconds, "load_seconds": prepared.load_seconds}
+    if cached is not None:
+        yield "token", {"text": cached}
+        finished_at = time.time()
+        yield "done", {
+            **_generation_payload(request, "engine", cached, cached=True),
+            "time_to_first_token": finished_at - started,
+            "total_seconds": finished_at - started,
+            **timings,
+        }
+        return
+
+    loop = asyncio.get_running_loop()
+    tokens: "asyncio.Queue[Optional[int]]" = asyncio.Queue()
+
+    def _push(token: Optional[int]) -> None:
+        # Runs on the engine thread; a failing callback would abort the whole decode step
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(tokens.put_nowait, token)
+
+    for token in shared.listen(_push):
+        tokens.put_nowait(token)
+    if shared.future.done():
+        tokens.put_nowait(None)
+
+    matcher = compile_stop_sequences(tokenizer, normalize_stop(request.stop)) if request.stop else None
+    generated: List[int] = []
+    sent = ""
+    first_token_at: Optional[float] = None
+    try:
+        while True:
+            try:
+                token = await asyncio.wait_for(tokens.get(), timeout=STREAM_DISCONNECT_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                if await is_disconnected():
+                    return
+                if cancel.cancelled:
+                    yield "error", {"detail": str(cancel.error())}
+                    return
+                continue
+            if token is None:
+                break
+            if cancel.cancelled:
+                yield "error", {"detail": str(cancel.error())}
+                return
+            if first_token_at is None:
+                first_token_at = time.time()
+            generated.append(token)
+            text = tokenizer.decode(generated, skip_special_tokens=True)
+            if matcher is not None:
+                text, _ = matcher.split_safe(matcher.trim_text(text))
+            if len(text) > len(sent) and text.startswith(sent):
+                yield "token", {"text": text[len(sent):]}
+                sent = text
+
+        error = shared.future.exception()
+        if error is not None:
+            yield "error", {"detail": str(error)}
+            return
+        response = shared.future.result()
+        # The final text is trimmed and stripped; send whatever was still held back
+        tail = response[len(sent.lstrip()):] if response.startswith(sent.lstrip()) else ""
+        if tail:
+            yield "token", {"text": tail}
+        await _store_response(inference, shared, key, response)
+
+        finished_at = time.time()
+        decode_seconds = finished_at - shared.first_token_at if shared.first_token_at else 0.0
+        yield "done", {
+            **_generation_payload(request, "engine", response, cached=shared.cached, coalesced=not leader),
+            "completion_tokens": len(generated),
+            "prompt_tokens": shared.prompt_tokens,
+            "time_to_first_token": (first_token_at or finished_at) - started,
+            "total_seconds": finished_at - started,
+            **timings,
+            # The first token comes from prefill, so the rate covers the decode steps after it
+            "tokens_per_second": (len(generated) - 1) / decode_seconds if decode_seconds > 0 else 0.0,
+        }
+    finally:
+        shared.detach(_push)
+
+
+@app.post("/generate/stream")
+async def generate_stream(request: GenerateRequest, http_request: Request) -> EventSourceResponse:
+    """Server-Sent Events: ``token`` events as text decodes, then one ``done`` event with timings"""
+    prepared = await _prepare_stream(request)
+
+    async def _sse() -> AsyncIterator[Dict[str, str]]:
+        events = _stream_events(request, prepared, http_request.is_disconnected)
+        try:
+            async for event, data in events:
+                yield {"event": event, "data": json.dumps(data)}
+        finally:
+            await events.aclose()
+
+    return EventSourceResponse(_sse(), headers={"X-Accel-Buffering": "no"})
+
+
+@app.websocket("/generate/ws")
+async def generate_websocket(websocket: WebSocket) -> None:
+    """WebSocket variant of ``/generate/stream``: send one request JSON, receive ``{"event": ...}`` messages"""
+    await websocket.accept()
+    try:
+        request = GenerateRequest(**await websocket.receive_json())
+        prepared = await _prepare_stream(request)
+    except WebSocketDisconnect:
+        return
+    except HTTPException as exc:
+        error = {"event": "error", "detail": exc.detail}
+        if exc.headers and "Retry-After" in exc.headers:
+            error["retry_after"] = int(exc.headers["Retry-After"])
+        await websocket.send_json(error)
+        await websocket.close()
+        return
+    except ValueError as exc:
+        await websocket.send_json({"event": "error", "detail": str(exc)})
+        await websocket.close()
+        return
+
+    closed = asyncio.Event()
+
+    async def _watch_disconnect() -> None:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                closed.set()
+                return
+
+    async def _is_disconnected() -> bool:
+        return closed.is_set()
+
+    watcher = asyncio.create_task(_watch_disconnect())
+    events = _stream_events(request, prepared, _is_disconnected)
+    try:
+        async for event, data in events:
+            if closed.is_set():
+                break
+            await websocket.send_json({"event": event, **data})
+        if not closed.is_set():
+            await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await events.aclose()
+        watcher.cancel()
+
+
+@app.get("/generate/stats")
+def generation_stats() -> Dict[str, Any]:
+    """Per-model sections are ``None`` when models live in worker processes; see ``workers`` instead"""
+    engines = []
+    cancellation = []
+    response_caches = []
+    for entry in MODEL_POOL.entries():
+        engine = getattr(entry.model, "_engine", None)
+        if engine is not None:
+            engines.append({**entry.key._asdict(), **engine.stats()})
+        cancellation.append({**entry.key._asdict(), **entry.model.cancellation_stats.to_dict()})
+        if entry.model.response_cache is not None:
+            response_caches.append({**entry.key._asdict(), **entry.model.response_cache.stats()})
+    in_process = WORKER_POOL is None
+    return {
+        "engines": engines if in_process else None,
+        "cancellation": cancellation if in_process else None,
+        "response_cache": response_caches if in_process else None,
+        "coalescing": COALESCER.stats(),
+        "workers": WORKER_POOL.stats() if WORKER_POOL is not None else None,
+        "admission": [{**key._asdict(), **controller.stats()} for key, controller in ADMISSION.items()],
+    }
+
+
+@app.post("/chat/sessions")
+async def create_chat_session(request: ChatSessionRequest) -> Dict[str, Any]:
+    _require_in_process_models("Chat sessions")
+    loop = asyncio.get_running_loop()
+    try:
+        inference = await loop.run_in_executor(None, _pooled_model, request)
+    except ModelPoolBusy as exc:
+        raise _pool_busy(exc) from exc
+    try:
+        template = ChatTemplate.from_prompt_file(request.prompt_template_type)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    if request.system is not None:
+        template.system = request.system.strip()
+    session = CHAT_SESSIONS.create(inference, template)
+    return session.info()
+
+
+@app.get("/chat/sessions")
+def list_chat_sessions() -> Dict[str, Any]:
+    return {"sessions": CHAT_SESSIONS.list()}
+
+
+@app.post("/chat/sessions/{session_id}/messages")
+async def send_chat_message(session_id: str, request: ChatMessageRequest) -> Dict[str, Any]:
+    _require_in_process_models("Chat sessions")
+    try:
+        session = CHAT_SESSIONS.get(session_id)
+        owner = CHAT_SESSIONS.owner(session_id)
+    except KeyError as exc:
+        raise HTTPException(status_code=404, detail="Chat session not found or expired") from exc
+    # Keep the model loaded for this turn; a session whose model was evicted is gone
+    lease = MODEL_POOL.retain(owner)
+    if lease is None:
+        raise HTTPException(status_code=404, detail="Chat session not found or expired")
+
+    def _chat() -> str:
+        # Sessions run on the base model and must not overlap engine steps routing adapters
+        with owner.use_adapter(None):
+            return session.chat(
+                request.message,
+                max_new_tokens=request.max_new_tokens,
+                temperature=request.temperature,
+                top_p=request.top_p,
+                top_k=request.top_k,
+            )
+
+    loop = asyncio.get_running_loop()
+    try:
+        response = await loop.run_in_executor(None, _chat)
+    finally:
+        lease.release()
+    return {"response": response, "session": session.info()}
+
+
+@app.delete("/chat/sessions/{session_id}")
+def delete_chat_session(session_id: str) -> Dict[str, Any]:
+    if not CHAT_SESSIONS.close(session_id):
+        raise HTTPException(status_code=404, detail="Chat session not found")
+    return {"status": "closed", "session_id": session_id}
 
+
+@app.get("/models/adapters")
+def list_served_adapters() -> Dict[str, Any]:
+    _require_in_process_models("Listing served adapters")
+    models = []
+    for entry in MODEL_POOL.entries():
+        bank = getattr(entry.model, "adapters", None)
+        if bank is not None:
+            models.append({**entry.key._asdict(), "adapters": bank.loaded(), "adapter_loads": bank.loads})
+    return {"models": models}
+
+
+@app.get("/models/loaded")
+def list_loaded_models() -> Dict[str, Any]:
+    # Each worker's loaded models are listed under /generate/stats
+    _require_in_process_models("Listing loaded models")
+    return {**MODEL_POOL.snapshot(), "draft_models": DRAFT_POOL.snapshot()}
+
+
+@app.post("/models/warm")
+async def warm_model(request: ModelLoadRequest) -> Dict[str, Any]:
+    _require_in_process_models("Warming models")
+    key = _model_key(request)
     loop = asyncio.get_running_loop()
-    response = await loop.run_in_executor(None, _generate)
-    return {"response": response}
+    try:
+        await loop.run_in_executor(None, _pooled_model, request)
+        await loop.run_in_executor(None, _pooled_draft_model, request)
+    except ModelPoolBusy as exc:
+        raise _pool_busy(exc) from exc
+    except Exception as exc:
+        raise HTTPException(status_code=400, detail=f"Failed to load model: {exc}") from exc
+    entry = MODEL_POOL.entry(key)
+    if entry is None:
+        return {"status": "loaded", "model": key._asdict()}
+    return {"status": "loaded", "model": entry.to_dict(), "load_report": entry.model.load_report.to_dict()}
+
+
+@app.post("/models/evict")
+def evict_model(request: ModelLoadRequest) -> Dict[str, Any]:
+    _require_in_process_models("Evicting models")
+    key = _model_key(request)
+    draft_key = _draft_key(request)
+    evicted = MODEL_POOL.evict(key)
+    if draft_key is not None:
+        # The draft may be shared with other targets; it reloads on their next request
+        evicted = DRAFT_POOL.evict(draft_key) or evicted
+    if not evicted:
+        raise HTTPException(status_code=404, detail="Model is not loaded")
+    return {"status": "evicted", "model": key._asdict()}
 
 
 @app.post("/evaluate")
@@ -0,0 +1,307 @@
+"""
+Process-wide cache of loaded inference models.
+
+Models are keyed by resolved path, device, dtype and adapter, and evicted in
+least-recently-used order once a memory budget or model count is exceeded.
+Speculative-decoding draft models live in a separate pool keyed by their own
+path, so one draft is shared by every target using it.
+Concurrent requests for a model that is still loading wait for that single
+load instead of starting their own.
+
+Callers running generations take a :class:`ModelLease` with
+:meth:`ModelPool.acquire`. Leased models are never chosen for eviction, and a
+model evicted explicitly while leased is only released once its last lease
+ends. A load that only fits by evicting busy models is refused with
+:class:`ModelPoolBusy`.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+
+class ModelKey(NamedTuple):
+    """Identity of a loaded model"""
+    model_path: str
+    device: str = "auto"
+    torch_dtype: str = "float16"
+    adapter_path: Optional[str] = None
+
+
+@dataclass
+class PoolEntry:
+    """A loaded model and its bookkeeping"""
+    key: ModelKey
+    model: Any
+    size_bytes: int
+    loaded_at: float = field(default_factory=time.time)
+    last_used: float = field(default_factory=time.time)
+    hits: int = 0
+    load_seconds: float = 0.0
+    # Leases held by running generations
+    in_use: int = 0
+    # Evicted while leased; released when the last lease ends
+    retired: bool = False
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            **self.key._asdict(),
+            "size_bytes": self.size_bytes,
+            "loaded_at": self.loaded_at,
+            "last_used": self.last_used,
+            "hits": self.hits,
+            "load_seconds": self.load_seconds,
+            "in_use": self.in_use,
+        }
+
+
+class ModelPoolBusy(RuntimeError):
+    """A model could only be loaded by evicting models that are serving requests"""
+
+
+class ModelLease:
+    """Keeps a pooled model from being released; end it once, directly or when a generation finishes"""
+
+    def __init__(self, pool: "ModelPool", entry: PoolEntry):
+        self.pool = pool
+        self.entry = entry
+        self.model = entry.model
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self.pool._end_lease(self.entry)
+
+    def release_when_done(self, future: Future) -> None:
+        """Hold the model until ``future`` resolves, which may be after the requesting client left"""
+        if self._released:
+            return
+        self._released = True
+        future.add_done_callback(lambda _: self.pool._end_lease(self.entry))
+
+
+def model_size_bytes(inference: Any) -> int:
+    """Bytes held by a model's parameters and buffers"""
+    model = getattr(inference, "model", inference)
+    total = 0
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        total += tensor.numel() * tensor.element_size()
+    return total
+
+
+class _PendingLoad:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.error: Optional[BaseException] = None
+
+
+class ModelPool:
+    """LRU pool of loaded models with single-flight loading"""
+
+    def __init__(
+        self,
+        loader: Callable[..., Any],
+        max_bytes: Optional[int] = None,
+        max_models: Optional[int] = None,
+        on_evict: Optional[Callable[[PoolEntry], None]] = None,
+    ) -> None:
+        """
+        Args:
+            loader: Callable building a model from ``ModelKey`` fields plus extra kwargs
+            max_bytes: Memory budget across all cached models (None for unbounded)
+            max_models: Maximum number of cached models (None for unbounded)
+            on_evict: Hook called after an entry leaves the pool
+        """
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.max_models = max_models
+        self.on_evict = on_evict
+        self._entries: "OrderedDict[ModelKey, PoolEntry]" = OrderedDict()
+        self._pending: Dict[ModelKey, _PendingLoad] = {}
+        self._lock = threading.Lock()
+
+    def total_bytes(self) -> int:
+        with self._lock:
+            return sum(entry.size_bytes for entry in self._entries.values())
+
+    def get(self, key: ModelKey, **load_kwargs) -> Any:
+        """Return the cached model for ``key``, loading it once if needed"""
+        return self._get(key, False, load_kwargs).model
+
+    def acquire(self, key: ModelKey, **load_kwargs) -> ModelLease:
+        """Like :meth:`get`, but keep the model loaded until the returned lease is released"""
+        return ModelLease(self, self._get(key, True, load_kwargs))
+
+    def retain(self, model: Any) -> Optional[ModelLease]:
+        """Lease a model obtained earlier, or ``None`` if it has left the pool"""
+        with self._lock:
+            for entry in self._entries.values():
+                if entry.model is model:
+                    entry.in_use += 1
+                    return ModelLease(self, entry)
+        return None
+
+    def _end_lease(self, entry: PoolEntry) -> None:
+        with self._lock:
+            entry.in_use = max(0, entry.in_use - 1)
+            release = entry.retired and entry.in_use == 0
+        if release:
+            # The last lease often ends on the model's own engine thread, which closing it would join
+            threading.Thread(target=self._release, args=(entry,), name="model-pool-release", daemon=True).start()
+
+    def _get(self, key: ModelKey, lease: bool, load_kwargs: Dict[str, Any]) -> PoolEntry:
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    entry.hits += 1
+                    entry.last_used = time.time()
+                    if lease:
+                        entry.in_use += 1
+                    return entry
+                pending = self._pending.get(key)
+                owner = pending is None
+                if owner:
+                    if self._all_busy_at_capacity():
+                        raise ModelPoolBusy(f"Cannot load {key.model_path}: every loaded model is serving requests")
+                    pending = self._pending[key] = _PendingLoad()
+
+            if not owner:
+                pending.done.wait()
+                if pending.error is not None:
+                    raise pending.error
+                # Loaded (or loaded then evicted); look again
+                continue
+
+            try:
+                started = time.time()
+                model = self.loader(**key._asdict(), **load_kwargs)
+                entry = PoolEntry(
+                    key=key,
+                    model=model,
+                    size_bytes=model_size_bytes(model),
+                    load_seconds=time.time() - started,
+                )
+            except BaseException as exc:
+                pending.error = exc
+                with self._lock:
+                    self._pending.pop(key, None)
+                pending.done.set()
+                raise
+
+            with self._lock:
+                self._entries[key] = entry
+                self._pending.pop(key, None)
+                evicted = self._evict_over_budget(keep=key)
+                # Anything still over budget besides the new model is serving requests
+                refused = self._over_budget() and len(self._entries) > 1
+                if refused:
+                    self._entries.pop(key)
+                    pending.error = ModelPoolBusy(
+                        f"Cannot fit {key.model_path} in the pool budget while the loaded models serve requests"
+                    )
+                elif lease:
+                    entry.in_use += 1
+            pending.done.set()
+            for old in evicted:
+                self._release(old)
+            if refused:
+                self._release(entry)
+                raise pending.error
+            return entry
+
+    def _all_busy_at_capacity(self) -> bool:
+        # Caller holds self._lock
+        if self.max_models is None or len(self._entries) < self.max_models:
+            return False
+        return all(entry.in_use for entry in self._entries.values())
+
+    def _over_budget(self) -> bool:
+        # Caller holds self._lock
+        if self.max_models is not None and len(self._entries) > self.max_models:
+            return True
+        if self.max_bytes is not None:
+            return sum(entry.size_bytes for entry in self._entries.values()) > self.max_bytes
+        return False
+
+    def _evict_over_budget(self, keep: ModelKey) -> List[PoolEntry]:
+        """Pop least recently used idle entries until the pool fits; caller holds self._lock"""
+        evicted = []
+        while self._over_budget():
+            victim = next((k for k, entry in self._entries.items() if k != keep and not entry.in_use), None)
+            if victim is None:
+                break
+            evicted.append(self._entries.pop(victim))
+        return evicted
+
+    def _release(self, entry: PoolEntry) -> None:
+        if self.on_evict is not None:
+            self.on_evict(entry)
+
+    def evict(self, key: ModelKey) -> bool:
+        """Drop ``key`` from the pool; returns False if it was not loaded"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            idle = entry is not None and not self._retire(entry)
+        if entry is None:
+            return False
+        if idle:
+            self._release(entry)
+        return True
+
+    def clear(self) -> int:
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+            idle = [entry for entry in entries if not self._retire(entry)]
+        for entry in idle:
+            self._release(entry)
+        return len(entries)
+
+    @staticmethod
+    def _retire(entry: PoolEntry) -> bool:
+        """Defer releasing a leased entry to its last lease; caller holds self._lock"""
+        entry.retired = entry.in_use > 0
+        return entry.retired
+
+    def entries(self) -> List[PoolEntry]:
+        """Loaded entries, most recently used first"""
+        with self._lock:
+            return list(reversed(self._entries.values()))
+
+    def entry(self, key: ModelKey) -> Optional[PoolEntry]:
+        with self._lock:
+            return self._entries.get(key)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = [entry.to_dict() for entry in reversed(self._entries.values())]
+            loading = [key._asdict() for key in self._pending]
+        return {
+            "models": entries,
+            "loading": loading,
+            "total_bytes": sum(entry["size_bytes"] for entry in entries),
+            "max_bytes": self.max_bytes,
+            "max_models": self.max_models,
+        }
+
+
+def pool_limits_from_env() -> Dict[str, Optional[int]]:
+    """Read ``MODEL_POOL_MAX_MEMORY_GB`` (unset = unbounded) and ``MODEL_POOL_MAX_MODELS`` (0 = unbounded)"""
+    max_gb = os.getenv("MODEL_POOL_MAX_MEMORY_GB", "").strip()
+    max_models = int(os.getenv("MODEL_POOL_MAX_MODELS", "2"))
+    return {
+        "max_bytes": int(float(max_gb) * (1024 ** 3)) if max_gb else None,
+        "max_models": max_models or None,
+    }
+
+
+def draft_pool_limits_from_env() -> Dict[str, Optional[int]]:
+    """Read ``DRAFT_POOL_MAX_MODELS`` (0 = unbounded) for the speculative-decoding draft cache"""
+    max_models = int(os.getenv("DRAFT_POOL_MAX_MODELS", "2"))
+    return {"max_models": max_models or None}
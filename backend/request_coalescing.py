@@ -0,0 +1,147 @@
+"""
+Single-flight coalescing of identical in-flight generation requests.
+
+Deterministic requests with the same key (model content, prompt and decoding
+parameters) attach to one running generation instead of starting their own.
+Every subscriber gets the same result, and streaming subscribers get a replay
+of the tokens decoded so far followed by the live ones. The generation is
+cancelled only when its last subscriber leaves.
+"""
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from cancellation import CancellationToken
+
+TokenListener = Callable[[Optional[int]], None]
+
+
+class SharedGeneration:
+    """One generation fanned out to every subscriber asking for the same output"""
+
+    def __init__(self, key: Optional[str]):
+        self.key = key
+        self.cancel = CancellationToken()
+        self.future: Future = Future()
+        self.tokens: List[int] = []
+        self.prompt_tokens: Optional[int] = None
+        self.started_at = time.time()
+        self.first_token_at: Optional[float] = None
+        # Answered from a response cache (set by out-of-process workers)
+        self.cached = False
+        self.subscribers = 0
+        self._listeners: List[TokenListener] = []
+        self._lock = threading.Lock()
+        self._cache_claimed = False
+
+    def push(self, token: int) -> None:
+        """Record a decoded token and forward it to live listeners (any thread)"""
+        with self._lock:
+            if self.first_token_at is None:
+                self.first_token_at = time.time()
+            self.tokens.append(token)
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(token)
+
+    def resolve(self, result: Any = None, error: Optional[BaseException] = None) -> None:
+        if self.future.done():
+            return
+        if error is not None:
+            self.future.set_exception(error)
+        else:
+            self.future.set_result(result)
+        with self._lock:
+            listeners = list(self._listeners)
+        # ``None`` marks the end of the token stream
+        for listener in listeners:
+            listener(None)
+
+    def link(self, future: Future) -> None:
+        """Resolve from another future (e.g. an engine request's)"""
+        def _copy(done: Future) -> None:
+            if done.cancelled():
+                self.resolve(error=self.cancel.error())
+            elif done.exception() is not None:
+                self.resolve(error=done.exception())
+            else:
+                self.resolve(result=done.result())
+
+        future.add_done_callback(_copy)
+
+    def attach(self) -> bool:
+        """Subscribe unless the generation was already abandoned"""
+        with self._lock:
+            if self.cancel.fired:
+                return False
+            self.subscribers += 1
+            return True
+
+    def listen(self, listener: TokenListener) -> List[int]:
+        """Register a token listener and return the tokens it missed"""
+        with self._lock:
+            self._listeners.append(listener)
+            return list(self.tokens)
+
+    def detach(self, listener: Optional[TokenListener] = None) -> None:
+        """Leave the generation; the last subscriber to leave an unfinished one cancels it"""
+        with self._lock:
+            if listener is not None and listener in self._listeners:
+                self._listeners.remove(listener)
+            self.subscribers -= 1
+            if self.subscribers <= 0 and not self.future.done():
+                self.cancel.cancel()
+
+    def claim_cache_write(self) -> bool:
+        """True for exactly one subscriber, which stores the result in the response cache"""
+        with self._lock:
+            claimed, self._cache_claimed = self._cache_claimed, True
+            return not claimed
+
+
+class RequestCoalescer:
+    """Registry of in-flight generations keyed by output identity"""
+
+    def __init__(self):
+        self._inflight: Dict[str, SharedGeneration] = {}
+        self._lock = threading.Lock()
+        self.started = 0
+        self.coalesced = 0
+
+    def acquire(self, key: Optional[str]) -> Tuple[SharedGeneration, bool]:
+        """
+        Subscribe to the in-flight generation for ``key`` or create one.
+
+        Returns ``(shared, leader)``; the leader must start the generation and
+        every caller must :meth:`SharedGeneration.detach` when done. ``None``
+        keys (sampled requests) always get a private generation.
+        """
+        with self._lock:
+            shared = self._inflight.get(key) if key is not None else None
+            if shared is not None and not shared.future.done() and shared.attach():
+                self.coalesced += 1
+                return shared, False
+            shared = SharedGeneration(key)
+            shared.attach()
+            self.started += 1
+            if key is not None:
+                self._inflight[key] = shared
+        if key is not None:
+            shared.future.add_done_callback(lambda _: self._forget(shared))
+        return shared, True
+
+    def _forget(self, shared: SharedGeneration) -> None:
+        with self._lock:
+            if self._inflight.get(shared.key) is shared:
+                del self._inflight[shared.key]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            requests = self.started + self.coalesced
+            return {
+                "in_flight": len(self._inflight),
+                "generations_started": self.started,
+                "requests_coalesced": self.coalesced,
+                "coalesced_rate": self.coalesced / requests if requests else 0.0,
+            }
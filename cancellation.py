@@ -0,0 +1,125 @@
+"""
+Cooperative cancellation for generation.
+
+``model.generate`` cannot be interrupted from another thread, so a
+:class:`CancellationToken` is checked once per decode step by a stopping
+criterion (or by our own decode loops). A token is cancelled explicitly, e.g.
+when a client disconnects, or implicitly once its deadline passes. Every
+cancellation is recorded in :class:`CancellationStats` together with the
+decode steps it saved.
+"""
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import torch
+from transformers import StoppingCriteria
+
+CANCELLED = "cancelled"
+DEADLINE = "deadline"
+
+
+class GenerationCancelled(RuntimeError):
+    """Raised or set on a future when generation was cancelled by its caller"""
+
+
+class CancellationToken:
+    """Thread-safe cancel flag with an optional deadline"""
+
+    def __init__(self, timeout: Optional[float] = None):
+        """
+        Args:
+            timeout: Seconds from now after which the token counts as cancelled
+        """
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.reason: Optional[str] = None
+        self._event = threading.Event()
+
+    def cancel(self, reason: str = CANCELLED) -> None:
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        if not self._event.is_set() and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel(DEADLINE)
+        return self._event.is_set()
+
+    @property
+    def fired(self) -> bool:
+        """Whether cancellation has been observed, without re-checking the deadline"""
+        return self._event.is_set()
+
+    def remaining(self) -> Optional[float]:
+        """Seconds until the deadline (``None`` without one)"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def error(self) -> BaseException:
+        """Exception describing why the token was cancelled"""
+        if self.reason == DEADLINE:
+            return TimeoutError("Generation deadline exceeded")
+        return GenerationCancelled("Generation cancelled")
+
+
+class CancellationStats:
+    """Counts cancelled generations and the work they no longer cost"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.cancelled = 0
+        self.deadline_exceeded = 0
+        self.reclaimed_tokens = 0
+        self.skipped_prefill_tokens = 0
+
+    def record(self, reason: Optional[str], reclaimed_tokens: int, skipped_prefill_tokens: int = 0) -> None:
+        """
+        Args:
+            reason: ``CANCELLED`` or ``DEADLINE``
+            reclaimed_tokens: Decode steps (summed over rows) that will not run
+            skipped_prefill_tokens: Prompt tokens never prefilled
+        """
+        with self._lock:
+            if reason == DEADLINE:
+                self.deadline_exceeded += 1
+            else:
+                self.cancelled += 1
+            self.reclaimed_tokens += max(0, reclaimed_tokens)
+            self.skipped_prefill_tokens += max(0, skipped_prefill_tokens)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "cancelled": self.cancelled,
+                "deadline_exceeded": self.deadline_exceeded,
+                "reclaimed_decode_tokens": self.reclaimed_tokens,
+                "skipped_prefill_tokens": self.skipped_prefill_tokens,
+            }
+
+
+class CancellationCriteria(StoppingCriteria):
+    """Stops every row of ``model.generate`` once ``token`` is cancelled"""
+
+    def __init__(
+        self,
+        token: CancellationToken,
+        prompt_length: int,
+        max_new_tokens: int,
+        stats: Optional[CancellationStats] = None,
+    ):
+        self.token = token
+        self.prompt_length = prompt_length
+        self.max_new_tokens = max_new_tokens
+        self.stats = stats
+        self._recorded = False
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        stop = self.token.cancelled
+        if stop and not self._recorded:
+            self._recorded = True
+            if self.stats is not None:
+                generated = input_ids.shape[1] - self.prompt_length
+                self.stats.record(self.token.reason, input_ids.shape[0] * (self.max_new_tokens - generated))
+        return torch.full((input_ids.shape[0],), stop, dtype=torch.bool, device=input_ids.device)
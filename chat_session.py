@@ -0,0 +1,271 @@
+"""
+Multi-turn chat sessions that keep their KV cache between turns.
+
+A session owns the conversation's ``past_key_values``; each turn only runs the
+tokens of the new user message (plus the previous turn's final token) before
+decoding. When the cache would grow past ``max_cached_tokens`` the oldest
+turns are dropped and the kept transcript is re-prefilled once.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+import torch
+
+from generation_engine import sample_next_tokens
+from kv_cache import cache_nbytes, to_legacy_cache
+
+PROMPT_FILE = os.path.join(os.path.dirname(__file__), "prompts", "prompt.json")
+
+
+@dataclass
+class ChatTemplate:
+    """How the system text and user turns are laid out in the transcript"""
+    system: str = ""
+    user: str = "{input}"
+    separator: str = "\n\n"
+
+    @classmethod
+    def from_prompt_template(cls, template: Optional[Dict[str, str]]) -> "ChatTemplate":
+        if not template:
+            return cls()
+        return cls(
+            system=template.get("system", "").strip(),
+            user=template.get("user", "{input}").strip(),
+        )
+
+    @classmethod
+    def from_prompt_file(cls, template_type: Optional[str] = None) -> "ChatTemplate":
+        """Build a template from an entry of ``prompts/prompt.json``"""
+        if not template_type:
+            return cls()
+        with open(PROMPT_FILE, "r", encoding="utf-8") as f:
+            templates = json.load(f)
+        if template_type not in templates:
+            raise ValueError(f"Unknown prompt template '{template_type}'")
+        return cls.from_prompt_template(templates[template_type])
+
+    def turn_text(self, message: str, first: bool) -> str:
+        user = self.user.format(input=message)
+        if first:
+            return self.separator.join(part for part in (self.system, user) if part)
+        return self.separator + user
+
+
+class ChatSession:
+    """One conversation and its cached attention state"""
+
+    def __init__(
+        self,
+        model: Any,
+        tokenizer: Any,
+        template: Optional[ChatTemplate] = None,
+        max_cached_tokens: int = 4096,
+        session_id: Optional[str] = None,
+    ):
+        """
+        Args:
+            model: Causal LM called directly with ``past_key_values``
+            tokenizer: Matching tokenizer
+            template: Transcript layout (defaults to bare user messages)
+            max_cached_tokens: Cap on tokens kept in the session's KV cache
+            session_id: Identifier (generated when omitted)
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.template = template or ChatTemplate()
+        self.max_cached_tokens = max_cached_tokens
+        self.session_id = session_id or uuid.uuid4().hex
+        eos = tokenizer.eos_token_id
+        self.eos_token_ids = set(eos if isinstance(eos, (list, tuple)) else [eos])
+
+        self.history: List[Dict[str, str]] = []
+        self.created_at = time.time()
+        self.last_active = self.created_at
+        self.lock = threading.Lock()
+
+        self._past: Any = None
+        self._cached_ids: List[int] = []
+        self._pending_ids: List[int] = []
+        # Offsets into the transcript where each user turn starts
+        self._turn_starts: List[int] = []
+        self.prefill_tokens = 0
+
+    @property
+    def transcript_ids(self) -> List[int]:
+        return self._cached_ids + self._pending_ids
+
+    @property
+    def cached_tokens(self) -> int:
+        return len(self._cached_ids)
+
+    def cache_bytes(self) -> int:
+        return cache_nbytes(to_legacy_cache(self._past)) if self._past is not None else 0
+
+    def reset(self) -> None:
+        self._past = None
+        self._cached_ids, self._pending_ids, self._turn_starts = [], [], []
+        self.history = []
+
+    def _forward(self, token_ids: List[int]) -> torch.Tensor:
+        device = next(self.model.parameters()).device
+        input_ids = torch.tensor([token_ids], dtype=torch.long, device=device)
+        outputs = self.model(input_ids=input_ids, past_key_values=self._past, use_cache=True)
+        self._past = outputs.past_key_values
+        self._cached_ids.extend(token_ids)
+        self.prefill_tokens += len(token_ids)
+        return outputs.logits[:, -1, :]
+
+    def _fit(self, incoming: int) -> None:
+        """Drop the oldest turns until the new turn fits under ``max_cached_tokens``"""
+        transcript = self.transcript_ids
+        if len(transcript) + incoming <= self.max_cached_tokens or len(self._turn_starts) < 1:
+            return
+        prefix_end = self._turn_starts[0]
+        keep_from = len(self._turn_starts)
+        for idx, start in enumerate(self._turn_starts):
+            if prefix_end + len(transcript) - start + incoming <= self.max_cached_tokens:
+                keep_from = idx
+                break
+        cut = self._turn_starts[keep_from] if keep_from < len(self._turn_starts) else len(transcript)
+        kept = transcript[:prefix_end] + transcript[cut:]
+        shift = cut - prefix_end
+        self._turn_starts = [start - shift for start in self._turn_starts[keep_from:]]
+        self.history = self.history[keep_from:]
+        # Positions changed, so the cache is rebuilt from the kept transcript on the next forward
+        self._past = None
+        self._cached_ids = []
+        self._pending_ids = kept
+
+    def chat(
+        self,
+        message: str,
+        max_new_tokens: int = 256,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        top_k: int = 50,
+        on_token: Optional[Callable[[int], None]] = None,
+    ) -> str:
+        """Add a user message and generate the assistant reply"""
+        with self.lock:
+            first = not self.transcript_ids
+            turn_text = self.template.turn_text(message, first)
+            new_ids = self.tokenizer(turn_text, add_special_tokens=first)["input_ids"]
+            self._fit(len(new_ids) + max_new_tokens)
+
+            # The system prefix is never dropped, so turns start after it
+            system_ids = 0
+            if first and self.template.system:
+                system_ids = len(self.tokenizer(self.template.system, add_special_tokens=True)["input_ids"])
+            self._turn_starts.append(len(self.transcript_ids) + system_ids)
+
+            params = {
+                "temperatures": torch.tensor([temperature], dtype=torch.float32),
+                "top_ps": torch.tensor([top_p], dtype=torch.float32),
+                "top_ks": torch.tensor([top_k], dtype=torch.long),
+            }
+            generated: List[int] = []
+            with torch.no_grad():
+                logits = self._forward(self._pending_ids + new_ids)
+                self._pending_ids = []
+                while True:
+                    device_params = {key: value.to(logits.device) for key, value in params.items()}
+                    token = int(sample_next_tokens(logits, **device_params)[0])
+                    generated.append(token)
+                    if on_token is not None:
+                        on_token(token)
+                    if token in self.eos_token_ids or len(generated) >= max_new_tokens:
+                        # Fed with the next user turn instead of costing an extra step now
+                        self._pending_ids = [token]
+                        break
+                    logits = self._forward([token])
+
+            response = self.tokenizer.decode(generated, skip_special_tokens=True).strip()
+            self.history.append({"user": message, "assistant": response})
+            self.last_active = time.time()
+            return response
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "session_id": self.session_id,
+            "turns": len(self.history),
+            "cached_tokens": self.cached_tokens,
+            "max_cached_tokens": self.max_cached_tokens,
+            "cache_bytes": self.cache_bytes(),
+            "prefill_tokens": self.prefill_tokens,
+            "created_at": self.created_at,
+            "last_active": self.last_active,
+        }
+
+
+class ChatSessionManager:
+    """Registry of live sessions with idle and count-based eviction"""
+
+    def __init__(self, idle_timeout: float = 900.0, max_sessions: int = 32, max_cached_tokens: int = 4096):
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.max_cached_tokens = max_cached_tokens
+        self._sessions: Dict[str, ChatSession] = {}
+        self._owners: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def create(self, owner: Any, template: Optional[ChatTemplate] = None) -> ChatSession:
+        """Open a session on ``owner`` (an object with ``model`` and ``tokenizer``)"""
+        session = ChatSession(
+            owner.model,
+            owner.tokenizer,
+            template=template,
+            max_cached_tokens=self.max_cached_tokens,
+        )
+        with self._lock:
+            self._evict_idle_locked()
+            while len(self._sessions) >= self.max_sessions:
+                oldest = min(self._sessions.values(), key=lambda s: s.last_active)
+                self._drop_locked(oldest.session_id)
+            self._sessions[session.session_id] = session
+            self._owners[session.session_id] = owner
+        return session
+
+    def get(self, session_id: str) -> ChatSession:
+        with self._lock:
+            self._evict_idle_locked()
+            return self._sessions[session_id]
+
+    def owner(self, session_id: str) -> Any:
+        """The object a live session was opened on"""
+        with self._lock:
+            return self._owners[session_id]
+
+    def close(self, session_id: str) -> bool:
+        with self._lock:
+            return self._drop_locked(session_id)
+
+    def close_for_owner(self, owner: Any) -> int:
+        """Close every session bound to ``owner`` (e.g. when its model is unloaded)"""
+        with self._lock:
+            ids = [sid for sid, o in self._owners.items() if o is owner]
+            for sid in ids:
+                self._drop_locked(sid)
+        return len(ids)
+
+    def list(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            self._evict_idle_locked()
+            return [session.info() for session in self._sessions.values()]
+
+    def _drop_locked(self, session_id: str) -> bool:
+        session = self._sessions.pop(session_id, None)
+        self._owners.pop(session_id, None)
+        if session is None:
+            return False
+        session.reset()
+        return True
+
+    def _evict_idle_locked(self) -> None:
+        cutoff = time.time() - self.idle_timeout
+        for sid in [sid for sid, s in self._sessions.items() if s.last_active < cutoff and not s.lock.locked()]:
+            self._drop_locked(sid)
@@ -0,0 +1,217 @@
+import logging
+import math
+import random
+import time
+from typing import Dict, List, Tuple
+
+import torch
+import torch.nn.functional as F
+from datasets import Dataset
+
+logger = logging.getLogger(__name__)
+
+PRUNE_STRATEGIES = ("drop_easy", "downweight", "stratified")
+LOSS_WEIGHT_COLUMN = "loss_weight"
+
+
+def _pad_batch(sequences: List[List[int]], pad_value: int) -> torch.Tensor:
+    width = max(len(seq) for seq in sequences)
+    return torch.tensor(
+        [list(seq) + [pad_value] * (width - len(seq)) for seq in sequences],
+        dtype=torch.long,
+    )
+
+
+def score_example_losses(
+    model: torch.nn.Module,
+    dataset: Dataset,
+    pad_token_id: int,
+    batch_size: int = 8,
+) -> List[float]:
+    """
+    Compute the mean token loss of every example without tracking gradients.
+
+    Examples are scored in length-sorted batches so padding stays small; the
+    returned list follows the original dataset order.
+
+    Args:
+        model: Causal LM (optionally wrapped with a PEFT adapter) used for scoring
+        dataset: Tokenized dataset with ``input_ids`` and ``attention_mask`` columns
+        pad_token_id: Token id used to right-pad each batch
+        batch_size: Number of examples per forward pass
+
+    Returns:
+        Per-example mean negative log-likelihood
+    """
+    input_ids = dataset["input_ids"]
+    attention = dataset["attention_mask"]
+    lengths = [int(sum(mask)) for mask in attention]
+    order = sorted(range(len(input_ids)), key=lambda idx: lengths[idx])
+    losses = [0.0] * len(input_ids)
+
+    device = next(model.parameters()).device
+    was_training = model.training
+    model.eval()
+    try:
+        with torch.no_grad():
+            for start in range(0, len(order), batch_size):
+                batch_idx = order[start:start + batch_size]
+                # Trim the per-map padding added at tokenization time
+                ids = [input_ids[i][:max(lengths[i], 1)] for i in batch_idx]
+                mask = [attention[i][:max(lengths[i], 1)] for i in batch_idx]
+                ids_tensor = _pad_batch(ids, pad_token_id).to(device)
+                mask_tensor = _pad_batch(mask, 0).to(device)
+
+                logits = model(input_ids=ids_tensor, attention_mask=mask_tensor).logits
+                shift_logits = logits[:, :-1, :].float()
+                shift_labels = ids_tensor[:, 1:]
+                shift_mask = mask_tensor[:, 1:].float()
+
+                token_loss = F.cross_entropy(
+                    shift_logits.reshape(-1, shift_logits.size(-1)),
+                    shift_labels.reshape(-1),
+                    reduction="none",
+                ).view(shift_labels.shape)
+                per_example = (token_loss * shift_mask).sum(dim=1) / shift_mask.sum(dim=1).clamp(min=1.0)
+
+                for idx, value in zip(batch_idx, per_example.tolist()):
+                    losses[idx] = value
+    finally:
+        if was_training:
+            model.train()
+
+    return losses
+
+
+def _quantile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return float("nan")
+    position = q * (len(sorted_values) - 1)
+    lower = math.floor(position)
+    upper = math.ceil(position)
+    if lower == upper:
+        return sorted_values[lower]
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def _loss_summary(values: List[float]) -> Dict[str, float]:
+    ordered = sorted(values)
+    if not ordered:
+        return {}
+    return {
+        "mean": sum(ordered) / len(ordered),
+        "min": ordered[0],
+        "p25": _quantile(ordered, 0.25),
+        "median": _quantile(ordered, 0.5),
+        "p75": _quantile(ordered, 0.75),
+        "max": ordered[-1],
+    }
+
+
+def prune_by_loss(
+    dataset: Dataset,
+    losses: List[float],
+    strategy: str = "drop_easy",
+    fraction: float = 0.2,
+    easy_weight: float = 0.1,
+    num_strata: int = 10,
+    seed: int = 42,
+) -> Tuple[Dataset, Dict]:
+    """
+    Drop, downweight or stratify examples according to their scored loss.
+
+    Args:
+        dataset: Tokenized training dataset
+        losses: Per-example losses aligned with ``dataset``
+        strategy: One of ``drop_easy``, ``downweight`` or ``stratified``
+        fraction: Share of examples treated as easy (``drop_easy``/``downweight``)
+            or removed overall (``stratified``)
+        easy_weight: Loss weight given to easy examples with ``downweight``
+        num_strata: Number of loss quantile bins used by ``stratified``
+        seed: Random seed for stratified sampling
+
+    Returns:
+        Tuple of the resulting dataset and a statistics dictionary
+    """
+    if strategy not in PRUNE_STRATEGIES:
+        raise ValueError(f"Unknown prune strategy '{strategy}'. Expected one of {PRUNE_STRATEGIES}")
+    if not 0.0 <= fraction < 1.0:
+        raise ValueError(f"prune_fraction must be in [0, 1), got {fraction}")
+    if len(losses) != len(dataset):
+        raise ValueError(f"Got {len(losses)} losses for {len(dataset)} examples")
+
+    total = len(dataset)
+    order = sorted(range(total), key=lambda idx: losses[idx])
+    num_easy = int(total * fraction)
+    threshold = losses[order[num_easy - 1]] if num_easy > 0 else None
+
+    if strategy == "drop_easy":
+        keep = sorted(order[num_easy:])
+        result = dataset.select(keep)
+    elif strategy == "downweight":
+        easy = set(order[:num_easy])
+        keep = list(range(total))
+        weights = [easy_weight if idx in easy else 1.0 for idx in keep]
+        result = dataset.add_column(LOSS_WEIGHT_COLUMN, weights)
+    else:
+        rng = random.Random(seed)
+        strata = max(1, min(num_strata, total))
+        keep = []
+        for stratum in range(strata):
+            members = order[stratum * total // strata:(stratum + 1) * total // strata]
+            quota = int(round(len(members) * (1.0 - fraction)))
+            keep.extend(rng.sample(members, quota))
+        keep.sort()
+        result = dataset.select(keep)
+
+    stats = {
+        "strategy": strategy,
+        "fraction": fraction,
+        "examples_before": total,
+        "examples_after": len(result),
+        "examples_dropped": total - len(result),
+        "easy_threshold": threshold,
+        "loss_all": _loss_summary(losses),
+        "loss_kept": _loss_summary([losses[idx] for idx in keep]),
+    }
+    if strategy == "downweight":
+        stats["examples_downweighted"] = num_easy
+        stats["easy_weight"] = easy_weight
+    if strategy == "stratified":
+        stats["num_strata"] = strata
+
+    return result, stats
+
+
+def score_and_prune(
+    model: torch.nn.Module,
+    dataset: Dataset,
+    pad_token_id: int,
+    strategy: str = "drop_easy",
+    fraction: float = 0.2,
+    batch_size: int = 8,
+    easy_weight: float = 0.1,
+    num_strata: int = 10,
+    seed: int = 42,
+) -> Tuple[Dataset, Dict]:
+    """Score ``dataset`` with ``model`` and apply :func:`prune_by_loss`."""
+    started = time.perf_counter()
+    losses = score_example_losses(model, dataset, pad_token_id=pad_token_id, batch_size=batch_size)
+    scoring_seconds = time.perf_counter() - started
+
+    pruned, stats = prune_by_loss(
+        dataset,
+        losses,
+        strategy=strategy,
+        fraction=fraction,
+        easy_weight=easy_weight,
+        num_strata=num_strata,
+        seed=seed,
+    )
+    stats["scoring_seconds"] = scoring_seconds
+    stats["scoring_batch_size"] = batch_size
+    logger.info(
+        f"Loss pruning ({strategy}) kept {stats['examples_after']}/{stats['examples_before']} examples "
+        f"after scoring for {scoring_seconds:.1f}s"
+    )
+    return pruned, stats
@@ -0,0 +1,254 @@
+"""
+Lazy, weighted interleaving of several JSON/JSONL datasets.
+
+Sources are streamed from disk and sampled according to their weights with a
+seeded RNG, so a mixture of large files never has to be concatenated or held
+in memory. Each source carries on across mixture passes, restarts when
+exhausted, and its completed passes are tracked as per-source epochs.
+"""
+import itertools
+import json
+import logging
+import random
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Union
+
+from torch.utils.data import IterableDataset
+from transformers import TrainerCallback
+
+logger = logging.getLogger(__name__)
+
+_DECODER = json.JSONDecoder()
+
+
+@dataclass
+class MixtureSource:
+    """A dataset file and its relative sampling weight"""
+    path: str
+    weight: float = 1.0
+    name: Optional[str] = None
+    num_examples: Optional[int] = None
+    max_examples: Optional[int] = None
+    epochs_completed: int = 0
+    examples_drawn: int = 0
+
+    def label(self) -> str:
+        return self.name or self.path
+
+    def examples(self) -> Iterator[Dict]:
+        """Stream the source, truncated to ``max_examples`` when set"""
+        return itertools.islice(iter_json_examples(self.path), self.max_examples)
+
+
+def parse_mixture_sources(value: Union[str, Sequence[Any]]) -> List[MixtureSource]:
+    """
+    Normalize mixture sources given as JSON, ``path:weight`` strings or dicts.
+
+    Examples of accepted input::
+
+        '[{"path": "data/a.json", "weight": 3}, {"path": "data/b.jsonl"}]'
+        ["data/a.json:3", "data/b.jsonl:1"]
+    """
+    if isinstance(value, str):
+        value = json.loads(value) if value.strip().startswith("[") else [value]
+
+    sources = []
+    for item in value:
+        if isinstance(item, MixtureSource):
+            sources.append(item)
+        elif isinstance(item, dict):
+            sources.append(MixtureSource(path=item["path"], weight=float(item.get("weight", 1.0)), name=item.get("name")))
+        else:
+            path, sep, weight = str(item).rpartition(":")
+            if sep and path and weight.replace(".", "", 1).isdigit():
+                sources.append(MixtureSource(path=path, weight=float(weight)))
+            else:
+                sources.append(MixtureSource(path=str(item)))
+
+    if not sources:
+        raise ValueError("At least one dataset source is required")
+    for source in sources:
+        if source.weight <= 0:
+            raise ValueError(f"Sampling weight for {source.path} must be positive, got {source.weight}")
+    return sources
+
+
+def _iter_json_array(handle, chunk_size: int) -> Iterator[Dict]:
+    buffer = ""
+    started = False
+    while True:
+        chunk = handle.read(chunk_size)
+        buffer += chunk
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if not started and pos < len(buffer):
+                if buffer[pos] != "[":
+                    raise ValueError("Expected a JSON array of examples")
+                started = True
+                pos += 1
+                continue
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+            try:
+                example, end = _DECODER.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if not chunk:
+                    if buffer[pos:].strip():
+                        raise
+                    return
+                break
+            yield example
+            pos = end
+        buffer = buffer[pos:]
+        if not chunk:
+            return
+
+
+def iter_json_examples(path: str, chunk_size: int = 1 << 20) -> Iterator[Dict]:
+    """
+    Stream examples from a ``.jsonl`` file or a top-level JSON array.
+
+    Files using the ``{"data": [...]}`` layout cannot be streamed and are
+    loaded whole, matching :func:`prepare_dataset.load_json_dataset`.
+    """
+    with open(path, "r", encoding="utf-8") as handle:
+        if path.endswith(".jsonl"):
+            for line in handle:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+            return
+
+        head = handle.read(1)
+        while head and head.isspace():
+            head = handle.read(1)
+        handle.seek(0)
+        if head == "{":
+            data = json.load(handle)
+            yield from data.get("data", [])
+            return
+        yield from _iter_json_array(handle, chunk_size)
+
+
+class WeightedDatasetMixture(IterableDataset):
+    """Iterable dataset that interleaves sources by weight with deterministic seeding"""
+
+    def __init__(
+        self,
+        sources: Sequence[MixtureSource],
+        transform: Optional[Callable[[Dict], Dict]] = None,
+        samples_per_epoch: Optional[int] = None,
+        seed: int = 42,
+        shuffle_buffer: int = 1000,
+    ):
+        """
+        Args:
+            sources: Dataset sources with sampling weights
+            transform: Function turning a raw example into model features
+            samples_per_epoch: Examples yielded per pass (defaults to the total source size)
+            seed: Base seed; each pass uses ``seed + epoch``
+            shuffle_buffer: Size of the per-source shuffle buffer (0 disables shuffling)
+        """
+        super().__init__()
+        self.sources = list(sources)
+        self.transform = transform
+        self.seed = seed
+        self.shuffle_buffer = shuffle_buffer
+        self.epoch = 0
+        self._iterators: List[Optional[Iterator[Dict]]] = [None] * len(self.sources)
+
+        if samples_per_epoch is None:
+            for source in self.sources:
+                if source.num_examples is None:
+                    source.num_examples = sum(1 for _ in source.examples())
+            samples_per_epoch = sum(source.num_examples for source in self.sources)
+        if samples_per_epoch <= 0:
+            raise ValueError("Dataset mixture is empty")
+        self.samples_per_epoch = samples_per_epoch
+
+        total_weight = sum(source.weight for source in self.sources)
+        self.probabilities = [source.weight / total_weight for source in self.sources]
+
+    def __len__(self) -> int:
+        return self.samples_per_epoch
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def _shuffled(self, examples: Iterator[Dict], rng: random.Random) -> Iterator[Dict]:
+        if self.shuffle_buffer <= 1:
+            yield from examples
+            return
+        buffer: List[Dict] = []
+        for example in examples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(example)
+                continue
+            idx = rng.randrange(len(buffer))
+            yield buffer[idx]
+            buffer[idx] = example
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def _next_example(self, source_idx: int, rng: random.Random) -> Dict:
+        source = self.sources[source_idx]
+        for _ in range(2):
+            if self._iterators[source_idx] is None:
+                source_rng = random.Random(rng.random())
+                self._iterators[source_idx] = self._shuffled(source.examples(), source_rng)
+            try:
+                example = next(self._iterators[source_idx])
+                source.examples_drawn += 1
+                return example
+            except StopIteration:
+                source.epochs_completed += 1
+                self._iterators[source_idx] = None
+        raise ValueError(f"Dataset source is empty: {source.path}")
+
+    def __iter__(self) -> Iterator[Dict]:
+        rng = random.Random(self.seed + self.epoch)
+        # Sources resume where the previous pass stopped, so a large low-weight
+        # source is eventually read in full; each restart reshuffles it from the
+        # seeded pass rng, which keeps runs reproducible
+        indices = list(range(len(self.sources)))
+        for _ in range(self.samples_per_epoch):
+            source_idx = rng.choices(indices, weights=self.probabilities)[0]
+            example = self._next_example(source_idx, rng)
+            yield self.transform(example) if self.transform else example
+        self.epoch += 1
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Per-source sampling statistics"""
+        return {
+            source.label(): {
+                "weight": source.weight,
+                "probability": probability,
+                "num_examples": source.num_examples,
+                "examples_drawn": source.examples_drawn,
+                "epochs_completed": source.epochs_completed,
+            }
+            for source, probability in zip(self.sources, self.probabilities)
+        }
+
+
+class MixtureStatsCallback(TrainerCallback):
+    """Log per-source epoch accounting at the end of every epoch"""
+
+    def __init__(self, mixture: WeightedDatasetMixture, log: Optional[logging.Logger] = None):
+        self.mixture = mixture
+        self.log = log or logger
+
+    def _report(self, label: str):
+        for name, stats in self.mixture.stats().items():
+            self.log.info(
+                f"{label} source {name}: drawn={stats['examples_drawn']} "
+                f"epochs_completed={stats['epochs_completed']} p={stats['probability']:.3f}"
+            )
+
+    def on_epoch_end(self, args, state, control, **kwargs):
+        self._report(f"Epoch {state.epoch:.2f}")
+
+    def on_train_end(self, args, state, control, **kwargs):
+        self._report("Final")
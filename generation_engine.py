@@ -0,0 +1,446 @@
+"""
+Continuous batching for concurrent generation requests.
+
+A single background thread owns the model and runs one decode loop over every
+active request. New requests are prefilled and join the batch between decode
+steps; finished rows leave immediately, so a long generation never holds short
+ones hostage. Each row keeps its own sampling settings and token budget.
+"""
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Union
+
+import torch
+
+from cancellation import CANCELLED, CancellationStats, CancellationToken
+from kv_cache import (
+    LegacyCache,
+    cache_length,
+    concat_cache_rows,
+    from_legacy_cache,
+    pad_cache_left,
+    select_cache_rows,
+    slice_cache,
+    to_legacy_cache,
+)
+from multi_lora import NO_ADAPTER, has_multi_lora, set_adapter_indices
+from prefix_cache import PrefixKVCache
+from stop_sequences import StopSequenceMatcher, compile_stop_sequences, normalize_stop
+
+logger = logging.getLogger(__name__)
+
+
+def sample_next_tokens(
+    logits: torch.Tensor,
+    temperatures: torch.Tensor,
+    top_ps: torch.Tensor,
+    top_ks: torch.Tensor,
+) -> torch.Tensor:
+    """
+    Pick one token per row with per-row temperature, top-p and top-k.
+
+    Rows with temperature <= 0 decode greedily; top_k <= 0 disables top-k.
+    """
+    logits = logits.float()
+    greedy = logits.argmax(dim=-1)
+    if bool((temperatures <= 0).all()):
+        return greedy
+
+    scaled = logits / temperatures.clamp(min=1e-5).unsqueeze(-1)
+    sorted_logits, sorted_indices = scaled.sort(dim=-1, descending=True)
+    ranks = torch.arange(sorted_logits.shape[-1], device=logits.device).unsqueeze(0)
+    k = torch.where(top_ks > 0, top_ks, torch.full_like(top_ks, sorted_logits.shape[-1]))
+    sorted_logits = sorted_logits.masked_fill(ranks >= k.unsqueeze(-1), float("-inf"))
+
+    probs = sorted_logits.softmax(dim=-1)
+    # Drop tokens once the mass before them already exceeds top_p (always keep the first)
+    exceeded = (probs.cumsum(dim=-1) - probs) > top_ps.unsqueeze(-1)
+    probs = probs.masked_fill(exceeded, 0.0)
+    choice = torch.multinomial(probs / probs.sum(dim=-1, keepdim=True), num_samples=1)
+    sampled = sorted_indices.gather(-1, choice).squeeze(-1)
+    return torch.where(temperatures > 0, sampled, greedy)
+
+
+@dataclass
+class GenerationRequest:
+    """One queued or active generation"""
+    prompt_ids: List[int]
+    max_new_tokens: int
+    temperature: float = 0.7
+    top_p: float = 0.9
+    top_k: int = 50
+    on_token: Optional[Callable[[int], None]] = None
+    adapter: Optional[str] = None
+    adapter_slot: Optional[int] = None
+    stop_matcher: Optional[StopSequenceMatcher] = None
+    stopped: bool = False
+    cancel: Optional[CancellationToken] = None
+    future: Future = field(default_factory=Future)
+    generated: List[int] = field(default_factory=list)
+    submitted_at: float = field(default_factory=time.time)
+    first_token_at: Optional[float] = None
+
+    @property
+    def position(self) -> int:
+        """Position id of the last generated token"""
+        return len(self.prompt_ids) + len(self.generated) - 1
+
+    @property
+    def cancelled(self) -> bool:
+        return self.future.cancelled() or (self.cancel is not None and self.cancel.cancelled)
+
+
+class ContinuousBatchingEngine:
+    """Token-level scheduler merging concurrent requests into one decode batch"""
+
+    def __init__(
+        self,
+        model: Any,
+        tokenizer: Any,
+        max_batch_size: int = 8,
+        idle_timeout: float = 0.1,
+        prefix_cache: Optional[PrefixKVCache] = None,
+        model_lock: Optional[threading.Lock] = None,
+        adapter_bank: Optional[Any] = None,
+        cancellation_stats: Optional[CancellationStats] = None,
+    ):
+        """
+        Args:
+            model: Causal LM called directly with ``past_key_values``
+            tokenizer: Tokenizer used to encode prompts and decode outputs
+            max_batch_size: Maximum number of concurrently decoding requests
+            idle_timeout: Seconds to block waiting for work when the batch is empty
+            prefix_cache: Shared prompt-prefix KV cache consulted during prefill
+            model_lock: Lock held around each step when other code may reconfigure the model
+            adapter_bank: :class:`adapter_serving.LoraAdapterBank` for per-row adapters
+            cancellation_stats: Shared counters for cancelled and timed-out rows
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.prefix_cache = prefix_cache
+        self.model_lock = model_lock
+        self.adapter_bank = adapter_bank
+        self.cancellation_stats = cancellation_stats or CancellationStats()
+        self.max_batch_size = max_batch_size
+        self.idle_timeout = idle_timeout
+        eos = tokenizer.eos_token_id
+        self.eos_token_ids = set(eos if isinstance(eos, (list, tuple)) else [eos])
+
+        self._queue: "queue.Queue[GenerationRequest]" = queue.Queue()
+        self._rows: List[GenerationRequest] = []
+        self._cache: Optional[LegacyCache] = None
+        self._mask: Optional[torch.Tensor] = None
+
+        self.tokens_generated = 0
+        self.decode_steps = 0
+        self.started_at = time.time()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="generation-engine", daemon=True)
+        self._thread.start()
+
+    @property
+    def device(self) -> torch.device:
+        return next(self.model.parameters()).device
+
+    def submit(
+        self,
+        prompt: str,
+        max_new_tokens: int = 256,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        top_k: int = 50,
+        on_token: Optional[Callable[[int], None]] = None,
+        adapter: Optional[str] = None,
+        stop: Optional[Union[str, Sequence[str]]] = None,
+        timeout: Optional[float] = None,
+        cancel: Optional[CancellationToken] = None,
+    ) -> GenerationRequest:
+        """
+        Queue a prompt; ``request.future`` resolves to the decoded response.
+
+        ``adapter`` names a registry LoRA for this row only; rows with different
+        adapters still share each decode step. ``stop`` strings finish the row
+        early and are trimmed from its response. The row leaves the batch at the
+        next step once ``request.future`` or ``cancel`` is cancelled, or after
+        ``timeout`` seconds (the future then raises ``TimeoutError``).
+        """
+        if self._stopped.is_set():
+            raise RuntimeError("Generation engine has been stopped")
+        if adapter and self.adapter_bank is None:
+            raise ValueError("This engine has no adapter bank")
+        request = GenerationRequest(
+            prompt_ids=self.tokenizer(prompt)["input_ids"],
+            max_new_tokens=max(1, max_new_tokens),
+            temperature=temperature,
+            top_p=top_p,
+            top_k=top_k,
+            on_token=on_token,
+            adapter=adapter,
+            cancel=cancel or (CancellationToken(timeout) if timeout else None),
+        )
+        stops = normalize_stop(stop)
+        if stops:
+            request.stop_matcher = compile_stop_sequences(self.tokenizer, stops)
+        if adapter:
+            # Pins the slot until the request completes
+            request.adapter_slot = self.adapter_bank.acquire(adapter)
+        self._queue.put(request)
+        return request
+
+    def generate(self, prompt: str, **kwargs) -> str:
+        """Blocking convenience wrapper around :meth:`submit`"""
+        return self.submit(prompt, **kwargs).future.result()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join(timeout=5)
+        error = RuntimeError("Generation engine stopped")
+        for request in self._rows:
+            self._complete(request, error=error)
+        while True:
+            try:
+                request = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self._complete(request, error=error)
+        self._rows, self._cache, self._mask = [], None, None
+
+    def stats(self) -> Dict[str, Any]:
+        elapsed = max(time.time() - self.started_at, 1e-6)
+        return {
+            "active": len(self._rows),
+            "queued": self._queue.qsize(),
+            "max_batch_size": self.max_batch_size,
+            "tokens_generated": self.tokens_generated,
+            "decode_steps": self.decode_steps,
+            "tokens_per_second": self.tokens_generated / elapsed,
+            "prefix_cache": self.prefix_cache.stats() if self.prefix_cache is not None else None,
+            "cancellation": self.cancellation_stats.to_dict(),
+        }
+
+    # ------------------------------------------------------------------ loop
+
+    def _run(self) -> None:
+        with torch.no_grad():
+            while not self._stopped.is_set():
+                try:
+                    self._admit()
+                    if self._rows:
+                        if self.model_lock is not None:
+                            with self.model_lock:
+                                self._decode_step()
+                        else:
+                            self._decode_step()
+                except Exception as exc:  # keep serving after a failed step
+                    logger.exception("Generation step failed")
+                    for request in self._rows:
+                        self._complete(request, error=exc)
+                    self._rows, self._cache, self._mask = [], None, None
+
+    def _admit(self) -> None:
+        incoming: List[GenerationRequest] = []
+        free_slots = self.max_batch_size - len(self._rows)
+        if free_slots <= 0:
+            return
+        if not self._rows:
+            try:
+                incoming.append(self._queue.get(timeout=self.idle_timeout))
+            except queue.Empty:
+                return
+        while len(incoming) < free_slots:
+            try:
+                incoming.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        for request in incoming:
+            if request.cancelled:
+                # Never prefilled, so the whole prompt and budget are saved
+                self.cancellation_stats.record(
+                    self._cancel_reason(request), request.max_new_tokens, skipped_prefill_tokens=len(request.prompt_ids)
+                )
+                self._complete(request, error=self._cancel_error(request))
+                continue
+            try:
+                if self.model_lock is not None:
+                    with self.model_lock:
+                        cache = self._prefill(request)
+                else:
+                    cache = self._prefill(request)
+            except Exception as exc:
+                self._complete(request, error=exc)
+                continue
+            if not self._finished(request):
+                self._join(request, cache)
+
+    def _prefill(self, request: GenerationRequest) -> LegacyCache:
+        prompt_ids = request.prompt_ids
+        past, start = None, 0
+        # Cached prefixes hold base-model KV states, which differ under an adapter
+        use_prefix_cache = self.prefix_cache is not None and request.adapter is None
+        if use_prefix_cache:
+            matched, cached = self.prefix_cache.lookup(prompt_ids)
+            start = max(0, min(matched, len(prompt_ids) - 1))
+            if start:
+                past = from_legacy_cache(slice_cache(cached, 0, start))
+        input_ids = torch.tensor([prompt_ids[start:]], dtype=torch.long, device=self.device)
+        with self._routed_adapters([request]):
+            outputs = self.model(input_ids=input_ids, past_key_values=past, use_cache=True)
+        token = self._sample(outputs.logits[:, -1, :], [request])[0]
+        self._emit(request, token)
+        self._check_stops([request])
+        cache = to_legacy_cache(outputs.past_key_values)
+        if use_prefix_cache:
+            self.prefix_cache.insert(prompt_ids, cache)
+        return cache
+
+    def _join(self, request: GenerationRequest, cache: LegacyCache) -> None:
+        row_mask = torch.ones(1, cache_length(cache), dtype=torch.long, device=self.device)
+        if self._cache is None:
+            self._cache, self._mask, self._rows = cache, row_mask, [request]
+            return
+        width = max(cache_length(self._cache), cache_length(cache))
+        self._cache = concat_cache_rows([pad_cache_left(self._cache, width), pad_cache_left(cache, width)])
+        self._mask = torch.cat(
+            [
+                torch.nn.functional.pad(self._mask, (width - self._mask.shape[1], 0)),
+                torch.nn.functional.pad(row_mask, (width - row_mask.shape[1], 0)),
+            ],
+            dim=0,
+        )
+        self._rows.append(request)
+
+    def _decode_step(self) -> None:
+        device = self.device
+        input_ids = torch.tensor([[r.generated[-1]] for r in self._rows], dtype=torch.long, device=device)
+        position_ids = torch.tensor([[r.position] for r in self._rows], dtype=torch.long, device=device)
+        self._mask = torch.cat([self._mask, self._mask.new_ones(len(self._rows), 1)], dim=1)
+
+        with self._routed_adapters(self._rows):
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=self._mask,
+                position_ids=position_ids,
+                past_key_values=from_legacy_cache(self._cache),
+                use_cache=True,
+            )
+        self._cache = to_legacy_cache(outputs.past_key_values)
+        self.decode_steps += 1
+
+        tokens = self._sample(outputs.logits[:, -1, :], self._rows)
+        for request, token in zip(self._rows, tokens):
+            self._emit(request, token)
+        self._check_stops(self._rows)
+        keep = [row_idx for row_idx, request in enumerate(self._rows) if not self._finished(request)]
+        if len(keep) < len(self._rows):
+            self._drop_finished(keep)
+
+    def _drop_finished(self, keep: List[int]) -> None:
+        if not keep:
+            self._rows, self._cache, self._mask = [], None, None
+            return
+        rows = torch.tensor(keep, dtype=torch.long, device=self._mask.device)
+        self._rows = [self._rows[idx] for idx in keep]
+        self._cache = select_cache_rows(self._cache, rows)
+        self._mask = self._mask.index_select(0, rows)
+        # Columns that are padding for every remaining row can go
+        leading = int((self._mask.cumsum(dim=1) == 0).sum(dim=1).min())
+        if leading:
+            self._cache = slice_cache(self._cache, leading)
+            self._mask = self._mask[:, leading:]
+
+    # --------------------------------------------------------------- helpers
+
+    def _sample(self, logits: torch.Tensor, requests: List[GenerationRequest]) -> List[int]:
+        device = logits.device
+        temperatures = torch.tensor([r.temperature for r in requests], dtype=torch.float32, device=device)
+        top_ps = torch.tensor([r.top_p for r in requests], dtype=torch.float32, device=device)
+        top_ks = torch.tensor([r.top_k for r in requests], dtype=torch.long, device=device)
+        return sample_next_tokens(logits, temperatures, top_ps, top_ks).tolist()
+
+    def _emit(self, request: GenerationRequest, token: int) -> None:
+        if request.first_token_at is None:
+            request.first_token_at = time.time()
+        request.generated.append(token)
+        self.tokens_generated += 1
+        if request.on_token is not None:
+            request.on_token(token)
+
+    def _check_stops(self, requests: List[GenerationRequest]) -> None:
+        """Flag rows ending in a stop sequence, one tensor comparison per distinct matcher"""
+        groups: Dict[int, List[GenerationRequest]] = {}
+        for request in requests:
+            if request.stop_matcher:
+                groups.setdefault(id(request.stop_matcher), []).append(request)
+        for group in groups.values():
+            hits = group[0].stop_matcher.match_sequences([r.generated for r in group])
+            for request, hit in zip(group, hits):
+                request.stopped = request.stopped or hit
+
+    def _finished(self, request: GenerationRequest) -> bool:
+        done = (
+            request.stopped
+            or request.generated[-1] in self.eos_token_ids
+            or len(request.generated) >= request.max_new_tokens
+        )
+        if not done and request.cancelled:
+            self.cancellation_stats.record(
+                self._cancel_reason(request), request.max_new_tokens - len(request.generated)
+            )
+            self._complete(request, error=self._cancel_error(request))
+            return True
+        if done:
+            text = self.tokenizer.decode(request.generated, skip_special_tokens=True)
+            if request.stop_matcher is not None:
+                text = request.stop_matcher.trim_text(text)
+            self._complete(request, result=text.strip())
+        return done
+
+    @staticmethod
+    def _cancel_reason(request: GenerationRequest) -> str:
+        if request.cancel is not None and request.cancel.reason:
+            return request.cancel.reason
+        return CANCELLED
+
+    @staticmethod
+    def _cancel_error(request: GenerationRequest) -> Optional[BaseException]:
+        # A cancelled future needs no result; a cancelled token reports why
+        if request.future.cancelled() or request.cancel is None:
+            return None
+        return request.cancel.error()
+
+    def _complete(self, request: GenerationRequest, result: Optional[str] = None, error: Optional[BaseException] = None) -> None:
+        """Resolve the future (unless already done) and unpin the request's adapter slot"""
+        if not request.future.done():
+            if error is not None:
+                request.future.set_exception(error)
+            else:
+                request.future.set_result(result)
+        if request.adapter_slot is not None:
+            self.adapter_bank.release(request.adapter_slot)
+            request.adapter_slot = None
+
+    @contextmanager
+    def _routed_adapters(self, requests: List[GenerationRequest]) -> Iterator[None]:
+        """
+        Point every multi-LoRA layer at each row's adapter slot (or none) for one forward pass.
+
+        The routing is cleared afterwards so forwards outside the engine never
+        see a stale per-row selection; callers hold ``model_lock``.
+        """
+        if self.adapter_bank is None or not has_multi_lora(self.model):
+            yield
+            return
+        set_adapter_indices(
+            self.model,
+            [NO_ADAPTER if r.adapter_slot is None else r.adapter_slot for r in requests],
+        )
+        try:
+            yield
+        finally:
+            set_adapter_indices(self.model, None)
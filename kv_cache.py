@@ -0,0 +1,84 @@
+"""
+Helpers for manipulating ``past_key_values`` outside of ``model.generate``.
+
+Everything works on the legacy layout (one tuple of ``[batch, heads, seq, dim]``
+tensors per layer); ``to_legacy_cache``/``from_legacy_cache`` convert to and
+from the ``Cache`` objects newer Transformers releases return.
+"""
+from typing import Any, Sequence, Tuple
+
+import torch
+
+LegacyCache = Tuple[Tuple[torch.Tensor, ...], ...]
+
+try:
+    from transformers import DynamicCache
+except ImportError:  # older transformers only know the tuple layout
+    DynamicCache = None
+
+
+def to_legacy_cache(past: Any) -> LegacyCache:
+    if hasattr(past, "to_legacy_cache"):
+        return past.to_legacy_cache()
+    return tuple(tuple(layer) for layer in past)
+
+
+def from_legacy_cache(legacy: LegacyCache) -> Any:
+    if DynamicCache is not None and hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(legacy)
+    return legacy
+
+
+def cache_length(legacy: LegacyCache) -> int:
+    return legacy[0][0].shape[-2] if legacy else 0
+
+
+def cache_nbytes(legacy: LegacyCache) -> int:
+    return sum(t.numel() * t.element_size() for layer in legacy for t in layer)
+
+
+def slice_cache(legacy: LegacyCache, start: int = 0, end: int = None) -> LegacyCache:
+    """Keep sequence positions ``[start, end)`` of every layer"""
+    return tuple(tuple(t[..., start:end, :] for t in layer) for layer in legacy)
+
+
+def clone_cache(legacy: LegacyCache) -> LegacyCache:
+    return tuple(tuple(t.clone() for t in layer) for layer in legacy)
+
+
+def pad_cache_left(legacy: LegacyCache, length: int) -> LegacyCache:
+    """Left-pad every layer with zeros up to ``length`` positions"""
+    pad = length - cache_length(legacy)
+    if pad <= 0:
+        return legacy
+    padded = []
+    for layer in legacy:
+        tensors = []
+        for t in layer:
+            zeros = t.new_zeros(t.shape[:-2] + (pad, t.shape[-1]))
+            tensors.append(torch.cat([zeros, t], dim=-2))
+        padded.append(tuple(tensors))
+    return tuple(padded)
+
+
+def concat_cache_rows(caches: Sequence[LegacyCache]) -> LegacyCache:
+    """Stack caches of equal length along the batch dimension"""
+    return tuple(
+        tuple(torch.cat([cache[layer_idx][t_idx] for cache in caches], dim=0) for t_idx in range(len(caches[0][layer_idx])))
+        for layer_idx in range(len(caches[0]))
+    )
+
+
+def select_cache_rows(legacy: LegacyCache, rows: torch.Tensor) -> LegacyCache:
+    return tuple(tuple(t.index_select(0, rows.to(t.device)) for t in layer) for layer in legacy)
+
+
+def crop_cache(past: Any, length: int) -> Any:
+    """Drop every position from ``length`` onwards, keeping the cache's own type"""
+    if past is None:
+        return None
+    if hasattr(past, "crop"):
+        past.crop(length)
+        return past
+    legacy = slice_cache(to_legacy_cache(past), 0, length)
+    return from_legacy_cache(legacy) if not isinstance(past, tuple) else legacy
@@ -0,0 +1,119 @@
+"""
+Memory helpers for long training runs: OOM detection, cleanup and a watcher
+callback that requests a protective checkpoint when memory gets tight.
+"""
+import gc
+import logging
+import os
+from typing import Dict, Optional
+
+import torch
+from transformers import TrainerCallback
+
+try:
+    import psutil
+    PSUTIL_AVAILABLE = True
+except ImportError:
+    PSUTIL_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+_CGROUP_LIMIT_FILES = (
+    "/sys/fs/cgroup/memory.max",
+    "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+)
+
+
+def is_oom_error(exc: BaseException) -> bool:
+    """Return True for CUDA or host allocator out-of-memory errors"""
+    oom_type = getattr(torch.cuda, "OutOfMemoryError", None)
+    if oom_type is not None and isinstance(exc, oom_type):
+        return True
+    if isinstance(exc, RuntimeError):
+        message = str(exc).lower()
+        return "out of memory" in message or "can't allocate memory" in message
+    return False
+
+
+def free_memory() -> None:
+    """Release cached allocator blocks after an OOM"""
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def host_memory_limit() -> Optional[int]:
+    """Container memory limit if one is set, otherwise total RAM"""
+    for path in _CGROUP_LIMIT_FILES:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                raw = f.read().strip()
+        except OSError:
+            continue
+        if raw.isdigit() and int(raw) < (1 << 60):
+            return int(raw)
+    if PSUTIL_AVAILABLE:
+        return psutil.virtual_memory().total
+    return None
+
+
+def memory_snapshot() -> Dict[str, float]:
+    """Current process RSS and device memory usage, in bytes and as limit fractions"""
+    snapshot: Dict[str, float] = {}
+    if PSUTIL_AVAILABLE:
+        rss = psutil.Process(os.getpid()).memory_info().rss
+        snapshot["rss_bytes"] = rss
+        limit = host_memory_limit()
+        if limit:
+            snapshot["rss_fraction"] = rss / limit
+    if torch.cuda.is_available():
+        device = torch.cuda.current_device()
+        reserved = torch.cuda.memory_reserved(device)
+        total = torch.cuda.get_device_properties(device).total_memory
+        snapshot["device_reserved_bytes"] = reserved
+        snapshot["device_fraction"] = reserved / total if total else 0.0
+    return snapshot
+
+
+class MemoryGuardCallback(TrainerCallback):
+    """Trigger a checkpoint when RSS or device memory nears its limit"""
+
+    def __init__(
+        self,
+        threshold: float = 0.92,
+        cooldown_steps: int = 50,
+        log: Optional[logging.Logger] = None,
+    ):
+        """
+        Args:
+            threshold: Fraction of the memory limit that triggers a protective save
+            cooldown_steps: Minimum number of steps between protective saves
+            log: Logger used for warnings (defaults to this module's logger)
+        """
+        self.threshold = threshold
+        self.cooldown_steps = cooldown_steps
+        self.log = log or logger
+        self.baseline: Dict[str, float] = {}
+        self.last_save_step: Optional[int] = None
+        self.protective_saves = 0
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.baseline = memory_snapshot()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        snapshot = memory_snapshot()
+        pressure = max(snapshot.get("rss_fraction", 0.0), snapshot.get("device_fraction", 0.0))
+        if pressure < self.threshold:
+            return control
+        if self.last_save_step is not None and state.global_step - self.last_save_step < self.cooldown_steps:
+            return control
+
+        rss_growth = snapshot.get("rss_bytes", 0) - self.baseline.get("rss_bytes", 0)
+        self.log.warning(
+            f"Memory at {pressure:.1%} of limit on step {state.global_step} "
+            f"(RSS growth {rss_growth / (1024**2):.0f} MB); saving a protective checkpoint"
+        )
+        self.last_save_step = state.global_step
+        self.protective_saves += 1
+        control.should_save = True
+        return control
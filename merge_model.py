@@ -1,9 +1,10 @@
 import os
-import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoTokenizer
 from peft import PeftModel
 import fire
 
+from weight_loading import load_causal_lm
+
 def merge_model(
     base_model_name: str,
     adapter_model_path: str,
@@ -24,12 +25,13 @@ def merge_model(
         trust_remote_code (bool): Whether to trust remote code when loading models
     """
     print(f"Loading base model: {base_model_name}")
-    base_model = AutoModelForCausalLM.from_pretrained(
+    base_model, load_report = load_causal_lm(
         base_model_name,
-        torch_dtype=torch.float16,
-        device_map=device,
+        device=device,
+        torch_dtype="float16",
         trust_remote_code=trust_remote_code
     )
+    print(load_report.summary())
     
     print(f"Loading adapter model from: {adapter_model_path}")
     model = PeftModel.from_pretrained(
@@ -1,12 +1,13 @@
 import os
-import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoTokenizer
 from peft import PeftModel
 import fire
 import logging
 import sys
 from pathlib import Path
 
+from weight_loading import load_causal_lm
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -66,12 +67,13 @@ def merge_multiple_loras(
         
         try:
             # Load the base model
-            current_model = AutoModelForCausalLM.from_pretrained(
+            current_model, load_report = load_causal_lm(
                 base_model_name,
-                torch_dtype=torch.float16,
-                device_map=device,
+                device=device,
+                torch_dtype="float16",
                 trust_remote_code=trust_remote_code
             )
+            logging.info(load_report.summary())
         except Exception as e:
             logging.error(f"Failed to load base model: {str(e)}")
             raise
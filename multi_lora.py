@@ -0,0 +1,330 @@
+"""
+Stacked LoRA layers that route each batch row to its own adapter.
+
+Every wrapped linear keeps the A/B matrices of all adapters in one tensor
+(``[num_adapters, r, in]`` / ``[num_adapters, out, r]``). A forward pass runs
+the shared base projection once and adds each row's low-rank update through a
+batched gather, so several adapters can be trained or served together on the
+same frozen base model.
+"""
+import json
+import math
+import os
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Union
+
+import torch
+import torch.nn as nn
+
+DEFAULT_TARGET_MODULES = ["q_proj", "k_proj", "v_proj", "o_proj"]
+NO_ADAPTER = -1
+
+
+class MultiLoraLinear(nn.Module):
+    """Linear layer with a bank of LoRA adapters selected per batch row"""
+
+    def __init__(
+        self,
+        base_layer: nn.Module,
+        module_name: str,
+        num_adapters: int,
+        r: int,
+        lora_alpha: float,
+        lora_dropout: float = 0.0,
+        dtype: torch.dtype = torch.float32,
+    ):
+        super().__init__()
+        self.base_layer = base_layer
+        self.module_name = module_name
+        self.r = r
+        in_features = base_layer.in_features
+        out_features = base_layer.out_features
+        device = next(base_layer.parameters()).device
+
+        self.lora_A = nn.Parameter(torch.empty(num_adapters, r, in_features, dtype=dtype, device=device))
+        self.lora_B = nn.Parameter(torch.zeros(num_adapters, out_features, r, dtype=dtype, device=device))
+        for idx in range(num_adapters):
+            nn.init.kaiming_uniform_(self.lora_A.data[idx], a=math.sqrt(5))
+        self.register_buffer(
+            "scaling",
+            torch.full((num_adapters,), lora_alpha / r, dtype=torch.float32, device=device),
+            persistent=False,
+        )
+        self.lora_dropout = nn.Dropout(p=lora_dropout) if lora_dropout > 0 else nn.Identity()
+
+        self.adapter_indices: Optional[torch.Tensor] = None
+        self.uniform_index: Optional[int] = None
+
+    @property
+    def in_features(self) -> int:
+        return self.base_layer.in_features
+
+    @property
+    def out_features(self) -> int:
+        return self.base_layer.out_features
+
+    @property
+    def num_adapters(self) -> int:
+        return self.lora_A.shape[0]
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        result = self.base_layer(x)
+        if self.adapter_indices is None and self.uniform_index is None:
+            return result
+        if self.uniform_index == NO_ADAPTER:
+            return result
+
+        lora_input = self.lora_dropout(x).to(self.lora_A.dtype)
+        if self.uniform_index is not None:
+            # Whole batch uses one adapter: plain matmuls, no gather needed
+            slot = self.uniform_index
+            hidden = lora_input @ self.lora_A[slot].t()
+            delta = (hidden @ self.lora_B[slot].t()) * self.scaling[slot]
+            return result + delta.to(result.dtype)
+
+        squeeze = lora_input.dim() == 2
+        if squeeze:
+            lora_input = lora_input.unsqueeze(1)
+        indices = self.adapter_indices
+        active = (indices >= 0).to(self.scaling.dtype)
+        safe = indices.clamp(min=0)
+        a = self.lora_A.index_select(0, safe)
+        b = self.lora_B.index_select(0, safe)
+        scale = (self.scaling.index_select(0, safe) * active).to(lora_input.dtype)
+
+        hidden = torch.bmm(lora_input, a.transpose(1, 2))
+        delta = torch.bmm(hidden, b.transpose(1, 2)) * scale[:, None, None]
+        if squeeze:
+            delta = delta.squeeze(1)
+        return result + delta.to(result.dtype)
+
+
+def _parent_module(model: nn.Module, module_name: str):
+    parent_name, _, child_name = module_name.rpartition(".")
+    parent = model.get_submodule(parent_name) if parent_name else model
+    return parent, child_name
+
+
+def inject_multi_lora(
+    model: nn.Module,
+    adapter_names: Sequence[str],
+    r: int = 64,
+    lora_alpha: float = 128,
+    lora_dropout: float = 0.0,
+    target_modules: Optional[Iterable[str]] = None,
+    dtype: torch.dtype = torch.float32,
+) -> List[MultiLoraLinear]:
+    """
+    Replace every targeted linear in ``model`` with a :class:`MultiLoraLinear`.
+
+    Args:
+        model: Causal LM whose projections should receive adapters
+        adapter_names: One name per adapter slot
+        r: LoRA rank shared by all slots
+        lora_alpha: LoRA alpha used to initialise each slot's scaling
+        lora_dropout: Dropout applied to the LoRA input
+        target_modules: Module name suffixes to wrap (defaults to attention projections)
+        dtype: Dtype of the stacked LoRA weights
+
+    Returns:
+        The injected layers
+    """
+    targets = list(target_modules or DEFAULT_TARGET_MODULES)
+    matches = [
+        name
+        for name, module in model.named_modules()
+        if name.split(".")[-1] in targets and hasattr(module, "in_features") and not isinstance(module, MultiLoraLinear)
+    ]
+    if not matches:
+        raise ValueError(f"No modules matching {targets} found for multi-LoRA injection")
+
+    layers = []
+    for name in matches:
+        parent, child_name = _parent_module(model, name)
+        layer = MultiLoraLinear(
+            getattr(parent, child_name),
+            module_name=name,
+            num_adapters=len(adapter_names),
+            r=r,
+            lora_alpha=lora_alpha,
+            lora_dropout=lora_dropout,
+            dtype=dtype,
+        )
+        setattr(parent, child_name, layer)
+        layers.append(layer)
+
+    model._multi_lora_layers = layers
+    model._multi_lora_names = list(adapter_names)
+    model._multi_lora_config = {
+        "r": r,
+        "lora_alpha": lora_alpha,
+        "lora_dropout": lora_dropout,
+        "target_modules": targets,
+    }
+    return layers
+
+
+def has_multi_lora(model: nn.Module) -> bool:
+    return bool(getattr(model, "_multi_lora_layers", None))
+
+
+def set_adapter_indices(model: nn.Module, indices: Union[torch.Tensor, Sequence[int], int, None]) -> None:
+    """
+    Select the adapter used by each batch row.
+
+    ``indices`` may be a single slot for the whole batch, a per-row sequence or
+    tensor, or ``None`` to disable all adapters. The selection stays active
+    until changed, which keeps gradient-checkpoint recomputation consistent.
+    """
+    layers = getattr(model, "_multi_lora_layers", [])
+    uniform = None
+    tensor = None
+    if indices is None:
+        uniform = NO_ADAPTER
+    elif isinstance(indices, int):
+        uniform = indices
+    else:
+        values = indices.tolist() if isinstance(indices, torch.Tensor) else list(indices)
+        if values and all(value == values[0] for value in values):
+            uniform = int(values[0])
+        else:
+            tensor = torch.as_tensor(values, dtype=torch.long)
+
+    devices: Dict[torch.device, torch.Tensor] = {}
+    for layer in layers:
+        layer.uniform_index = uniform
+        if tensor is None:
+            layer.adapter_indices = None
+            continue
+        device = layer.lora_A.device
+        if device not in devices:
+            devices[device] = tensor.to(device)
+        layer.adapter_indices = devices[device]
+
+
+def multi_lora_parameters(model: nn.Module) -> List[nn.Parameter]:
+    params = []
+    for layer in getattr(model, "_multi_lora_layers", []):
+        params.extend([layer.lora_A, layer.lora_B])
+    return params
+
+
+def save_multi_lora_adapter(
+    model: nn.Module,
+    slot: int,
+    output_dir: Union[str, os.PathLike],
+    base_model_name: Optional[str] = None,
+) -> Path:
+    """Write one adapter slot in the PEFT LoRA layout (adapter_config.json + safetensors)."""
+    from safetensors.torch import save_file
+
+    output_path = Path(output_dir)
+    output_path.mkdir(parents=True, exist_ok=True)
+    config = getattr(model, "_multi_lora_config", {})
+
+    tensors = {}
+    for layer in model._multi_lora_layers:
+        prefix = f"base_model.model.{layer.module_name}"
+        tensors[f"{prefix}.lora_A.weight"] = layer.lora_A[slot].detach().to("cpu").contiguous()
+        tensors[f"{prefix}.lora_B.weight"] = layer.lora_B[slot].detach().to("cpu").contiguous()
+    save_file(tensors, str(output_path / "adapter_model.safetensors"), metadata={"format": "pt"})
+
+    adapter_config = {
+        "peft_type": "LORA",
+        "task_type": "CAUSAL_LM",
+        "base_model_name_or_path": base_model_name or getattr(model.config, "_name_or_path", None),
+        "r": config.get("r"),
+        "lora_alpha": config.get("lora_alpha"),
+        "lora_dropout": config.get("lora_dropout", 0.0),
+        "target_modules": config.get("target_modules", DEFAULT_TARGET_MODULES),
+        "bias": "none",
+        "fan_in_fan_out": False,
+        "inference_mode": True,
+        "modules_to_save": None,
+    }
+    with (output_path / "adapter_config.json").open("w", encoding="utf-8") as f:
+        json.dump(adapter_config, f, indent=2)
+    return output_path
+
+
+def save_multi_lora_adapters(
+    model: nn.Module,
+    output_dir: Union[str, os.PathLike],
+    base_model_name: Optional[str] = None,
+) -> Dict[str, Path]:
+    """Save every adapter slot into ``output_dir/<adapter name>``."""
+    return {
+        name: save_multi_lora_adapter(model, slot, Path(output_dir) / name, base_model_name)
+        for slot, name in enumerate(model._multi_lora_names)
+    }
+
+
+def read_adapter_config(adapter_dir: Union[str, os.PathLike]) -> Dict:
+    with (Path(adapter_dir) / "adapter_config.json").open("r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _load_adapter_tensors(adapter_dir: Path) -> Dict[str, torch.Tensor]:
+    safetensors_path = adapter_dir / "adapter_model.safetensors"
+    if safetensors_path.exists():
+        from safetensors.torch import load_file
+
+        return load_file(str(safetensors_path))
+    return torch.load(adapter_dir / "adapter_model.bin", map_location="cpu")
+
+
+def load_multi_lora_adapter(
+    model: nn.Module,
+    slot: int,
+    adapter_dir: Union[str, os.PathLike],
+) -> Dict:
+    """
+    Copy a PEFT LoRA adapter into one slot of every injected layer.
+
+    Adapters of lower rank than the bank are zero-padded, which leaves their
+    output unchanged; layers the adapter does not target stay zero for the slot.
+
+    Returns:
+        The adapter's config
+    """
+    adapter_dir = Path(adapter_dir)
+    config = read_adapter_config(adapter_dir)
+    tensors = _load_adapter_tensors(adapter_dir)
+    lora_alpha = config.get("lora_alpha", config.get("r", 1))
+
+    # PEFT may or may not keep the adapter name in the key
+    by_module: Dict[str, Dict[str, torch.Tensor]] = {}
+    for key, tensor in tensors.items():
+        for part in ("lora_A", "lora_B"):
+            marker = f".{part}."
+            if marker in key:
+                module = key.split(marker)[0]
+                if module.startswith("base_model.model."):
+                    module = module[len("base_model.model."):]
+                by_module.setdefault(module, {})[part] = tensor
+
+    layers = {layer.module_name: layer for layer in model._multi_lora_layers}
+    unknown = sorted(set(by_module) - set(layers))
+    if unknown:
+        raise ValueError(
+            f"Adapter {adapter_dir} targets modules without a LoRA bank: {unknown[:3]}"
+            f"{' ...' if len(unknown) > 3 else ''}"
+        )
+
+    with torch.no_grad():
+        for name, layer in layers.items():
+            layer.lora_A.data[slot].zero_()
+            layer.lora_B.data[slot].zero_()
+            weights = by_module.get(name)
+            if not weights:
+                continue
+            a, b = weights["lora_A"], weights["lora_B"]
+            rank = a.shape[0]
+            if rank > layer.r:
+                raise ValueError(f"Adapter {adapter_dir} has rank {rank}, above the bank rank {layer.r}")
+            layer.lora_A.data[slot, :rank] = a.to(layer.lora_A.dtype)
+            layer.lora_B.data[slot, :, :rank] = b.to(layer.lora_B.dtype)
+            scale = lora_alpha / math.sqrt(rank) if config.get("use_rslora") else lora_alpha / rank
+            layer.scaling[slot] = scale
+    return config
+
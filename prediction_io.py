@@ -0,0 +1,121 @@
+"""
+Append-only JSONL storage for batch predictions.
+
+Each completed prediction is written as one line tagged with its input index,
+so an interrupted job loses at most the batch in flight and can resume by
+skipping indices that already have outputs. Paths ending in ``.gz`` are
+gzip-compressed; a final ordered JSON file can be produced for ``eval.py``.
+"""
+import gzip
+import json
+import os
+import zlib
+from typing import Dict, IO, Iterable, List, Optional, Tuple
+
+INDEX_FIELD = "index"
+
+
+def is_jsonl_path(path: str) -> bool:
+    return path.endswith(".jsonl") or path.endswith(".jsonl.gz")
+
+
+def open_text(path: str, mode: str) -> IO[str]:
+    """Open a text file, transparently handling gzip compression"""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def load_jsonl_predictions(path: str) -> Tuple[Dict[int, Dict], bool]:
+    """
+    Read predictions written by :class:`JsonlPredictionWriter`.
+
+    Returns:
+        Mapping of input index to record, and whether the file was intact.
+        A torn final line or truncated gzip stream marks the file as not intact;
+        every record before the damage is still returned.
+    """
+    records: Dict[int, Dict] = {}
+    if not os.path.exists(path):
+        return records, True
+
+    intact = True
+    try:
+        with open_text(path, "r") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    intact = False
+                    break
+                records[int(record[INDEX_FIELD])] = record
+    except (EOFError, OSError, zlib.error):
+        intact = False
+    return records, intact
+
+
+class JsonlPredictionWriter:
+    """Append predictions to a JSONL file as soon as they complete"""
+
+    def __init__(self, path: str, resume: bool = True):
+        """
+        Args:
+            path: Output ``.jsonl`` or ``.jsonl.gz`` file
+            resume: Keep existing records; otherwise start a fresh file
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+        self.completed: Dict[int, Dict] = {}
+        if resume:
+            self.completed, intact = load_jsonl_predictions(path)
+            if not intact:
+                # Drop the damaged tail so new appends stay readable
+                self._rewrite(self.completed.values())
+        elif os.path.exists(path):
+            os.remove(path)
+        self._handle: Optional[IO[str]] = open_text(path, "a")
+
+    def _rewrite(self, records: Iterable[Dict]) -> None:
+        tmp_path = self.path + ".tmp" + (".gz" if self.path.endswith(".gz") else "")
+        with open_text(tmp_path, "w") as f:
+            for record in sorted(records, key=lambda r: r[INDEX_FIELD]):
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def write(self, records: Iterable[Dict]) -> None:
+        """Append records (each must carry an ``index``) and flush them to disk"""
+        for record in records:
+            self._handle.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.completed[int(record[INDEX_FIELD])] = record
+        self._handle.flush()
+
+    def close(self) -> None:
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def __enter__(self) -> "JsonlPredictionWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def ordered_predictions(records: Dict[int, Dict], total: Optional[int] = None) -> List[Dict]:
+    """Records sorted by input index with the index field stripped"""
+    indices = sorted(records) if total is None else [idx for idx in range(total) if idx in records]
+    return [
+        {key: value for key, value in records[idx].items() if key != INDEX_FIELD}
+        for idx in indices
+    ]
+
+
+def write_json_predictions(results: List[Dict], output_file: str) -> None:
+    """Write the list-of-dicts JSON layout that ``eval.py`` reads"""
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+    with open(output_file, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,173 @@
+"""
+Radix-tree cache of prompt-prefix key/value states.
+
+Each edge of the tree holds a run of token ids together with the KV segment
+for exactly those positions, so a shared system prompt is stored once no
+matter how many distinct prompts extend it. A lookup walks the tree as far as
+the prompt matches and stitches the segments back into a ``past_key_values``
+covering that prefix; only the remaining suffix then needs a forward pass.
+Leaves are evicted least-recently-used once the byte budget is exceeded.
+"""
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+from kv_cache import LegacyCache, cache_nbytes, slice_cache
+
+
+def _concat_segments(segments: List[LegacyCache]) -> LegacyCache:
+    if len(segments) == 1:
+        return segments[0]
+    return tuple(
+        tuple(torch.cat([seg[layer][t] for seg in segments], dim=-2) for t in range(len(segments[0][layer])))
+        for layer in range(len(segments[0]))
+    )
+
+
+def _own(legacy: LegacyCache) -> LegacyCache:
+    # Slices are views; copy so the full per-request cache can be freed
+    return tuple(tuple(t.contiguous().clone() for t in layer) for layer in legacy)
+
+
+class _Node:
+    __slots__ = ("tokens", "kv", "children", "parent", "last_used", "nbytes")
+
+    def __init__(self, tokens: Tuple[int, ...], kv: Optional[LegacyCache], parent: Optional["_Node"]):
+        self.tokens = tokens
+        self.kv = kv
+        self.children: Dict[int, "_Node"] = {}
+        self.parent = parent
+        self.last_used = time.time()
+        self.nbytes = cache_nbytes(kv) if kv else 0
+
+
+class PrefixKVCache:
+    """Thread-safe radix tree mapping token prefixes to stored KV segments"""
+
+    def __init__(self, max_bytes: int, min_prefix_tokens: int = 16):
+        """
+        Args:
+            max_bytes: Memory budget for stored KV segments
+            min_prefix_tokens: Prompts shorter than this are not worth caching
+        """
+        self.max_bytes = max_bytes
+        self.min_prefix_tokens = min_prefix_tokens
+        self._root = _Node((), None, None)
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.lookups = 0
+        self.hits = 0
+        self.tokens_reused = 0
+
+    def lookup(self, token_ids: Sequence[int]) -> Tuple[int, Optional[LegacyCache]]:
+        """
+        Longest cached prefix of ``token_ids``.
+
+        Returns:
+            Number of matched tokens and the KV covering them (``(0, None)`` on a miss)
+        """
+        now = time.time()
+        segments: List[LegacyCache] = []
+        matched = 0
+        with self._lock:
+            self.lookups += 1
+            node = self._root
+            while matched < len(token_ids):
+                child = node.children.get(token_ids[matched])
+                if child is None:
+                    break
+                common = 0
+                limit = min(len(child.tokens), len(token_ids) - matched)
+                while common < limit and child.tokens[common] == token_ids[matched + common]:
+                    common += 1
+                child.last_used = now
+                if common == len(child.tokens):
+                    segments.append(child.kv)
+                else:
+                    segments.append(slice_cache(child.kv, 0, common))
+                matched += common
+                if common < len(child.tokens):
+                    break
+                node = child
+            if not matched:
+                return 0, None
+            self.hits += 1
+            self.tokens_reused += matched
+        return matched, _concat_segments(segments)
+
+    def insert(self, token_ids: Sequence[int], past: LegacyCache) -> None:
+        """Store ``past`` (covering at least ``token_ids``) under its prefix path"""
+        if len(token_ids) < self.min_prefix_tokens:
+            return
+        tokens = tuple(token_ids)
+        with self._lock:
+            node = self._root
+            depth = 0
+            while depth < len(tokens):
+                child = node.children.get(tokens[depth])
+                if child is None:
+                    leaf = _Node(tokens[depth:], _own(slice_cache(past, depth, len(tokens))), node)
+                    node.children[tokens[depth]] = leaf
+                    self.total_bytes += leaf.nbytes
+                    break
+                common = 0
+                limit = min(len(child.tokens), len(tokens) - depth)
+                while common < limit and child.tokens[common] == tokens[depth + common]:
+                    common += 1
+                if common < len(child.tokens):
+                    self._split(child, common)
+                    child = node.children[tokens[depth]]
+                child.last_used = time.time()
+                node = child
+                depth += common
+            self._evict()
+
+    def _split(self, node: _Node, at: int) -> None:
+        """Cut ``node``'s edge after ``at`` tokens, inserting a new parent"""
+        head = _Node(node.tokens[:at], _own(slice_cache(node.kv, 0, at)), node.parent)
+        head.last_used = node.last_used
+        node.parent.children[node.tokens[0]] = head
+        old_bytes = node.nbytes
+        node.tokens = node.tokens[at:]
+        node.kv = _own(slice_cache(node.kv, at))
+        node.nbytes = cache_nbytes(node.kv)
+        node.parent = head
+        head.children[node.tokens[0]] = node
+        self.total_bytes += head.nbytes + node.nbytes - old_bytes
+
+    def _leaves(self) -> List[_Node]:
+        leaves, stack = [], list(self._root.children.values())
+        while stack:
+            node = stack.pop()
+            if node.children:
+                stack.extend(node.children.values())
+            else:
+                leaves.append(node)
+        return leaves
+
+    def _evict(self) -> None:
+        while self.total_bytes > self.max_bytes:
+            leaves = self._leaves()
+            if not leaves:
+                break
+            victim = min(leaves, key=lambda leaf: leaf.last_used)
+            del victim.parent.children[victim.tokens[0]]
+            self.total_bytes -= victim.nbytes
+            victim.kv = None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._root = _Node((), None, None)
+            self.total_bytes = 0
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "total_bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            "tokens_reused": self.tokens_reused,
+        }
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import logging
 from pathlib import Path
@@ -7,6 +8,8 @@ import pandas as pd
 
 logger = logging.getLogger(__name__)
 
+FINGERPRINT_COLUMN = "row_fingerprint"
+
 def load_json_dataset(
     dataset_path: str,
     input_column: str = "input",
@@ -61,6 +64,39 @@ def load_json_dataset(
         logger.error(f"Error loading dataset from {dataset_path}: {e}")
         raise
 
+def row_fingerprint(input_text, target_text) -> str:
+    """Return a stable hash identifying a raw input/output pair."""
+    payload = json.dumps([str(input_text), str(target_text)], ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+def add_row_fingerprints(
+    dataset: Union[Dataset, Dict[str, Dataset]],
+    input_column: str = "input",
+    target_column: str = "output",
+) -> Dataset:
+    """
+    Add a column with the fingerprint of each raw example.
+    
+    Fingerprints are computed before prompt formatting so that changing the
+    template does not make every row look new.
+    
+    Args:
+        dataset: HuggingFace Dataset with raw input/target columns, or a dict of splits
+        input_column: Name of the input column
+        target_column: Name of the target column
+        
+    Returns:
+        Dataset (or dict of splits) with an additional fingerprint column
+    """
+    if isinstance(dataset, dict):
+        return dataset.__class__({
+            split: add_row_fingerprints(split_dataset, input_column=input_column, target_column=target_column)
+            for split, split_dataset in dataset.items()
+        })
+    return dataset.map(
+        lambda x: {FINGERPRINT_COLUMN: row_fingerprint(x[input_column], x[target_column])}
+    )
+
 def format_prompt(
     example: Dict,
     input_column: str = "input",
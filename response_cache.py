@@ -0,0 +1,169 @@
+"""
+Cache of deterministic generations.
+
+Greedy and beam-search outputs depend only on the weights, the prompt and the
+decoding parameters, so repeated calls (evaluation reruns, UI retries) can be
+answered without touching the model. Keys combine a content fingerprint of the
+model and adapter files, the normalized prompt and the parameters that affect
+a deterministic decode. Entries live in an in-memory LRU and, optionally, in a
+directory of small JSON files that survives restarts and is shared by every
+process pointed at it. Sampled generations are never cached.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+SAMPLE_BYTES = 1 << 20
+
+_fingerprint_lock = threading.Lock()
+_fingerprints: Dict[Tuple[str, float], str] = {}
+
+
+def content_fingerprint(path: Optional[str]) -> str:
+    """
+    Stable hash of a model or adapter directory (or file).
+
+    Small files (configs, tokenizer) are hashed whole; large weight files
+    contribute their size plus their first and last MiB, which changes whenever
+    they are retrained or re-merged without reading gigabytes per load.
+    References that are not local paths (hub ids) hash the reference itself.
+    """
+    if not path:
+        return ""
+    root = Path(path)
+    if not root.exists():
+        return hashlib.sha256(str(path).encode("utf-8")).hexdigest()
+    files = [root] if root.is_file() else sorted(p for p in root.iterdir() if p.is_file())
+    stamp = (str(root.resolve()), max((p.stat().st_mtime for p in files), default=0.0))
+    with _fingerprint_lock:
+        if stamp in _fingerprints:
+            return _fingerprints[stamp]
+
+    digest = hashlib.sha256()
+    for file in files:
+        size = file.stat().st_size
+        digest.update(f"{file.name}:{size}".encode("utf-8"))
+        with file.open("rb") as f:
+            if size <= 2 * SAMPLE_BYTES:
+                digest.update(f.read())
+            else:
+                digest.update(f.read(SAMPLE_BYTES))
+                f.seek(-SAMPLE_BYTES, os.SEEK_END)
+                digest.update(f.read())
+    fingerprint = digest.hexdigest()
+    with _fingerprint_lock:
+        _fingerprints[stamp] = fingerprint
+    return fingerprint
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Unicode NFC with unified line endings, so equivalent text shares one entry"""
+    return unicodedata.normalize("NFC", prompt.replace("\r\n", "\n").replace("\r", "\n"))
+
+
+def response_cache_key(fingerprint: str, prompt: str, params: Dict[str, Any]) -> str:
+    payload = json.dumps(
+        {"model": fingerprint, "prompt": normalize_prompt(prompt), "params": params},
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """In-memory LRU of responses backed by an optional on-disk tier"""
+
+    def __init__(self, max_entries: int = 1024, disk_dir: Optional[str] = None):
+        """
+        Args:
+            max_entries: Responses kept in memory (0 keeps only the disk tier)
+            disk_dir: Directory for persistent entries (``None`` disables the disk tier)
+        """
+        self.max_entries = max_entries
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    def _disk_path(self, key: str) -> Path:
+        return self.disk_dir / key[:2] / f"{key}.json"
+
+    def _remember(self, key: str, response: str) -> None:
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = response
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return self._entries[key]
+
+        if self.disk_dir is not None:
+            try:
+                with self._disk_path(key).open("r", encoding="utf-8") as f:
+                    response = json.load(f)["response"]
+            except (OSError, ValueError, KeyError):
+                response = None
+            if response is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                    self._remember(key, response)
+                return response
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, response: str) -> None:
+        with self._lock:
+            self._remember(key, response)
+        if self.disk_dir is None:
+            return
+        path = self._disk_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename, so concurrent readers never see a partial entry
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            json.dump({"response": response, "created_at": time.time()}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def record_bypass(self) -> None:
+        with self._lock:
+            self.bypassed += 1
+
+    def clear(self) -> None:
+        """Drop the in-memory tier (disk entries are kept)"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "disk_dir": str(self.disk_dir) if self.disk_dir is not None else None,
+                "hits": hits,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "hit_rate": hits / lookups if lookups else 0.0,
+            }
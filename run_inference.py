@@ -1,21 +1,62 @@
 import os
 import json
+import queue
+import multiprocessing as mp
 import torch
-from typing import Optional, List, Dict, Union, Generator
-from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer, StoppingCriteriaList, StoppingCriteria
+from typing import Optional, List, Dict, Union, Generator, Iterator, Tuple, Callable, Any
+from transformers import AutoTokenizer, TextIteratorStreamer, StoppingCriteriaList
 from tqdm import tqdm
 import fire
 import threading
+from contextlib import contextmanager
 
-class StopOnTokens(StoppingCriteria):
-    def __init__(self, stop_token_ids: List[int]):
-        self.stop_token_ids = stop_token_ids
+from adapter_serving import LoraAdapterBank
+from cancellation import CancellationCriteria, CancellationStats, CancellationToken
+from chat_session import ChatSession, ChatTemplate
+from kv_cache import from_legacy_cache, slice_cache, to_legacy_cache
+from prefix_cache import PrefixKVCache
+from response_cache import ResponseCache, content_fingerprint, response_cache_key
+from stop_sequences import StopSequenceCriteria, compile_stop_sequences, normalize_stop
+from speculative_decoding import DraftModelProposer, PromptLookupProposer, speculative_generate
+from weight_loading import load_causal_lm, warmup_model
+from prediction_io import (
+    INDEX_FIELD,
+    JsonlPredictionWriter,
+    is_jsonl_path,
+    load_jsonl_predictions,
+    ordered_predictions,
+    write_json_predictions,
+)
+
+def load_draft_model(
+    model_path: str,
+    device: str = "auto",
+    torch_dtype: str = "float16",
+    adapter_path: Optional[str] = None,
+    trust_remote_code: bool = True,
+    mmap_weights: bool = False,
+):
+    """
+    Load a small model for speculative decoding.
+
+    Takes the ``ModelKey`` fields so it can serve as a ``ModelPool`` loader,
+    which lets one draft be shared by every target model that uses it.
+    Draft models never carry an adapter.
+    """
+    if adapter_path:
+        raise ValueError("Draft models cannot have an adapter")
+    print(f"Loading draft model from: {model_path}")
+    draft_model, report = load_causal_lm(
+        model_path,
+        device=device,
+        torch_dtype=torch_dtype,
+        trust_remote_code=trust_remote_code,
+        share_weights=mmap_weights,
+    )
+    print(report.summary())
+    draft_model.eval()
+    return draft_model
 
-    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        for stop_ids in self.stop_token_ids:
-            if input_ids[0][-1] == stop_ids:
-                return True
-        return False
 
 class ModelInference:
     def __init__(
@@ -28,6 +69,16 @@ class ModelInference:
         top_k: int = 50,
         num_beams: int = 1,
         trust_remote_code: bool = True,
+        torch_dtype: str = "float16",
+        adapter_path: Optional[str] = None,
+        prefix_cache_mb: int = 0,
+        draft_model_path: Optional[str] = None,
+        adapter_registry: Optional[str] = None,
+        max_loaded_adapters: int = 8,
+        response_cache_size: int = 0,
+        response_cache_dir: Optional[str] = None,
+        mmap_weights: bool = False,
+        warmup: bool = False,
     ):
         """
         Initialize the inference model.
@@ -41,13 +92,42 @@ class ModelInference:
             top_k: Top-k sampling parameter
             num_beams: Number of beams for beam search
             trust_remote_code: Whether to trust remote code when loading models
+            torch_dtype: Weight dtype ('float16', 'bfloat16', 'float32' or 'auto')
+            adapter_path: Optional LoRA adapter applied on top of the base model
+            prefix_cache_mb: Memory for reusing KV states of shared prompt prefixes (0 disables)
+            draft_model_path: Optional small model sharing the tokenizer, used for speculative decoding
+            adapter_registry: Adapter registry whose LoRAs can be attached per request without merging
+            max_loaded_adapters: Number of registry adapters kept resident at once
+            response_cache_size: Deterministic responses kept in memory (0 disables the memory tier)
+            response_cache_dir: Optional directory persisting cached responses across runs
+            mmap_weights: Build CPU weights on read-only mappings of the safetensors files, so
+                processes loading the same model share one copy through the page cache
+            warmup: Run a short forward pass after loading so the first request does not pay for setup
         """
         print(f"Loading model from: {model_path}")
-        self.model = AutoModelForCausalLM.from_pretrained(
+        self.model, self.load_report = load_causal_lm(
             model_path,
-            torch_dtype=torch.float16,
-            device_map=device,
-            trust_remote_code=trust_remote_code
+            device=device,
+            torch_dtype=torch_dtype,
+            trust_remote_code=trust_remote_code,
+            share_weights=mmap_weights,
+        )
+        if adapter_path:
+            from peft import PeftModel
+
+            print(f"Loading adapter from: {adapter_path}")
+            self.model = PeftModel.from_pretrained(self.model, adapter_path)
+        self.model.eval()
+        
+        self.draft_model = (
+            load_draft_model(
+                draft_model_path,
+                device=device,
+                torch_dtype=torch_dtype,
+                trust_remote_code=trust_remote_code,
+                mmap_weights=mmap_weights,
+            )
+            if draft_model_path else None
         )
         
         print("Loading tokenizer...")
@@ -65,131 +145,636 @@ class ModelInference:
         self.top_k = top_k
         self.num_beams = num_beams
         
+        self.adapters = (
+            LoraAdapterBank(self.model, adapter_registry, max_loaded=max_loaded_adapters)
+            if adapter_registry else None
+        )
+        self.prefix_cache = PrefixKVCache(prefix_cache_mb * 1024 * 1024) if prefix_cache_mb > 0 else None
+        self.response_cache = (
+            ResponseCache(response_cache_size, response_cache_dir)
+            if response_cache_size > 0 or response_cache_dir else None
+        )
+        self.model_path = model_path
+        self.adapter_path = adapter_path
+        self._base_fingerprint: Optional[str] = None
+        self._engine = None
+        self._engine_lock = threading.Lock()
+        self.cancellation_stats = CancellationStats()
+        # Background generate() threads of open streams, cancelled by close()
+        self._generation_threads: Dict[threading.Thread, CancellationToken] = {}
+        
         # Add stop tokens
         self.stop_tokens = ["</s>", "\n\n", "<|reserved_special_token_236|>", "<|reserved_special_token_237|>","<|endoftext|>"]
         
+        if warmup:
+            warmup_model(self.model, self.load_report)
+        print(self.load_report.summary())
         print("Model loaded successfully!")
     
-    def _generate_tokens(self, prompt: str, max_new_tokens: Optional[int] = None) -> torch.Tensor:
-        """Internal method to generate tokens."""
-        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.model.device)
+    def get_engine(self, max_batch_size: int = 8):
+        """Lazily start a continuous batching engine that shares this model."""
+        from generation_engine import ContinuousBatchingEngine
+
+        with self._engine_lock:
+            if self._engine is None:
+                self._engine = ContinuousBatchingEngine(
+                    self.model,
+                    self.tokenizer,
+                    max_batch_size=max_batch_size,
+                    prefix_cache=self.prefix_cache,
+                    # Adapter requests switch the whole model, so steps must not overlap them
+                    model_lock=self.adapters.switch_lock if self.adapters is not None else None,
+                    adapter_bank=self.adapters,
+                    cancellation_stats=self.cancellation_stats,
+                )
+            return self._engine
+
+    def close(self) -> None:
+        """Stop the batching engine and any streaming generation still running."""
+        with self._engine_lock:
+            if self._engine is not None:
+                self._engine.stop()
+                self._engine = None
+        for thread, cancel in list(self._generation_threads.items()):
+            cancel.cancel()
+            thread.join()
+
+    @contextmanager
+    def use_adapter(self, adapter: Optional[str]):
+        """
+        Route generation inside the block through a registry adapter.
         
-        generate_kwargs = {
-            "max_new_tokens": max_new_tokens or self.max_length,
+        With no adapter the block runs on the plain base model; once a registry
+        is attached it still takes the bank's switch lock, so it never overlaps
+        an engine step routing other rows through their adapters.
+        """
+        if not adapter:
+            if self.adapters is None:
+                yield
+                return
+            with self.adapters.use_base():
+                yield
+            return
+        if self.adapters is None:
+            raise ValueError("This model was loaded without an adapter registry")
+        with self.adapters.activate(adapter):
+            yield
+
+    def _generation_kwargs(self, max_new_tokens: Optional[int] = None, **overrides) -> Dict:
+        """
+        Decoding parameters shared by single and batched generation.
+
+        Non-None ``overrides`` (temperature, top_p, top_k, num_beams) replace the
+        instance defaults, so one loaded model can serve differently tuned calls.
+        """
+        params = {
             "temperature": self.temperature,
             "top_p": self.top_p,
             "top_k": self.top_k,
             "num_beams": self.num_beams,
+        }
+        params.update({key: value for key, value in overrides.items() if value is not None})
+        return {
+            "max_new_tokens": max_new_tokens or self.max_length,
+            **params,
             "pad_token_id": self.tokenizer.pad_token_id,
             "eos_token_id": self.tokenizer.eos_token_id,
+            "do_sample": True if params["temperature"] > 0 else False,
         }
+
+    def _stopping_criteria(
+        self,
+        prompt_length: int,
+        max_new_tokens: int,
+        matcher=None,
+        cancel: Optional[CancellationToken] = None,
+    ) -> Optional[StoppingCriteriaList]:
+        """Stop-string and cancellation criteria for one ``model.generate`` call."""
+        criteria = []
+        if matcher:
+            criteria.append(StopSequenceCriteria(matcher, prompt_length))
+        if cancel is not None:
+            criteria.append(CancellationCriteria(cancel, prompt_length, max_new_tokens, self.cancellation_stats))
+        return StoppingCriteriaList(criteria) if criteria else None
+
+    def _model_fingerprint(self, adapter: Optional[str] = None) -> str:
+        """Content hash of the weights a call runs on, including a per-request adapter."""
+        if self._base_fingerprint is None:
+            self._base_fingerprint = "|".join(
+                [content_fingerprint(self.model_path), content_fingerprint(self.adapter_path), str(self.model.dtype)]
+            )
+        if not adapter:
+            return self._base_fingerprint
+        if self.adapters is None:
+            raise ValueError("This model was loaded without an adapter registry")
+        return f"{self._base_fingerprint}|{content_fingerprint(self.adapters.resolve_path(adapter))}"
+
+    def generation_key(
+        self,
+        prompt: str,
+        max_new_tokens: Optional[int] = None,
+        adapter: Optional[str] = None,
+        stop: Optional[Union[str, List[str]]] = None,
+        **overrides,
+    ) -> Optional[str]:
+        """
+        Identity of a deterministic call's output (``None`` when the call samples).
+        
+        Only the parameters that change a greedy or beam-search decode are part
+        of the key, so identical calls can share one cached or in-flight result.
+        Calls without ``adapter`` run on the base model and are keyed on it,
+        whatever adapter another thread has active.
+        """
+        params = self._generation_kwargs(max_new_tokens, **overrides)
+        if params["do_sample"]:
+            return None
+        return response_cache_key(
+            self._model_fingerprint(adapter),
+            prompt,
+            {
+                "max_new_tokens": params["max_new_tokens"],
+                "num_beams": params["num_beams"],
+                "stop": list(normalize_stop(stop)),
+            },
+        )
+
+    def response_cache_key(
+        self,
+        prompt: str,
+        max_new_tokens: Optional[int] = None,
+        adapter: Optional[str] = None,
+        stop: Optional[Union[str, List[str]]] = None,
+        **overrides,
+    ) -> Optional[str]:
+        """Response-cache key for a call, or ``None`` when caching is off or the call samples."""
+        if self.response_cache is None:
+            return None
+        key = self.generation_key(prompt, max_new_tokens, adapter, stop, **overrides)
+        if key is None:
+            self.response_cache.record_bypass()
+        return key
+
+    def _cached_prefix(self, prompt_ids: List[int]):
+        """Past key values for the longest cached prefix, leaving at least one token to run."""
+        if self.prefix_cache is None:
+            return None
+        matched, past = self.prefix_cache.lookup(prompt_ids)
+        matched = min(matched, len(prompt_ids) - 1)
+        if matched <= 0:
+            return None
+        return from_legacy_cache(slice_cache(past, 0, matched))
+
+    def _generate_tokens(
+        self,
+        prompt: str,
+        max_new_tokens: Optional[int] = None,
+        stop: Optional[Union[str, List[str]]] = None,
+        cancel: Optional[CancellationToken] = None,
+        **overrides,
+    ) -> torch.Tensor:
+        """Internal method to generate tokens."""
+        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.model.device)
+        
+        generate_kwargs = self._generation_kwargs(max_new_tokens, **overrides)
+        criteria = self._stopping_criteria(
+            inputs["input_ids"].shape[1],
+            generate_kwargs["max_new_tokens"],
+            matcher=self.stop_matcher(stop) if stop else None,
+            cancel=cancel,
+        )
+        if criteria:
+            generate_kwargs["stopping_criteria"] = criteria
+        # Beam search expands the cache per beam, so prefix reuse is greedy/sampling only;
+        # KV states also differ per adapter, so adapter requests skip the shared cache
+        use_prefix_cache = (
+            self.prefix_cache is not None
+            and generate_kwargs["num_beams"] == 1
+            and (self.adapters is None or self.adapters.active is None)
+        )
+        if use_prefix_cache:
+            prompt_ids = inputs["input_ids"][0].tolist()
+            past = self._cached_prefix(prompt_ids)
+            if past is not None:
+                generate_kwargs["past_key_values"] = past
+            generate_kwargs["return_dict_in_generate"] = True
         
         with torch.no_grad():
             outputs = self.model.generate(**inputs, **generate_kwargs)
-        return outputs[0]
+        if not use_prefix_cache:
+            return outputs[0]
+        
+        self.prefix_cache.insert(
+            prompt_ids,
+            slice_cache(to_legacy_cache(outputs.past_key_values), 0, len(prompt_ids)),
+        )
+        return outputs.sequences[0]
+
+    @staticmethod
+    def _length_buckets(
+        lengths: List[int],
+        batch_size: int,
+        max_batch_tokens: Optional[int],
+        max_new_tokens: int,
+    ) -> List[List[int]]:
+        """Group indices of similar length, capping rows and padded tokens per batch."""
+        order = sorted(range(len(lengths)), key=lambda idx: lengths[idx])
+        batches: List[List[int]] = []
+        current: List[int] = []
+        for idx in order:
+            # Sorted ascending, so the newest row sets the padded width
+            width = lengths[idx] + max_new_tokens
+            too_many_rows = len(current) >= batch_size
+            too_many_tokens = bool(max_batch_tokens) and current and (len(current) + 1) * width > max_batch_tokens
+            if current and (too_many_rows or too_many_tokens):
+                batches.append(current)
+                current = []
+            current.append(idx)
+        if current:
+            batches.append(current)
+        return batches
+
+    def _iter_batched_generation(
+        self,
+        prompts: List[str],
+        max_new_tokens: Optional[int] = None,
+        batch_size: int = 8,
+        max_batch_tokens: Optional[int] = None,
+        stop: Optional[Union[str, List[str]]] = None,
+        adapter: Optional[str] = None,
+    ) -> Iterator[Tuple[List[int], List[str]]]:
+        """
+        Generate responses in left-padded, length-sorted micro-batches.
+
+        Identical prompts are generated once. Rows that hit a ``stop`` string
+        finish individually and the stop string is trimmed from their output.
+        Every micro-batch runs through the registry ``adapter`` when one is given.
+        Yields ``(indices, responses)`` for each completed micro-batch, where
+        ``indices`` refer to ``prompts``.
+        """
+        unique_prompts: List[str] = []
+        positions: Dict[str, List[int]] = {}
+        for idx, prompt in enumerate(prompts):
+            if prompt not in positions:
+                positions[prompt] = []
+                unique_prompts.append(prompt)
+            positions[prompt].append(idx)
+
+        cache_keys: Dict[str, str] = {}
+        if self.response_cache is not None:
+            hit_indices: List[int] = []
+            hit_responses: List[str] = []
+            misses: List[str] = []
+            for prompt in unique_prompts:
+                key = self.response_cache_key(prompt, max_new_tokens, adapter, stop)
+                cached = self.response_cache.get(key) if key is not None else None
+                if cached is None:
+                    misses.append(prompt)
+                    if key is not None:
+                        cache_keys[prompt] = key
+                    continue
+                hit_indices.extend(positions[prompt])
+                hit_responses.extend([cached] * len(positions[prompt]))
+            if hit_indices:
+                yield hit_indices, hit_responses
+            unique_prompts = misses
+
+        if not unique_prompts:
+            return
+        encoded = self.tokenizer(unique_prompts)["input_ids"]
+        generate_kwargs = self._generation_kwargs(max_new_tokens)
+        pad_id = self.tokenizer.pad_token_id
+        matcher = self.stop_matcher(stop) if stop else None
+
+        for batch in self._length_buckets(
+            [len(ids) for ids in encoded],
+            batch_size=max(1, batch_size),
+            max_batch_tokens=max_batch_tokens,
+            max_new_tokens=generate_kwargs["max_new_tokens"],
+        ):
+            width = max(len(encoded[idx]) for idx in batch)
+            input_ids = torch.tensor(
+                [[pad_id] * (width - len(encoded[idx])) + encoded[idx] for idx in batch],
+                dtype=torch.long,
+            )
+            attention_mask = torch.tensor(
+                [[0] * (width - len(encoded[idx])) + [1] * len(encoded[idx]) for idx in batch],
+                dtype=torch.long,
+            )
+            if matcher:
+                generate_kwargs["stopping_criteria"] = StoppingCriteriaList([StopSequenceCriteria(matcher, width)])
+            with torch.no_grad(), self.use_adapter(adapter):
+                outputs = self.model.generate(
+                    input_ids=input_ids.to(self.model.device),
+                    attention_mask=attention_mask.to(self.model.device),
+                    **generate_kwargs,
+                )
+            texts = self.tokenizer.batch_decode(outputs[:, width:], skip_special_tokens=True)
+            if matcher:
+                texts = [matcher.trim_text(text) for text in texts]
+
+            indices: List[int] = []
+            responses: List[str] = []
+            for idx, text in zip(batch, texts):
+                prompt = unique_prompts[idx]
+                if prompt in cache_keys:
+                    self.response_cache.put(cache_keys[prompt], text.strip())
+                for position in positions[prompt]:
+                    indices.append(position)
+                    responses.append(text.strip())
+            yield indices, responses
+
+    def generate_batch(
+        self,
+        prompts: List[str],
+        max_new_tokens: Optional[int] = None,
+        batch_size: int = 8,
+        max_batch_tokens: Optional[int] = None,
+        stop: Optional[Union[str, List[str]]] = None,
+        adapter: Optional[str] = None,
+    ) -> List[str]:
+        """Generate responses for many prompts, returned in input order."""
+        results: List[Optional[str]] = [None] * len(prompts)
+        for indices, responses in self._iter_batched_generation(
+            prompts, max_new_tokens, batch_size, max_batch_tokens, stop, adapter
+        ):
+            for idx, response in zip(indices, responses):
+                results[idx] = response
+        return results
     
     def generate_response(
         self,
         prompt: str,
         max_new_tokens: Optional[int] = None,
-        stream: bool = False
+        stream: bool = False,
+        adapter: Optional[str] = None,
+        stop: Optional[Union[str, List[str]]] = None,
+        cancel: Optional[CancellationToken] = None,
+        timeout: Optional[float] = None,
+        use_response_cache: bool = True,
+        **overrides,
     ) -> str:
-        """Generate a response for a given prompt."""
-        outputs = self._generate_tokens(prompt, max_new_tokens)
+        """
+        Generate a response for a given prompt.
+        
+        ``adapter`` names a registry LoRA applied for this call only, ``stop``
+        lists strings that end generation (and are trimmed from the response) and
+        ``overrides`` adjust decoding for this call. Generation stops at the next
+        step once ``cancel`` is cancelled or ``timeout`` seconds pass, raising
+        ``GenerationCancelled`` or ``TimeoutError``. Deterministic calls are
+        served from the response cache when one is configured, unless
+        ``use_response_cache`` is off (callers that manage the cache themselves).
+        """
+        cache_key = (
+            self.response_cache_key(prompt, max_new_tokens, adapter, stop, **overrides)
+            if use_response_cache else None
+        )
+        if cache_key is not None:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        cancel = cancel or (CancellationToken(timeout) if timeout else None)
+        with self.use_adapter(adapter):
+            outputs = self._generate_tokens(prompt, max_new_tokens, stop=stop, cancel=cancel, **overrides)
+        if cancel is not None and cancel.fired:
+            raise cancel.error()
         response = self.tokenizer.decode(outputs, skip_special_tokens=True)
         
         # Remove the prompt from the response
         if response.startswith(prompt):
             response = response[len(prompt):].strip()
+        if stop:
+            response = self.stop_matcher(stop).trim_text(response).strip()
+        if cache_key is not None:
+            self.response_cache.put(cache_key, response)
         return response
     
+    def generate_speculative(
+        self,
+        prompt: str,
+        max_new_tokens: Optional[int] = None,
+        num_draft_tokens: int = 4,
+        cancel: Optional[CancellationToken] = None,
+        draft_model=None,
+        adapter: Optional[str] = None,
+        stop: Optional[Union[str, List[str]]] = None,
+        **overrides,
+    ) -> Tuple[str, Dict]:
+        """
+        Generate with the draft model proposing tokens for the target to verify.
+        
+        ``draft_model`` overrides the one loaded with this model, so a cached
+        draft can be paired with any target sharing its tokenizer. ``adapter``
+        names a registry LoRA applied to the target only and ``stop`` works as
+        in :meth:`generate_response`.
+        
+        Returns:
+            The response and acceptance statistics for this request
+        """
+        draft_model = draft_model if draft_model is not None else self.draft_model
+        if draft_model is None:
+            raise ValueError("Speculative decoding needs a draft model (draft_model_path)")
+        params = self._generation_kwargs(max_new_tokens, **overrides)
+        temperature = params["temperature"] if params["do_sample"] else 0.0
+        proposer = DraftModelProposer(draft_model, temperature, params["top_p"], params["top_k"])
+        with self.use_adapter(adapter):
+            return self._run_speculative(
+                prompt, proposer, params, temperature, num_draft_tokens, cancel=cancel, stop=stop
+            )
+
+    def generate_prompt_lookup(
+        self,
+        prompt: str,
+        max_new_tokens: Optional[int] = None,
+        num_draft_tokens: int = 10,
+        max_ngram_size: int = 3,
+        cancel: Optional[CancellationToken] = None,
+        adapter: Optional[str] = None,
+        stop: Optional[Union[str, List[str]]] = None,
+        **overrides,
+    ) -> Tuple[str, Dict]:
+        """
+        Generate with n-gram prompt lookup proposing continuations copied from the context.
+        
+        ``adapter`` and ``stop`` work as in :meth:`generate_response`.
+        
+        Returns:
+            The response and per-request acceptance/speedup statistics
+        """
+        params = self._generation_kwargs(max_new_tokens, **overrides)
+        temperature = params["temperature"] if params["do_sample"] else 0.0
+        proposer = PromptLookupProposer(max_ngram_size=max_ngram_size)
+        with self.use_adapter(adapter):
+            return self._run_speculative(
+                prompt, proposer, params, temperature, num_draft_tokens,
+                adaptive=False, cancel=cancel, stop=stop,
+            )
+
+    def _run_speculative(
+        self, prompt, proposer, params, temperature, num_draft_tokens, adaptive=True, cancel=None, stop=None
+    ) -> Tuple[str, Dict]:
+        eos = self.tokenizer.eos_token_id
+        prompt_ids = self.tokenizer(prompt)["input_ids"]
+        matcher = self.stop_matcher(stop) if stop else None
+        generated, stats = speculative_generate(
+            self.model,
+            prompt_ids,
+            proposer,
+            max_new_tokens=params["max_new_tokens"],
+            eos_token_ids=eos if isinstance(eos, (list, tuple)) else [eos],
+            temperature=temperature,
+            top_p=params["top_p"],
+            top_k=params["top_k"],
+            num_draft_tokens=num_draft_tokens,
+            adaptive=adaptive,
+            cancel=cancel,
+            stop_matcher=matcher,
+        )
+        if cancel is not None and cancel.fired:
+            self.cancellation_stats.record(cancel.reason, params["max_new_tokens"] - len(generated))
+            raise cancel.error()
+        response = self.tokenizer.decode(generated, skip_special_tokens=True).strip()
+        if matcher:
+            response = matcher.trim_text(response).strip()
+        return response, stats.to_dict()
+    
+    def stop_matcher(self, stop: Optional[Union[str, List[str]]] = None):
+        """Compiled matcher for ``stop`` (defaults to the instance stop strings)."""
+        stops = normalize_stop(stop) if stop is not None else tuple(self.stop_tokens)
+        return compile_stop_sequences(self.tokenizer, stops)
+
     def generate_stream(
         self,
         prompt: str,
         max_new_tokens: Optional[int] = None,
+        stop: Optional[Union[str, List[str]]] = None,
+        cancel: Optional[CancellationToken] = None,
+        timeout: Optional[float] = None,
     ) -> Generator[str, None, None]:
-        """Generate a streaming response for a given prompt."""
+        """
+        Generate a streaming response for a given prompt.
+        
+        Text that could be the start of a stop string is held back until it is
+        known not to be one, so stop strings never reach the caller. The stream
+        ends early once ``cancel`` is cancelled or ``timeout`` seconds pass, and
+        closing the generator stops the background ``generate`` thread.
+        """
         inputs = self.tokenizer(prompt, return_tensors="pt").to(self.model.device)
         streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, timeout=10)
+        matcher = self.stop_matcher(stop)
+        cancel = cancel or CancellationToken(timeout)
         
-        # Add stop token ids
-        stop_token_ids = []
-        for token in self.stop_tokens:
-            ids = self.tokenizer.encode(token, add_special_tokens=False)
-            stop_token_ids.extend(ids)
+        generate_kwargs = self._generation_kwargs(max_new_tokens)
+        generate_kwargs["streamer"] = streamer
+        generate_kwargs["stopping_criteria"] = self._stopping_criteria(
+            inputs["input_ids"].shape[1], generate_kwargs["max_new_tokens"], matcher=matcher, cancel=cancel
+        )
+        errors: List[BaseException] = []
         
-        generate_kwargs = {
-            "max_new_tokens": self.max_length,
-            "temperature": self.temperature,
-            "top_p": self.top_p,
-            "top_k": self.top_k,
-            "num_beams": self.num_beams,
-            "pad_token_id": self.tokenizer.pad_token_id,
-            "eos_token_id": self.tokenizer.eos_token_id,
-            "do_sample": True if self.temperature > 0 else False,
-            "streamer": streamer,
-            "stopping_criteria": [StoppingCriteriaList([StopOnTokens(stop_token_ids)])]
-        }
+        def _generate():
+            try:
+                with self.use_adapter(None):
+                    self.model.generate(**inputs, **generate_kwargs)
+            except Exception as exc:
+                errors.append(exc)
+                streamer.end()
+            finally:
+                self._generation_threads.pop(threading.current_thread(), None)
         
         # Run generation in a separate thread
-        thread = threading.Thread(
-            target=self.model.generate,
-            kwargs={**inputs, **generate_kwargs}
-        )
+        thread = threading.Thread(target=_generate, name="generate-stream", daemon=True)
+        self._generation_threads[thread] = cancel
         thread.start()
         
-        # Yield from streamer as tokens are generated
-        for text in streamer:
-            yield text
+        try:
+            # Yield from streamer as tokens are generated
+            pending = ""
+            for text in streamer:
+                pending += text
+                trimmed = matcher.trim_text(pending)
+                if len(trimmed) < len(pending):
+                    if trimmed:
+                        yield trimmed
+                    return
+                safe, pending = matcher.split_safe(pending)
+                if safe:
+                    yield safe
+            if errors:
+                raise errors[0]
+            if pending:
+                yield pending
+        finally:
+            # Abandoned or stopped early: let generate() exit at its next step
+            if thread.is_alive():
+                cancel.cancel()
+            thread.join()
     
     def batch_inference(
         self,
         input_file: str,
         output_file: str,
         input_field: str = "input",
-        max_samples: Optional[int] = None
+        max_samples: Optional[int] = None,
+        batch_size: int = 8,
+        max_batch_tokens: Optional[int] = None,
+        resume: bool = True,
+        final_json_file: Optional[str] = None,
+        stop: Optional[Union[str, List[str]]] = None,
+        adapter: Optional[str] = None,
     ) -> List[Dict[str, str]]:
         """
         Run inference on a batch of inputs from a JSON file.
         
+        When ``output_file`` ends in ``.jsonl`` or ``.jsonl.gz`` each result is
+        appended as soon as its batch completes, and a rerun skips inputs that
+        already have outputs. Other paths keep the original JSON layout.
+        
         Args:
             input_file: Path to input JSON file
-            output_file: Path to save results
+            output_file: Path to save results (.json, .jsonl or .jsonl.gz)
             input_field: Field name containing input text in JSON
             max_samples: Maximum number of samples to process
+            batch_size: Maximum prompts per generation call
+            max_batch_tokens: Optional cap on padded prompt + new tokens per call
+            resume: Skip inputs already present in a JSONL output file
+            final_json_file: Also write ordered results as JSON (JSONL mode only)
+            stop: Stop string(s) that end a row's generation early
+            adapter: Registry adapter applied to every generation
         """
-        print(f"Loading inputs from: {input_file}")
-        with open(input_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            
-        if isinstance(data, dict):
-            data = [data]
-            
-        if max_samples:
-            data = data[:max_samples]
-            
-        results = []
-        total = len(data)
+        inputs = load_inference_inputs(input_file, input_field, max_samples)
+        if is_jsonl_path(output_file):
+            return self._batch_inference_jsonl(
+                inputs, output_file, batch_size, max_batch_tokens, resume, final_json_file,
+                stop=stop, adapter=adapter,
+            )
+
+        results: List[Optional[Dict[str, str]]] = [None] * len(inputs)
+        total = len(inputs)
+        completed = 0
         
         print(f"\nProcessing {total} samples...")
         progress_bar = tqdm(total=total, desc="Generating responses", unit="sample")
         
-        for item in data:
-            input_text = item[input_field]
-            response = self.generate_response(input_text)
-            
-            result = {
-                "input": input_text,
-                "output": response
-            }
-            results.append(result)
+        for indices, responses in self._iter_batched_generation(
+            inputs,
+            batch_size=batch_size,
+            max_batch_tokens=max_batch_tokens,
+            stop=stop,
+            adapter=adapter,
+        ):
+            for idx, response in zip(indices, responses):
+                results[idx] = {
+                    "input": inputs[idx],
+                    "output": response
+                }
             
             # Update progress bar
-            progress_bar.update(1)
+            progress_bar.update(len(indices))
             
             # Save intermediate results every 100 samples
-            if len(results) % 100 == 0:
-                self._save_results(results, output_file)
+            if (completed + len(indices)) // 100 > completed // 100:
+                self._save_results([r for r in results if r is not None], output_file)
+            completed += len(indices)
                 
         progress_bar.close()
         
@@ -197,31 +782,312 @@ class ModelInference:
         self._save_results(results, output_file)
         print(f"\nResults saved to: {output_file}")
         return results
+
+    def _batch_inference_jsonl(
+        self,
+        inputs: List[str],
+        output_file: str,
+        batch_size: int,
+        max_batch_tokens: Optional[int],
+        resume: bool,
+        final_json_file: Optional[str],
+        index_offset: int = 0,
+        progress_callback: Optional[Callable[[int], None]] = None,
+        stop: Optional[Union[str, List[str]]] = None,
+        adapter: Optional[str] = None,
+    ) -> List[Dict[str, str]]:
+        """
+        Append-only batch inference.
+
+        ``index_offset`` maps local inputs to global indices when running one
+        shard of a larger job; ``progress_callback`` replaces the local progress
+        bar with a per-batch completion count.
+        """
+        with JsonlPredictionWriter(output_file, resume=resume) as writer:
+            # Only trust records whose input still matches the input file
+            pending = [
+                idx for idx, text in enumerate(inputs)
+                if writer.completed.get(idx + index_offset, {}).get("input") != text
+            ]
+            total = len(inputs)
+            if len(pending) < total:
+                print(f"\nResuming: {total - len(pending)} of {total} samples already in {output_file}")
+            print(f"\nProcessing {len(pending)} samples...")
+            progress_bar = tqdm(
+                total=total,
+                initial=total - len(pending),
+                desc="Generating responses",
+                unit="sample",
+                disable=progress_callback is not None,
+            )
+
+            for indices, responses in self._iter_batched_generation(
+                [inputs[idx] for idx in pending],
+                batch_size=batch_size,
+                max_batch_tokens=max_batch_tokens,
+                stop=stop,
+                adapter=adapter,
+            ):
+                writer.write(
+                    {
+                        INDEX_FIELD: pending[idx] + index_offset,
+                        "input": inputs[pending[idx]],
+                        "output": response,
+                    }
+                    for idx, response in zip(indices, responses)
+                )
+                progress_bar.update(len(indices))
+                if progress_callback is not None:
+                    progress_callback(len(indices))
+            progress_bar.close()
+
+            completed = {
+                idx: writer.completed[idx + index_offset]
+                for idx in range(total)
+                if idx + index_offset in writer.completed
+            }
+
+        results = ordered_predictions(completed, total)
+        print(f"\nResults saved to: {output_file}")
+        if final_json_file:
+            write_json_predictions(results, final_json_file)
+            print(f"Ordered JSON written to: {final_json_file}")
+        return results
     
-    def interactive_mode(self):
-        """Start an interactive chat session."""
-        print("\nStarting interactive mode (type 'quit' to exit)")
+    def interactive_mode(
+        self,
+        chat_template: Optional[str] = None,
+        max_cached_tokens: int = 4096,
+        adapter: Optional[str] = None,
+    ):
+        """
+        Start an interactive chat session.
+        
+        The conversation's KV cache is kept between turns, so each reply only
+        processes the new message.
+        
+        Args:
+            chat_template: Optional entry of prompts/prompt.json used to lay out turns
+            max_cached_tokens: Oldest turns are dropped once the transcript exceeds this
+            adapter: Registry adapter the whole conversation runs through
+        """
+        session = ChatSession(
+            self.model,
+            self.tokenizer,
+            template=ChatTemplate.from_prompt_file(chat_template),
+            max_cached_tokens=max_cached_tokens,
+        )
+        print("\nStarting interactive mode (type 'quit' to exit, 'reset' to clear history)")
         print("-" * 50)
         
         while True:
             user_input = input("\nYou: ").strip()
             if user_input.lower() in ['quit', 'exit']:
                 break
+            if user_input.lower() == 'reset':
+                session.reset()
+                print("History cleared.")
+                continue
                 
             if not user_input:
                 continue
                 
             print("\nAssistant: ", end="", flush=True)
-            for text in self.generate_stream(user_input):
-                print(text, end="", flush=True)
+            generated: List[int] = []
+            printed = [""]
+            
+            def _print_token(token: int):
+                generated.append(token)
+                text = self.tokenizer.decode(generated, skip_special_tokens=True)
+                print(text[len(printed[0]):], end="", flush=True)
+                printed[0] = text
+            
+            with self.use_adapter(adapter):
+                session.chat(
+                    user_input,
+                    max_new_tokens=self.max_length,
+                    temperature=self.temperature,
+                    top_p=self.top_p,
+                    top_k=self.top_k,
+                    on_token=_print_token,
+                )
             print()  # New line at the end
     
     @staticmethod
     def _save_results(results: List[Dict[str, str]], output_file: str):
         """Save results to a JSON file."""
-        os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(results, f, ensure_ascii=False, indent=2)
+        write_json_predictions(results, output_file)
+
+def load_inference_inputs(
+    input_file: str,
+    input_field: str = "input",
+    max_samples: Optional[int] = None,
+) -> List[str]:
+    """Read prompts from a JSON list (or single object) of examples."""
+    print(f"Loading inputs from: {input_file}")
+    with open(input_file, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+        
+    if isinstance(data, dict):
+        data = [data]
+        
+    if max_samples:
+        data = data[:max_samples]
+    return [item[input_field] for item in data]
+
+
+def _shard_output_path(output_file: str, shard_id: int) -> str:
+    root = output_file
+    for suffix in (".jsonl.gz", ".jsonl", ".json"):
+        if root.endswith(suffix):
+            root = root[:-len(suffix)]
+            break
+    return f"{root}.shard{shard_id}.jsonl"
+
+
+def _split_cores(num_workers: int) -> List[List[int]]:
+    """Partition the CPUs this process may use into one subset per worker."""
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    if len(cores) < num_workers:
+        return [cores for _ in range(num_workers)]
+    per_worker, extra = divmod(len(cores), num_workers)
+    subsets, start = [], 0
+    for worker in range(num_workers):
+        end = start + per_worker + (1 if worker < extra else 0)
+        subsets.append(cores[start:end])
+        start = end
+    return subsets
+
+
+def _inference_shard_worker(
+    shard_id: int,
+    inputs: List[str],
+    index_offset: int,
+    cores: List[int],
+    shard_file: str,
+    model_kwargs: Dict[str, Any],
+    batch_kwargs: Dict[str, Any],
+    progress_queue,
+) -> None:
+    """Run one shard in a child process pinned to ``cores``."""
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(max(1, len(cores)))
+
+    inference = ModelInference(**model_kwargs)
+    inference._batch_inference_jsonl(
+        inputs,
+        shard_file,
+        final_json_file=None,
+        index_offset=index_offset,
+        progress_callback=lambda count: progress_queue.put((shard_id, count)),
+        **batch_kwargs,
+    )
+
+
+def run_sharded_inference(
+    model_kwargs: Dict[str, Any],
+    input_file: str,
+    output_file: str,
+    num_workers: int,
+    input_field: str = "input",
+    max_samples: Optional[int] = None,
+    batch_size: int = 8,
+    max_batch_tokens: Optional[int] = None,
+    resume: bool = True,
+    final_json_file: Optional[str] = None,
+    stop: Optional[Union[str, List[str]]] = None,
+    adapter: Optional[str] = None,
+) -> List[Dict[str, str]]:
+    """
+    Shard batch inference across ``num_workers`` processes.
+
+    Each worker loads its own model (one shared physical copy with
+    ``mmap_weights``), is pinned to a disjoint CPU subset and appends to
+    ``<output>.shardN.jsonl``; shard files double as resume state. Once every
+    shard finishes they are merged into ``output_file`` in input order.
+    """
+    inputs = load_inference_inputs(input_file, input_field, max_samples)
+    total = len(inputs)
+    num_workers = max(1, min(num_workers, total or 1))
+    shard_size = -(-total // num_workers) if total else 0
+    core_sets = _split_cores(num_workers)
+
+    ctx = mp.get_context("spawn")
+    progress_queue = ctx.Queue()
+    batch_kwargs = {
+        "batch_size": batch_size,
+        "max_batch_tokens": max_batch_tokens,
+        "resume": resume,
+        "stop": stop,
+        "adapter": adapter,
+    }
+    workers = []
+    shard_files = []
+    already_done = 0
+    for shard_id in range(num_workers):
+        start = shard_id * shard_size
+        shard_inputs = inputs[start:start + shard_size]
+        shard_file = _shard_output_path(output_file, shard_id)
+        shard_files.append(shard_file)
+        if resume:
+            done, _ = load_jsonl_predictions(shard_file)
+            already_done += sum(
+                1 for idx, text in enumerate(shard_inputs)
+                if done.get(start + idx, {}).get("input") == text
+            )
+        process = ctx.Process(
+            target=_inference_shard_worker,
+            args=(
+                shard_id, shard_inputs, start, core_sets[shard_id],
+                shard_file, model_kwargs, batch_kwargs, progress_queue,
+            ),
+        )
+        process.start()
+        workers.append(process)
+        print(f"Shard {shard_id}: {len(shard_inputs)} samples on cores {core_sets[shard_id]}")
+
+    progress_bar = tqdm(total=total, initial=already_done, desc="Generating responses", unit="sample")
+    while any(process.is_alive() for process in workers) or not progress_queue.empty():
+        try:
+            _, count = progress_queue.get(timeout=1.0)
+        except queue.Empty:
+            continue
+        progress_bar.update(count)
+    progress_bar.close()
+    for process in workers:
+        process.join()
+
+    failed = [shard_id for shard_id, process in enumerate(workers) if process.exitcode != 0]
+    if failed:
+        raise RuntimeError(
+            f"Inference shards {failed} failed; completed results are kept in their "
+            f"shard files and will be reused on the next run"
+        )
+
+    merged: Dict[int, Dict] = {}
+    for shard_file in shard_files:
+        records, _ = load_jsonl_predictions(shard_file)
+        merged.update(records)
+    results = ordered_predictions(merged, total)
+
+    if is_jsonl_path(output_file):
+        with JsonlPredictionWriter(output_file, resume=False) as writer:
+            writer.write(
+                {INDEX_FIELD: idx, **merged[idx]} for idx in range(total) if idx in merged
+            )
+    else:
+        write_json_predictions(results, output_file)
+    if final_json_file:
+        write_json_predictions(results, final_json_file)
+    for shard_file in shard_files:
+        os.remove(shard_file)
+    print(f"\nMerged {len(results)} results from {num_workers} shards into: {output_file}")
+    return results
+
 
 def main(
     model_path: str = "./merged_model",
@@ -237,14 +1103,33 @@ def main(
     top_k: int = 50,
     num_beams: int = 1,
     trust_remote_code: bool = True,
+    batch_size: int = 8,
+    max_batch_tokens: Optional[int] = None,
+    resume: bool = True,
+    final_json_file: Optional[str] = None,
+    num_workers: int = 1,
+    prefix_cache_mb: int = 0,
+    chat_template: Optional[str] = None,
+    draft_model_path: Optional[str] = None,
+    num_draft_tokens: int = 4,
+    prompt_lookup: bool = False,
+    adapter: Optional[str] = None,
+    adapter_registry: str = "config/adapters.json",
+    stop: Optional[Union[str, List[str]]] = None,
+    response_cache_size: int = 0,
+    response_cache_dir: Optional[str] = None,
+    mmap_weights: bool = False,
+    warmup: bool = False,
 ):
     """
     Run model inference in one of three modes:
     1. Single query mode: Provide a direct query
-    2. Batch mode: Process inputs from a JSON file
+    2. Batch mode: Process inputs from a JSON file (use a .jsonl/.jsonl.gz
+       output_file for append-only, resumable output; num_workers > 1 shards
+       the file across CPU-pinned worker processes)
     3. Interactive mode: Start a chat session
     """
-    inference = ModelInference(
+    model_kwargs = dict(
         model_path=model_path,
         device=device,
         max_length=max_length,
@@ -253,13 +1138,52 @@ def main(
         top_k=top_k,
         num_beams=num_beams,
         trust_remote_code=trust_remote_code,
+        prefix_cache_mb=prefix_cache_mb,
+        draft_model_path=draft_model_path,
+        adapter_registry=adapter_registry if adapter else None,
+        response_cache_size=response_cache_size,
+        response_cache_dir=response_cache_dir,
+        # Lets sharded workers share one copy of the weights
+        mmap_weights=mmap_weights,
+        warmup=warmup,
     )
+    if input_file and not query and num_workers > 1:
+        run_sharded_inference(
+            model_kwargs,
+            input_file=input_file,
+            output_file=output_file,
+            num_workers=num_workers,
+            input_field=input_field,
+            max_samples=max_samples,
+            batch_size=batch_size,
+            max_batch_tokens=max_batch_tokens,
+            resume=resume,
+            final_json_file=final_json_file,
+            stop=stop,
+            adapter=adapter,
+        )
+        return
+
+    inference = ModelInference(**model_kwargs)
     
     if query:
         # Single query mode
         print("\nQuery:", query)
+        if draft_model_path or prompt_lookup:
+            if draft_model_path:
+                response, stats = inference.generate_speculative(
+                    query, num_draft_tokens=num_draft_tokens, adapter=adapter, stop=stop
+                )
+            else:
+                response, stats = inference.generate_prompt_lookup(query, adapter=adapter, stop=stop)
+            print("\nAssistant:", response)
+            print("\nSpeculative decoding:", json.dumps(stats, indent=2))
+            return
+        if adapter:
+            print("\nAssistant:", inference.generate_response(query, adapter=adapter, stop=stop))
+            return
         print("\nAssistant:", end=" ", flush=True)
-        for text in inference.generate_stream(query):
+        for text in inference.generate_stream(query, stop=stop):
             print(text, end="", flush=True)
         print()  # New line at the end
     elif input_file:
@@ -268,11 +1192,17 @@ def main(
             input_file=input_file,
             output_file=output_file,
             input_field=input_field,
-            max_samples=max_samples
+            max_samples=max_samples,
+            batch_size=batch_size,
+            max_batch_tokens=max_batch_tokens,
+            resume=resume,
+            final_json_file=final_json_file,
+            stop=stop,
+            adapter=adapter,
         )
     else:
         # Interactive mode
-        inference.interactive_mode()
+        inference.interactive_mode(chat_template=chat_template, adapter=adapter)
 
 if __name__ == "__main__":
     fire.Fire(main)
@@ -42,6 +42,8 @@ INPUT_FILE="${INPUT_FILE:-$DEFAULT_INPUT_FILE}"
 OUTPUT_FILE="${OUTPUT_FILE:-$DEFAULT_OUTPUT_FILE}"
 INPUT_FIELD="${INPUT_FIELD:-input}"
 MAX_SAMPLES="${MAX_SAMPLES:-20}"
+BATCH_SIZE="${BATCH_SIZE:-8}"
+NUM_WORKERS="${NUM_WORKERS:-1}"
 
 # Run inference
 if [ "${PIPELINE_TEST_MODE:-0}" = "1" ]; then
@@ -106,6 +108,8 @@ elif [ -n "$INPUT_FILE" ]; then # Check if INPUT_FILE is non-empty after potenti
         --output_file="$OUTPUT_FILE" \
         --input_field="$INPUT_FIELD" \
         --max_samples="$MAX_SAMPLES" \
+        --batch_size="$BATCH_SIZE" \
+        --num_workers="$NUM_WORKERS" \
         --device="$DEVICE" \
         --max_length="$MAX_LENGTH" \
         --temperature="$TEMPERATURE" \
@@ -0,0 +1,248 @@
+"""
+Speculative decoding: cheap proposals verified by the target model in one pass.
+
+A proposer guesses the next ``k`` tokens; the target scores the whole guess in
+a single forward pass and keeps the longest prefix it agrees with (greedy) or
+accepts each token with probability ``min(1, p/q)`` (sampling), which leaves
+the output distribution unchanged. ``k`` grows while proposals are accepted in
+full and shrinks after a rejection.
+"""
+import time
+from dataclasses import dataclass, field
+from typing import Any, Iterable, List, Optional, Sequence, Tuple
+
+import torch
+
+from cancellation import CancellationToken
+from kv_cache import crop_cache
+
+
+def filtered_probs(logits: torch.Tensor, temperature: float, top_p: float, top_k: int) -> torch.Tensor:
+    """Next-token distribution after temperature, top-k and top-p (one-hot when greedy)"""
+    logits = logits.float()
+    if temperature <= 0:
+        probs = torch.zeros_like(logits)
+        probs[logits.argmax()] = 1.0
+        return probs
+    logits = logits / temperature
+    if top_k and top_k > 0 and top_k < logits.shape[-1]:
+        threshold = torch.topk(logits, top_k).values[-1]
+        logits = logits.masked_fill(logits < threshold, float("-inf"))
+    probs = logits.softmax(dim=-1)
+    if top_p < 1.0:
+        sorted_probs, sorted_idx = probs.sort(descending=True)
+        exceeded = (sorted_probs.cumsum(-1) - sorted_probs) > top_p
+        sorted_probs = sorted_probs.masked_fill(exceeded, 0.0)
+        probs = torch.zeros_like(probs).scatter(0, sorted_idx, sorted_probs)
+        probs = probs / probs.sum()
+    return probs
+
+
+def _align(probs: torch.Tensor, size: int) -> torch.Tensor:
+    # Draft and target heads of one family can differ in padded vocab size
+    if probs.shape[-1] == size:
+        return probs
+    if probs.shape[-1] > size:
+        probs = probs[:size]
+        return probs / probs.sum().clamp(min=1e-12)
+    return torch.nn.functional.pad(probs, (0, size - probs.shape[-1]))
+
+
+@dataclass
+class SpeculativeStats:
+    """Per-request acceptance accounting"""
+    method: str
+    proposed: int = 0
+    accepted: int = 0
+    target_passes: int = 0
+    new_tokens: int = 0
+    seconds: float = 0.0
+    draft_lengths: List[int] = field(default_factory=list)
+
+    def to_dict(self) -> dict:
+        return {
+            "method": self.method,
+            "proposed_tokens": self.proposed,
+            "accepted_tokens": self.accepted,
+            "acceptance_rate": self.accepted / self.proposed if self.proposed else 0.0,
+            "target_forward_passes": self.target_passes,
+            "new_tokens": self.new_tokens,
+            "tokens_per_target_pass": self.new_tokens / self.target_passes if self.target_passes else 0.0,
+            "tokens_per_second": self.new_tokens / self.seconds if self.seconds else 0.0,
+            "mean_draft_length": sum(self.draft_lengths) / len(self.draft_lengths) if self.draft_lengths else 0.0,
+        }
+
+
+class DraftModelProposer:
+    """Proposes tokens by decoding a small model of the same tokenizer family"""
+
+    method = "draft_model"
+
+    def __init__(self, draft_model: Any, temperature: float, top_p: float, top_k: int):
+        self.model = draft_model
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self._past = None
+        self._cached = 0
+
+    def propose(self, sequence: Sequence[int], k: int) -> Tuple[List[int], Optional[List[torch.Tensor]]]:
+        device = next(self.model.parameters()).device
+        pending = list(sequence[self._cached:])
+        tokens: List[int] = []
+        dists: List[torch.Tensor] = []
+        for step in range(k):
+            input_ids = torch.tensor([pending], dtype=torch.long, device=device)
+            outputs = self.model(input_ids=input_ids, past_key_values=self._past, use_cache=True)
+            self._past = outputs.past_key_values
+            self._cached += len(pending)
+            probs = filtered_probs(outputs.logits[0, -1], self.temperature, self.top_p, self.top_k)
+            token = int(torch.multinomial(probs, 1)) if self.temperature > 0 else int(probs.argmax())
+            tokens.append(token)
+            dists.append(probs)
+            pending = [token]
+        return tokens, dists
+
+    def rollback(self, valid_length: int) -> None:
+        if self._cached > valid_length:
+            self._past = crop_cache(self._past, valid_length)
+            self._cached = valid_length
+
+
+class PromptLookupProposer:
+    """
+    Proposes the continuation of the latest earlier occurrence of the trailing n-gram.
+
+    Works well when outputs copy spans from the prompt (summaries, quoting QA)
+    and needs no second model.
+    """
+
+    method = "prompt_lookup"
+
+    def __init__(self, max_ngram_size: int = 3, min_ngram_size: int = 1):
+        self.max_ngram_size = max_ngram_size
+        self.min_ngram_size = min_ngram_size
+
+    def propose(self, sequence: Sequence[int], k: int) -> Tuple[List[int], None]:
+        if k <= 0:
+            return [], None
+        for size in range(min(self.max_ngram_size, len(sequence) - 1), self.min_ngram_size - 1, -1):
+            tail = list(sequence[-size:])
+            # Search right-to-left so the most recent match wins
+            for start in range(len(sequence) - size - 1, -1, -1):
+                if list(sequence[start:start + size]) == tail:
+                    continuation = list(sequence[start + size:start + size + k])
+                    if continuation:
+                        return continuation, None
+        return [], None
+
+    def rollback(self, valid_length: int) -> None:
+        pass
+
+
+def speculative_generate(
+    target: Any,
+    prompt_ids: Sequence[int],
+    proposer: Any,
+    max_new_tokens: int,
+    eos_token_ids: Iterable[int],
+    temperature: float = 0.0,
+    top_p: float = 1.0,
+    top_k: int = 0,
+    num_draft_tokens: int = 4,
+    max_draft_tokens: int = 16,
+    adaptive: bool = True,
+    cancel: Optional[CancellationToken] = None,
+    stop_matcher: Optional[Any] = None,
+) -> Tuple[List[int], SpeculativeStats]:
+    """
+    Generate up to ``max_new_tokens`` with proposals verified by ``target``.
+
+    ``proposer`` implements ``propose(sequence, k) -> (tokens, dists)`` where
+    ``dists`` is a list of proposal distributions or ``None`` for deterministic
+    proposals, and ``rollback(valid_length)`` to discard rejected state.
+    Generation ends early, keeping what was accepted, once ``cancel`` fires,
+    and as soon as the output ends with a sequence of ``stop_matcher`` (a
+    :class:`stop_sequences.StopSequenceMatcher`); trimming the stop string from
+    the decoded text is left to the caller.
+    """
+    eos = set(eos_token_ids)
+    stats = SpeculativeStats(method=proposer.method)
+    started = time.time()
+    device = next(target.parameters()).device
+    sequence = list(prompt_ids)
+    prompt_len = len(sequence)
+    past, cached = None, 0
+    k = num_draft_tokens
+    finished = False
+
+    with torch.no_grad():
+        while not finished and len(sequence) - prompt_len < max_new_tokens:
+            if cancel is not None and cancel.cancelled:
+                break
+            remaining = max_new_tokens - (len(sequence) - prompt_len)
+            draft, dists = proposer.propose(sequence, min(k, max(remaining - 1, 0)))
+            stats.proposed += len(draft)
+            stats.draft_lengths.append(len(draft))
+
+            pending = sequence[cached:]
+            input_ids = torch.tensor([pending + draft], dtype=torch.long, device=device)
+            outputs = target(input_ids=input_ids, past_key_values=past, use_cache=True)
+            past = outputs.past_key_values
+            stats.target_passes += 1
+            logits = outputs.logits[0, len(pending) - 1:]
+            vocab = logits.shape[-1]
+
+            new_tokens: List[int] = []
+            rejected = False
+            for i, token in enumerate(draft):
+                p = filtered_probs(logits[i], temperature, top_p, top_k)
+                if temperature <= 0:
+                    accept = token < vocab and int(p.argmax()) == token
+                else:
+                    q_token = float(dists[i][token]) if dists is not None else 1.0
+                    p_token = float(p[token]) if token < vocab else 0.0
+                    accept = torch.rand(()).item() < min(1.0, p_token / max(q_token, 1e-12))
+                if accept:
+                    new_tokens.append(token)
+                    if token in eos:
+                        break
+                    continue
+                # Resample from the residual so sampling stays faithful to the target
+                if temperature <= 0:
+                    new_tokens.append(int(p.argmax()))
+                else:
+                    q = _align(dists[i], vocab) if dists is not None else torch.nn.functional.one_hot(
+                        torch.tensor(token), vocab
+                    ).to(p)
+                    residual = (p - q).clamp(min=0)
+                    residual = residual / residual.sum() if residual.sum() > 0 else p
+                    new_tokens.append(int(torch.multinomial(residual, 1)))
+                rejected = True
+                break
+            accepted = len(new_tokens) - (1 if rejected else 0)
+            stats.accepted += accepted
+
+            if not rejected and not (new_tokens and new_tokens[-1] in eos):
+                bonus = filtered_probs(logits[len(draft)], temperature, top_p, top_k)
+                new_tokens.append(int(torch.multinomial(bonus, 1)) if temperature > 0 else int(bonus.argmax()))
+
+            # Cached positions beyond the accepted prefix hold rejected guesses
+            valid = len(sequence) + accepted
+            past = crop_cache(past, valid)
+            cached = valid
+            proposer.rollback(valid)
+
+            for token in new_tokens[:remaining]:
+                sequence.append(token)
+                if token in eos or (stop_matcher and stop_matcher.match_sequences([sequence[prompt_len:]])[0]):
+                    finished = True
+                    break
+
+            if adaptive and draft:
+                k = min(k + 2, max_draft_tokens) if accepted == len(draft) else max(1, k - 1)
+
+    generated = sequence[prompt_len:]
+    stats.new_tokens = len(generated)
+    stats.seconds = time.time() - started
+    return generated, stats
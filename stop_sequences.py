@@ -0,0 +1,120 @@
+"""
+Multi-token stop sequences checked for every batch row at once.
+
+Stop strings are compiled once per tokenizer into a right-aligned table of
+token-id suffixes. A string can tokenize several ways depending on its
+neighbours ("\\n\\n" may be one token or two), so each string contributes every
+variant we can derive: its plain encoding, a per-character encoding and any
+single vocabulary token that decodes to it. Each decode step compares the
+tail of all rows against the whole table in one tensor operation.
+"""
+from functools import lru_cache
+from typing import Any, List, Optional, Sequence, Tuple, Union
+
+import torch
+from transformers import StoppingCriteria
+
+_PAD = -1
+
+
+def _token_variants(tokenizer: Any, stop: str) -> List[Tuple[int, ...]]:
+    variants = {tuple(tokenizer.encode(stop, add_special_tokens=False))}
+    per_char: List[int] = []
+    for char in stop:
+        per_char.extend(tokenizer.encode(char, add_special_tokens=False))
+    variants.add(tuple(per_char))
+    token_id = tokenizer.convert_tokens_to_ids(stop)
+    if isinstance(token_id, int) and token_id != tokenizer.unk_token_id:
+        variants.add((token_id,))
+    return [variant for variant in variants if variant]
+
+
+class StopSequenceMatcher:
+    """Compiled stop strings for one tokenizer"""
+
+    def __init__(self, tokenizer: Any, stop_strings: Sequence[str]):
+        self.stop_strings = [stop for stop in stop_strings if stop]
+        sequences = sorted({v for stop in self.stop_strings for v in _token_variants(tokenizer, stop)})
+        self.max_length = max((len(seq) for seq in sequences), default=0)
+        # Right-aligned so every row's last token lines up with column -1
+        table = [[_PAD] * (self.max_length - len(seq)) + list(seq) for seq in sequences]
+        self.table = torch.tensor(table, dtype=torch.long) if table else torch.empty(0, 0, dtype=torch.long)
+        self.lengths = [len(seq) for seq in sequences]
+
+    def __bool__(self) -> bool:
+        return bool(self.lengths)
+
+    def matches(self, input_ids: torch.Tensor, start: int = 0) -> torch.Tensor:
+        """
+        Rows of ``input_ids`` ``[batch, seq]`` whose tail ends with a stop sequence.
+
+        Tokens before ``start`` (the prompt) never count towards a match.
+        """
+        batch, width = input_ids.shape
+        if not self or width - start <= 0:
+            return torch.zeros(batch, dtype=torch.bool, device=input_ids.device)
+        tail = input_ids[:, -self.max_length:]
+        positions = torch.arange(width - tail.shape[1], width, device=input_ids.device)
+        # Mask prompt positions so a stop in the prompt cannot end generation
+        tail = torch.where(positions.unsqueeze(0) >= start, tail, torch.full_like(tail, -2))
+        if tail.shape[1] < self.max_length:
+            tail = torch.nn.functional.pad(tail, (self.max_length - tail.shape[1], 0), value=-2)
+        table = self.table.to(input_ids.device)
+        equal = (tail.unsqueeze(1) == table.unsqueeze(0)) | (table.unsqueeze(0) == _PAD)
+        return equal.all(dim=-1).any(dim=-1)
+
+    def match_sequences(self, sequences: Sequence[Sequence[int]]) -> List[bool]:
+        """Vectorized check for ragged token lists (e.g. per-request generated tokens)"""
+        if not sequences:
+            return []
+        width = max(1, self.max_length)
+        rows = [[-2] * max(0, width - len(seq)) + list(seq[-width:]) for seq in sequences]
+        return self.matches(torch.tensor(rows, dtype=torch.long)).tolist()
+
+    def trim_text(self, text: str) -> str:
+        """Cut ``text`` at the first stop string it contains"""
+        cut = len(text)
+        for stop in self.stop_strings:
+            idx = text.find(stop)
+            if idx != -1:
+                cut = min(cut, idx)
+        return text[:cut]
+
+    def split_safe(self, text: str) -> Tuple[str, str]:
+        """
+        Split streamed text into a part that can be emitted and a held-back tail.
+
+        The tail is the longest suffix that could still grow into a stop string.
+        """
+        held = 0
+        for stop in self.stop_strings:
+            for size in range(min(len(stop) - 1, len(text)), 0, -1):
+                if text.endswith(stop[:size]):
+                    held = max(held, size)
+                    break
+        return text[:len(text) - held], text[len(text) - held:]
+
+
+@lru_cache(maxsize=64)
+def compile_stop_sequences(tokenizer: Any, stop_strings: Tuple[str, ...]) -> StopSequenceMatcher:
+    """Compile once per (tokenizer, stop strings) pair"""
+    return StopSequenceMatcher(tokenizer, stop_strings)
+
+
+class StopSequenceCriteria(StoppingCriteria):
+    """Per-row stopping criterion for ``model.generate`` (row-wise results need transformers >= 4.39)"""
+
+    def __init__(self, matcher: StopSequenceMatcher, prompt_length: int):
+        self.matcher = matcher
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return self.matcher.matches(input_ids, start=self.prompt_length)
+
+
+def normalize_stop(stop: Optional[Union[str, Sequence[str]]]) -> Tuple[str, ...]:
+    if not stop:
+        return ()
+    if isinstance(stop, str):
+        return (stop,)
+    return tuple(s for s in stop if s)
@@ -2,6 +2,7 @@ import os
 import sys
 import json
 import logging
+import random
 import traceback
 import re
 from pathlib import Path
@@ -9,20 +10,36 @@ from typing import Optional, Dict, List, Union, Tuple
 from datetime import datetime
 
 import torch
-from datasets import Dataset, load_dataset
+from datasets import Dataset, concatenate_datasets, load_dataset
 import transformers
 from transformers import (
-    AutoModelForCausalLM,
     AutoTokenizer,
     BitsAndBytesConfig,
+    DataCollatorForSeq2Seq,
     TrainingArguments,
     Trainer,
     set_seed,
 )
-from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
+from peft import LoraConfig, PeftModel, get_peft_model, prepare_model_for_kbit_training
 import pandas as pd
 
-from prepare_dataset import prepare_dataset, format_prompt, load_json_dataset
+from prepare_dataset import (
+    FINGERPRINT_COLUMN,
+    add_row_fingerprints,
+    prepare_dataset,
+    format_prompt,
+    load_json_dataset,
+)
+from data_pruning import LOSS_WEIGHT_COLUMN, score_and_prune
+from dataset_mixture import MixtureStatsCallback, WeightedDatasetMixture, parse_mixture_sources
+from memory_guard import MemoryGuardCallback, free_memory, is_oom_error
+from weight_loading import load_causal_lm
+from multi_lora import (
+    has_multi_lora,
+    inject_multi_lora,
+    save_multi_lora_adapters,
+    set_adapter_indices,
+)
 
 # Configure logging
 logging.basicConfig(
@@ -151,6 +168,17 @@ class TrainingLogger:
         if exception:
             self.logger.error(f"Exception details:", exc_info=True)
     
+    def log_pruning_stats(self, stats: Dict):
+        """Log loss-based data pruning statistics"""
+        self.logger.info("="*50)
+        self.logger.info("Data Pruning:")
+        for key, value in stats.items():
+            if isinstance(value, dict):
+                summary = ", ".join(f"{k}={v:.4f}" for k, v in value.items())
+                self.logger.info(f"  {key}: {summary}")
+            else:
+                self.logger.info(f"  {key}: {value}")
+
     def log_training_complete(self, output_dir: str):
         """Log training completion"""
         self.logger.info("="*50)
@@ -164,6 +192,7 @@ def load_local_dataset(
     max_samples: Optional[int] = None,
     prompt_template: Optional[Union[str, Dict]] = None,
     logger: Optional["TrainingLogger"] = None,
+    add_fingerprints: bool = False,
 ) -> Dataset:
     """
     Load and prepare a local dataset
@@ -175,6 +204,9 @@ def load_local_dataset(
         target_column=target_column,
         max_samples=max_samples
     )
+
+    if add_fingerprints:
+        dataset = add_row_fingerprints(dataset, input_column=input_column, target_column=target_column)
     
     # Prepare dataset with prompt template if provided
     if prompt_template:
@@ -265,11 +297,23 @@ class DatasetProcessor:
             return_tensors=None  # Return lists instead of tensors
         )
 
-        # Create labels (same as input_ids for causal LM)
-        tokenized["labels"] = tokenized["input_ids"].copy()
+        # Create labels (same as input_ids for causal LM), ignoring padding so pad/eos
+        # positions are never trained on, whether or not the loss is weighted
+        tokenized["labels"] = [
+            [token if keep else -100 for token, keep in zip(ids, mask)]
+            for ids, mask in zip(tokenized["input_ids"], tokenized["attention_mask"])
+        ]
 
         return tokenized
 
+    def tokenize_example(self, example: Dict) -> Dict:
+        """Tokenize a single example (used by streaming datasets)"""
+        batch = {
+            self.input_column: [example[self.input_column]],
+            self.target_column: [example[self.target_column]],
+        }
+        return {key: value[0] for key, value in self.tokenize_and_format(batch).items()}
+
     def process_dataset(self, dataset: Dataset) -> Dataset:
         # Process the entire dataset at once
         processed_dataset = dataset.map(
@@ -282,6 +326,131 @@ class DatasetProcessor:
         return processed_dataset
 
 
+TASK_ID_COLUMN = "task_id"
+
+
+class PipelineTrainer(Trainer):
+    """Trainer with per-example loss weights, multi-LoRA task routing and OOM backoff"""
+
+    def __init__(self, *args, oom_backoff: bool = True, run_logger: Optional[logging.Logger] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.oom_backoff = oom_backoff
+        self.run_logger = run_logger or logging.getLogger(__name__)
+        self.micro_batch_splits = 1
+        self.oom_backoffs: List[Dict] = []
+        self._loss_scale = 1.0
+
+    def compute_loss(self, model, inputs, return_outputs=False, **kwargs):
+        task_ids = inputs.pop(TASK_ID_COLUMN, None)
+        if task_ids is not None:
+            # Left in place after the forward so checkpoint recomputation sees the same routing
+            set_adapter_indices(self.model, task_ids)
+
+        loss_weight = inputs.pop(LOSS_WEIGHT_COLUMN, None)
+        if loss_weight is None:
+            result = super().compute_loss(model, inputs, return_outputs=return_outputs, **kwargs)
+            if self._loss_scale == 1.0:
+                return result
+            if return_outputs:
+                return result[0] * self._loss_scale, result[1]
+            return result * self._loss_scale
+
+        labels = inputs.pop("labels")
+        outputs = model(**inputs)
+        shift_logits = outputs.logits[:, :-1, :].float()
+        shift_labels = labels[:, 1:]
+        mask = inputs["attention_mask"][:, 1:].float() if "attention_mask" in inputs else torch.ones_like(shift_labels, dtype=torch.float)
+        mask = mask * (shift_labels != -100).float()
+
+        token_loss = torch.nn.functional.cross_entropy(
+            shift_logits.reshape(-1, shift_logits.size(-1)),
+            shift_labels.clamp(min=0).reshape(-1),
+            reduction="none",
+        ).view(shift_labels.shape)
+        # Weight tokens by their row and normalise like the model's own loss (mean over
+        # labelled tokens), so a weight of 1.0 gives exactly the unweighted loss
+        weights = mask * loss_weight.to(token_loss.dtype).unsqueeze(1)
+        num_items = kwargs.get("num_items_in_batch")
+        if num_items is not None and getattr(self, "model_accepts_loss_kwargs", False):
+            denominator = torch.as_tensor(num_items, dtype=token_loss.dtype, device=token_loss.device)
+        else:
+            denominator = mask.sum().clamp(min=1.0)
+        loss = (token_loss * weights).sum() / denominator * self._loss_scale
+        return (loss, outputs) if return_outputs else loss
+
+    @staticmethod
+    def _split_inputs(inputs: Dict, parts: int) -> List[Dict]:
+        batch_size = next(v.shape[0] for v in inputs.values() if isinstance(v, torch.Tensor))
+        bounds = [round(i * batch_size / parts) for i in range(parts + 1)]
+        chunks = []
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            if hi > lo:
+                chunks.append({
+                    key: value[lo:hi] if isinstance(value, torch.Tensor) and value.dim() > 0 else value
+                    for key, value in inputs.items()
+                })
+        return chunks
+
+    def training_step(self, model, inputs, *args, **kwargs):
+        if not self.oom_backoff:
+            return super().training_step(model, inputs, *args, **kwargs)
+
+        batch_size = next(v.shape[0] for v in inputs.values() if isinstance(v, torch.Tensor))
+        # A globally normalised loss (num_items_in_batch) must not be rescaled per chunk
+        globally_normalised = (
+            kwargs.get("num_items_in_batch") is not None
+            and getattr(self, "model_accepts_loss_kwargs", False)
+        )
+        pending = self._split_inputs(inputs, min(self.micro_batch_splits, batch_size))
+        total_loss = None
+        while pending:
+            chunk = pending.pop(0)
+            chunk_rows = next(v.shape[0] for v in chunk.values() if isinstance(v, torch.Tensor))
+            # LoRA gradients are small, so snapshot them to undo a half-finished backward
+            grads = [(p, None if p.grad is None else p.grad.clone()) for p in model.parameters() if p.requires_grad]
+            self._loss_scale = 1.0 if globally_normalised else chunk_rows / batch_size
+            try:
+                loss = super().training_step(model, chunk, *args, **kwargs)
+            except Exception as exc:
+                if not is_oom_error(exc) or chunk_rows <= 1:
+                    raise
+                del exc
+                for param, grad in grads:
+                    param.grad = grad
+                free_memory()
+                self.micro_batch_splits = min(self.micro_batch_splits * 2, batch_size)
+                pending = self._split_inputs(chunk, 2) + pending
+                self._record_backoff(batch_size)
+                continue
+            finally:
+                self._loss_scale = 1.0
+            total_loss = loss if total_loss is None else total_loss + loss
+        return total_loss
+
+    def _record_backoff(self, batch_size: int) -> None:
+        micro_batch = max(1, batch_size // self.micro_batch_splits)
+        event = {
+            "step": self.state.global_step,
+            "micro_batch_size": micro_batch,
+            "micro_batch_splits": self.micro_batch_splits,
+            "effective_gradient_accumulation": self.args.gradient_accumulation_steps * self.micro_batch_splits,
+        }
+        self.oom_backoffs.append(event)
+        self.run_logger.warning(
+            f"Out of memory on step {event['step']}; retrying with micro-batch {micro_batch} "
+            f"and {event['effective_gradient_accumulation']}x gradient accumulation"
+        )
+        self.state.log_history.append({"oom_backoff": event, "step": event["step"]})
+
+    def save_model(self, output_dir: Optional[str] = None, _internal_call: bool = False):
+        if has_multi_lora(self.model):
+            # Only the adapter banks change; write each task as its own PEFT adapter
+            output_dir = output_dir or self.args.output_dir
+            save_multi_lora_adapters(self.model, output_dir)
+            return
+        super().save_model(output_dir, _internal_call=_internal_call)
+
+
 def resolve_model_path(model_name: str, model_cache_dir: Optional[str] = None) -> Tuple[str, bool]:
     """Return a resolved model path and flag whether it is local."""
     if os.path.isdir(model_name):
@@ -300,6 +469,92 @@ def resolve_model_path(model_name: str, model_cache_dir: Optional[str] = None) -
     return model_name, False
 
 
+TRAINING_MANIFEST_FILE = "training_manifest.json"
+
+
+def _resolve_registry_path(config_path: Union[str, os.PathLike]) -> Path:
+    config_path = Path(config_path)
+    if not config_path.is_absolute():
+        config_path = (Path(__file__).resolve().parent / config_path).resolve()
+    return config_path
+
+
+def find_registered_adapter(
+    config_path: Union[str, os.PathLike],
+    name_or_path: str,
+) -> Dict:
+    """Look up an adapter entry by name or path and resolve its directory."""
+
+    config_path = _resolve_registry_path(config_path)
+    if not config_path.exists():
+        raise ValueError(f"Adapter registry not found: {config_path}")
+
+    with config_path.open('r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    project_root = Path(__file__).resolve().parent
+    wanted = normalize_path_input(name_or_path)
+    for entry in config.get("adapters", []):
+        entry_path = Path(normalize_path_input(entry.get("path", "")))
+        if not entry_path.is_absolute():
+            entry_path = (project_root / entry_path).resolve()
+        candidates = {entry.get("name"), entry.get("path"), str(entry_path)}
+        if wanted in candidates or (os.path.isdir(wanted) and Path(wanted).resolve() == entry_path):
+            resolved = dict(entry)
+            resolved["resolved_path"] = str(entry_path)
+            # Entries inherit the registry-wide base model unless they record their own
+            if config.get("base_model"):
+                resolved.setdefault("base_model", config["base_model"])
+            return resolved
+
+    raise ValueError(f"Adapter '{name_or_path}' is not listed in {config_path}")
+
+
+def load_training_manifest(adapter_dir: Union[str, os.PathLike]) -> Optional[Dict]:
+    """Return the training manifest saved next to an adapter, if any."""
+    manifest_path = Path(adapter_dir) / TRAINING_MANIFEST_FILE
+    if not manifest_path.exists():
+        return None
+    with manifest_path.open('r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_training_manifest(
+    output_dir: Union[str, os.PathLike],
+    base_model_name: str,
+    dataset_path: Optional[str],
+    fingerprints: List[str],
+    parent_adapter: Optional[str] = None,
+) -> Path:
+    """Record which dataset rows an adapter has been trained on."""
+    manifest_path = Path(output_dir) / TRAINING_MANIFEST_FILE
+    manifest = {
+        "base_model": base_model_name,
+        "dataset_path": dataset_path,
+        "created_at": datetime.now().isoformat(),
+        "parent_adapter": parent_adapter,
+        "num_rows": len(fingerprints),
+        "fingerprints": sorted(fingerprints),
+    }
+    with manifest_path.open('w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    return manifest_path
+
+
+def select_dataset_delta(
+    fingerprints: List[str],
+    seen: set,
+    replay_fraction: float = 0.0,
+    seed: int = 42,
+) -> Tuple[List[int], List[int]]:
+    """Split row indices into unseen rows and a replay sample of seen rows."""
+    new_rows = [idx for idx, fp in enumerate(fingerprints) if fp not in seen]
+    old_rows = [idx for idx, fp in enumerate(fingerprints) if fp in seen]
+    replay_count = min(len(old_rows), int(round(len(new_rows) * replay_fraction)))
+    replay_rows = sorted(random.Random(seed).sample(old_rows, replay_count)) if replay_count else []
+    return new_rows, replay_rows
+
+
 def register_lora_adapter(
     config_path: Union[str, os.PathLike],
     base_model_name: str,
@@ -307,12 +562,11 @@ def register_lora_adapter(
     adapter_path: Union[str, os.PathLike],
     description: Optional[str] = None,
     logger: Optional[TrainingLogger] = None,
+    extra: Optional[Dict] = None,
 ):
     """Persist adapter metadata so merge scripts discover new runs automatically."""
 
-    config_path = Path(config_path)
-    if not config_path.is_absolute():
-        config_path = (Path(__file__).resolve().parent / config_path).resolve()
+    config_path = _resolve_registry_path(config_path)
 
     adapter_path = normalize_path_input(str(adapter_path))
     adapter_path = Path(adapter_path).resolve()
@@ -348,6 +602,8 @@ def register_lora_adapter(
             "description": description or "",
             "training_date": datetime.now().strftime("%Y-%m-%d"),
         }
+        if extra:
+            adapter_entry.update(extra)
 
         config["adapters"] = [
             existing
@@ -383,6 +639,7 @@ def train(
     model_name: str = "Qwen/Qwen2.5-0.5B-Instruct",
     dataset_path: Optional[str] = None,
     dataset_name: Optional[str] = None,
+    dataset_sources: Optional[Union[str, List]] = None,
     output_dir: str = "output",
     trust_remote_code: bool = True,
     
@@ -392,6 +649,8 @@ def train(
     max_samples: Optional[int] = None,
     max_length: int = 2048,
     max_target_length: Optional[int] = None,
+    mixture_samples_per_epoch: Optional[int] = None,
+    mixture_shuffle_buffer: int = 1000,
     
     # Training arguments
     num_train_epochs: float = 3.0,
@@ -420,6 +679,11 @@ def train(
     bias: str = "none",
     use_gradient_checkpointing: bool = False,
     
+    # OOM handling
+    oom_backoff: bool = True,
+    memory_guard_threshold: float = 0.92,
+    memory_guard_cooldown_steps: int = 50,
+    
     # Other arguments
     seed: int = 42,
     logging_steps: int = 10,
@@ -438,6 +702,17 @@ def train(
     # Prompt template
     prompt_template_type: Optional[str] = None,
     prompt_template: Optional[Union[str, Dict]] = None,
+
+    # Multi-task training: {"task name": "dataset path", ...}
+    task_datasets: Optional[Dict[str, str]] = None,
+
+    # Loss-based data pruning
+    prune_strategy: Optional[str] = None,
+    prune_fraction: float = 0.2,
+    prune_easy_weight: float = 0.1,
+    prune_num_strata: int = 10,
+    prune_batch_size: int = 8,
+    prune_scoring_adapter: Optional[str] = None,
     
     # Tracking arguments
     run_name: Optional[str] = None,
@@ -451,6 +726,11 @@ def train(
     adapter_name: Optional[str] = None,
     adapter_description: Optional[str] = None,
     adapter_config_path: Optional[str] = None,
+
+    # Incremental fine-tuning
+    warm_start_adapter: Optional[str] = None,
+    train_on_delta: bool = True,
+    replay_fraction: float = 0.0,
     
     # Model saving and loading
     save_safetensors: bool = True,
@@ -474,6 +754,7 @@ def train(
         model_cache_dir = normalize_path_input(model_cache_dir)
         adapter_config_path = normalize_path_input(adapter_config_path)
         resume_from_checkpoint = normalize_path_input(resume_from_checkpoint)
+        prune_scoring_adapter = normalize_path_input(prune_scoring_adapter)
 
         # Determine run name and target output directory
         if run_name is None:
@@ -513,6 +794,53 @@ def train(
         resolved_model_name, using_local_model = resolve_model_path(model_name, model_cache_dir)
         local_only = using_local_model or os.environ.get("TRANSFORMERS_OFFLINE", "0") == "1"
 
+        registry_path = (
+            Path(adapter_config_path)
+            if adapter_config_path
+            else Path(__file__).resolve().parent / "config" / "adapters.json"
+        )
+
+        if isinstance(task_datasets, str):
+            task_datasets = json.loads(task_datasets)
+        if task_datasets:
+            task_datasets = {name: normalize_path_input(path) for name, path in task_datasets.items()}
+            if warm_start_adapter:
+                raise ValueError("warm_start_adapter cannot be combined with task_datasets")
+
+        mixture_sources = None
+        if dataset_sources:
+            mixture_sources = parse_mixture_sources(dataset_sources)
+            for source in mixture_sources:
+                source.path = normalize_path_input(source.path)
+                # Like task_datasets, max_samples caps each source rather than the mixture
+                source.max_examples = max_samples
+            if task_datasets or prune_strategy or warm_start_adapter:
+                raise ValueError(
+                    "dataset_sources streams examples lazily and cannot be combined with "
+                    "task_datasets, prune_strategy or warm_start_adapter"
+                )
+
+        # Resolve the adapter to warm-start from before any heavy loading
+        parent_adapter = None
+        parent_manifest = None
+        if warm_start_adapter:
+            parent_adapter = find_registered_adapter(registry_path, warm_start_adapter)
+            parent_manifest = load_training_manifest(parent_adapter["resolved_path"])
+            parent_base = (parent_manifest or {}).get("base_model") or parent_adapter.get("base_model")
+            if parent_base and parent_base != model_name:
+                raise ValueError(
+                    f"Adapter '{warm_start_adapter}' was trained on base model {parent_base}, "
+                    f"not {model_name}; warm-starting it would not match the model's weights"
+                )
+            logger.logger.info(
+                f"Warm-starting from adapter '{parent_adapter.get('name')}' at {parent_adapter['resolved_path']}"
+            )
+            if parent_manifest is None and train_on_delta:
+                logger.logger.warning(
+                    "Adapter has no %s; training on the full dataset instead of a delta.",
+                    TRAINING_MANIFEST_FILE,
+                )
+
         # Log configuration
         config = {
             "Model": {
@@ -523,9 +851,11 @@ def train(
             },
             "Dataset": {
                 "path": dataset_path,
+                "sources": [f"{source.path} (weight {source.weight})" for source in mixture_sources] if mixture_sources else "none",
                 "name": dataset_name,
                 "max_samples": max_samples,
-                "max_length": max_length
+                "max_length": max_length,
+                "prune_strategy": prune_strategy or "none",
             },
             "Training": {
                 "num_epochs": num_train_epochs,
@@ -578,19 +908,15 @@ def train(
             bnb_config = None
 
         try:
-            load_kwargs = dict(
-                trust_remote_code=trust_remote_code,
-                local_files_only=local_only,
-            )
+            load_kwargs = dict(local_files_only=local_only)
             if bnb_config:
                 load_kwargs["quantization_config"] = bnb_config
-                load_kwargs["device_map"] = "auto"
-            else:
-                load_kwargs["torch_dtype"] = torch.float32
-                load_kwargs["device_map"] = "auto" if use_cuda else None
-
-            model = AutoModelForCausalLM.from_pretrained(
+            # Full-precision weights are cast per tensor straight onto the training device
+            model, load_report = load_causal_lm(
                 resolved_model_name,
+                device="auto" if use_cuda else "cpu",
+                torch_dtype="float32",
+                trust_remote_code=trust_remote_code,
                 **load_kwargs,
             )
         except OSError as err:
@@ -599,12 +925,9 @@ def train(
                 err,
             )
             raise
+        logger.logger.info(load_report.summary())
         model.config.use_cache = False
         
-        if not bnb_config:
-            target_device = torch.device("cuda") if use_cuda else torch.device("cpu")
-            model.to(target_device)
-        
         # Log model information
         model_info = {
             "Total parameters": sum(p.numel() for p in model.parameters()),
@@ -621,18 +944,6 @@ def train(
         if prompt_template is None and prompt_template_type:
             prompt_template = get_model_prompt_template(model_name, prompt_template_type)
         
-        # Load dataset
-        logger.logger.info("Loading dataset...")
-        dataset = load_local_dataset(
-            dataset_path=dataset_path,
-            input_column=input_column,
-            target_column=target_column,
-            max_samples=max_samples,
-            prompt_template=prompt_template,
-            logger=logger,
-        )
-        logger.log_dataset_info(dataset)
-        
         # Initialize dataset processor
         dataset_processor = DatasetProcessor(
             tokenizer=tokenizer,
@@ -640,19 +951,145 @@ def train(
             input_column=input_column,
             target_column=target_column
         )
-        
-        # Process dataset
-        logger.logger.info("Processing dataset...")
-        if isinstance(dataset, dict):
-            processed_dataset = {
-                split: dataset_processor.process_dataset(split_dataset)
-                for split, split_dataset in dataset.items()
-            }
-            train_dataset = processed_dataset["train"]
-            eval_dataset = processed_dataset.get("test")
-        else:
-            train_dataset = dataset_processor.process_dataset(dataset)
+
+        task_fingerprints: Dict[str, set] = {}
+        seen_fingerprints = set()
+        incremental_info = None
+        if task_datasets:
+            # Tokenize each task separately and tag rows with their adapter slot
+            logger.logger.info(f"Loading {len(task_datasets)} task datasets...")
+            task_splits = []
+            for task_idx, (task_name, task_path) in enumerate(task_datasets.items()):
+                task_dataset = load_local_dataset(
+                    dataset_path=task_path,
+                    input_column=input_column,
+                    target_column=target_column,
+                    max_samples=max_samples,
+                    prompt_template=prompt_template,
+                    logger=logger,
+                    add_fingerprints=True,
+                )
+                task_fingerprints[task_name] = set(task_dataset[FINGERPRINT_COLUMN])
+                logger.logger.info(f"Task '{task_name}' (slot {task_idx}): {len(task_dataset)} examples from {task_path}")
+                processed = dataset_processor.process_dataset(task_dataset)
+                task_splits.append(processed.add_column(TASK_ID_COLUMN, [task_idx] * len(processed)))
+            train_dataset = concatenate_datasets(task_splits)
             eval_dataset = None
+            trained_fingerprints = set()
+        elif mixture_sources:
+            logger.logger.info("Building streaming dataset mixture...")
+
+            def _mixture_transform(example: Dict) -> Dict:
+                if prompt_template:
+                    example = {
+                        **example,
+                        **format_prompt(
+                            example,
+                            input_column=input_column,
+                            target_column=target_column,
+                            prompt_template=prompt_template,
+                        ),
+                    }
+                return dataset_processor.tokenize_example(example)
+
+            train_dataset = WeightedDatasetMixture(
+                mixture_sources,
+                transform=_mixture_transform,
+                samples_per_epoch=mixture_samples_per_epoch,
+                seed=seed,
+                shuffle_buffer=mixture_shuffle_buffer,
+            )
+            eval_dataset = None
+            trained_fingerprints = set()
+            for name, stats in train_dataset.stats().items():
+                logger.logger.info(
+                    f"Mixture source {name}: weight={stats['weight']} p={stats['probability']:.3f} "
+                    f"examples={stats['num_examples']}"
+                )
+            logger.logger.info(f"Mixture yields {len(train_dataset)} examples per epoch")
+        else:
+            # Load dataset
+            logger.logger.info("Loading dataset...")
+            dataset = load_local_dataset(
+                dataset_path=dataset_path,
+                input_column=input_column,
+                target_column=target_column,
+                max_samples=max_samples,
+                prompt_template=prompt_template,
+                logger=logger,
+                add_fingerprints=True,
+            )
+
+            # Lineage and deltas are tracked on the rows actually trained on
+            train_split = dataset["train"] if isinstance(dataset, dict) else dataset
+
+            # Keep only rows the warm-start adapter has not seen, plus a replay sample
+            seen_fingerprints = set(parent_manifest.get("fingerprints", [])) if parent_manifest else set()
+            if parent_manifest and train_on_delta:
+                new_rows, replay_rows = select_dataset_delta(
+                    train_split[FINGERPRINT_COLUMN],
+                    seen_fingerprints,
+                    replay_fraction=replay_fraction,
+                    seed=seed,
+                )
+                incremental_info = {
+                    "total_rows": len(train_split),
+                    "new_rows": len(new_rows),
+                    "replay_rows": len(replay_rows),
+                }
+                logger.logger.info(
+                    f"Dataset delta: {len(new_rows)} new rows, {len(replay_rows)} replayed rows "
+                    f"out of {len(train_split)}"
+                )
+                if not new_rows:
+                    logger.logger.warning("No new rows since the warm-start adapter was trained; nothing to do.")
+                    return False
+                train_split = train_split.select(sorted(new_rows + replay_rows))
+                if isinstance(dataset, dict):
+                    dataset = dataset.__class__({**dataset, "train": train_split})
+                else:
+                    dataset = train_split
+
+            trained_fingerprints = set(train_split[FINGERPRINT_COLUMN])
+            logger.log_dataset_info(dataset)
+
+            # Process dataset
+            logger.logger.info("Processing dataset...")
+            if isinstance(dataset, dict):
+                processed_dataset = {
+                    split: dataset_processor.process_dataset(split_dataset)
+                    for split, split_dataset in dataset.items()
+                }
+                train_dataset = processed_dataset["train"]
+                eval_dataset = processed_dataset.get("test")
+            else:
+                train_dataset = dataset_processor.process_dataset(dataset)
+                eval_dataset = None
+
+        # Score examples with the frozen model and prune the easy ones
+        if prune_strategy:
+            logger.logger.info("Scoring training examples for loss-based pruning...")
+            scoring_model = model
+            if prune_scoring_adapter:
+                logger.logger.info(f"Scoring with prior adapter: {prune_scoring_adapter}")
+                scoring_model = PeftModel.from_pretrained(model, prune_scoring_adapter)
+            train_dataset, pruning_stats = score_and_prune(
+                scoring_model,
+                train_dataset,
+                pad_token_id=tokenizer.pad_token_id,
+                strategy=prune_strategy,
+                fraction=prune_fraction,
+                batch_size=prune_batch_size,
+                easy_weight=prune_easy_weight,
+                num_strata=prune_num_strata,
+                seed=seed,
+            )
+            if prune_scoring_adapter:
+                # Drop the scoring adapter so training starts from the plain base model
+                model = scoring_model.unload()
+            logger.log_pruning_stats(pruning_stats)
+            with open(os.path.join(output_dir, "logs", "pruning_stats.json"), "w", encoding="utf-8") as f:
+                json.dump(pruning_stats, f, indent=2)
         
         # Configure LoRA
         logger.logger.info("Configuring LoRA...")
@@ -666,8 +1103,33 @@ def train(
         )
         
         # Apply LoRA
-        logger.logger.info("Applying LoRA...")
-        model = get_peft_model(model, peft_config)
+        if task_datasets:
+            logger.logger.info(f"Injecting {len(task_datasets)} stacked LoRA adapters...")
+            for param in model.parameters():
+                param.requires_grad = False
+            inject_multi_lora(
+                model,
+                adapter_names=list(task_datasets.keys()),
+                r=lora_r,
+                lora_alpha=lora_alpha,
+                lora_dropout=lora_dropout,
+                target_modules=peft_config.target_modules,
+            )
+            if hasattr(model, "enable_input_require_grads"):
+                model.enable_input_require_grads()
+            if use_bnb:
+                # Trainer refuses to fine-tune a quantized model unless transformers' own adapter
+                # integration has marked adapters as attached, which is what this flag records.
+                # The task adapters are injected by multi_lora instead, so neither PEFT nor Trainer
+                # can see them. The flag's other effect (adapter-only save_pretrained) is never
+                # reached, because PipelineTrainer.save_model writes multi-LoRA banks itself.
+                model._hf_peft_config_loaded = True
+        elif parent_adapter:
+            logger.logger.info("Loading warm-start adapter weights...")
+            model = PeftModel.from_pretrained(model, parent_adapter["resolved_path"], is_trainable=True)
+        else:
+            logger.logger.info("Applying LoRA...")
+            model = get_peft_model(model, peft_config)
         
         # Training arguments
         logger.logger.info("Configuring training arguments...")
@@ -705,32 +1167,87 @@ def train(
             dataloader_pin_memory=use_cuda,
         )
         
+        callbacks = []
+        if mixture_sources:
+            callbacks.append(MixtureStatsCallback(train_dataset, logger.logger))
+        if memory_guard_threshold and memory_guard_threshold > 0:
+            callbacks.append(MemoryGuardCallback(
+                threshold=memory_guard_threshold,
+                cooldown_steps=memory_guard_cooldown_steps,
+                log=logger.logger,
+            ))
+
         # Initialize trainer
         logger.logger.info("Initializing trainer...")
-        trainer = Trainer(
+        trainer = PipelineTrainer(
             model=model,
             args=training_args,
             train_dataset=train_dataset,
             eval_dataset=eval_dataset,
             tokenizer=tokenizer,
+            # Streamed examples are tokenized one at a time and task datasets are padded per task,
+            # so rows in one batch can differ in length and labels need padding too
+            data_collator=DataCollatorForSeq2Seq(tokenizer, padding=True) if mixture_sources or task_datasets else None,
+            callbacks=callbacks,
+            oom_backoff=oom_backoff,
+            run_logger=logger.logger,
         )
         
         # Start training
         logger.logger.info("Starting training...")
         trainer.train()
+        if trainer.oom_backoffs:
+            logger.logger.warning(
+                f"Recovered from {len(trainer.oom_backoffs)} out-of-memory errors; "
+                f"final micro-batch split factor {trainer.micro_batch_splits}"
+            )
+            with open(os.path.join(output_dir, "logs", "oom_backoffs.json"), "w", encoding="utf-8") as f:
+                json.dump(trainer.oom_backoffs, f, indent=2)
         
         # Save model
         logger.logger.info("Saving model...")
         trainer.save_model(output_dir)
 
+        if task_datasets:
+            for task_name, task_path in task_datasets.items():
+                task_dir = Path(output_dir) / task_name
+                write_training_manifest(
+                    task_dir,
+                    base_model_name=model_name,
+                    dataset_path=task_path,
+                    fingerprints=list(task_fingerprints[task_name]),
+                )
+                if register_adapter:
+                    register_lora_adapter(
+                        config_path=registry_path,
+                        base_model_name=model_name,
+                        adapter_name=f"{adapter_name or run_name}-{task_name}",
+                        adapter_path=task_dir,
+                        description=adapter_description or f"Task '{task_name}' of multi-task run {run_name}",
+                        logger=logger,
+                        extra={"manifest": TRAINING_MANIFEST_FILE, "multitask_run": run_name},
+                    )
+            logger.logger.info("Training completed successfully!")
+            return True
+
+        # Record the rows covered by this adapter so later runs can train on the delta
+        write_training_manifest(
+            output_dir,
+            base_model_name=model_name,
+            dataset_path=dataset_path or (", ".join(source.path for source in mixture_sources) if mixture_sources else None),
+            fingerprints=list(seen_fingerprints | trained_fingerprints),
+            parent_adapter=parent_adapter.get("name") if parent_adapter else None,
+        )
+
         if register_adapter:
             adapter_label = adapter_name or run_name or dataset_name or Path(output_dir).name
             description = adapter_description or f"Run {run_name} saved at {Path(output_dir).name}"
-            registry_path = (
-                Path(adapter_config_path)
-                if adapter_config_path
-                else Path(__file__).resolve().parent / "config" / "adapters.json"
-            )
+            registry_extra = {"manifest": TRAINING_MANIFEST_FILE}
+            if parent_adapter:
+                registry_extra["parent_adapter"] = parent_adapter.get("name")
+                registry_extra["lineage"] = list(parent_adapter.get("lineage", [])) + [parent_adapter.get("name")]
+                if incremental_info:
+                    registry_extra["incremental"] = incremental_info
             register_lora_adapter(
                 config_path=registry_path,
                 base_model_name=model_name,
@@ -738,6 +1255,7 @@ def train(
                 adapter_path=output_dir,
                 description=description,
                 logger=logger,
+                extra=registry_extra,
             )
         
         logger.logger.info("Training completed successfully!")